@@ -32,6 +32,7 @@ from utils.pidfile import PidFile
 from utils.network import get_proxy, get_site_url
 from utils.flare import Flare
 from utils.platform import get_os, get_os_release
+from utils.util import _is_affirmative
 from metadata import get_metadata
 
 from collector import Collector
@@ -85,7 +86,12 @@ class AgentRunner(Thread):
 
     def run(self):
         log.info('Starting Agent Runner...')
-        self.collection()
+        # Flushes are serialized off the collection loop
+        self._serializer.start()
+        try:
+            self.collection()
+        finally:
+            self._serializer.stop()
 
 
 def init_config(do_log=True):
@@ -236,12 +242,20 @@ class Agent(Daemon):
             recent_point_threshold=config.get('recent_point_threshold'),
             histogram_aggregates=config.get('histogram_aggregates'),
             histogram_percentiles=config.get('histogram_percentiles'),
+            histogram_backend=config.get('histogram_backend'),
+            histogram_reservoir_size=config.get('histogram_reservoir_size'),
+            set_backend=config.get('set_backend'),
+            set_hll_precision=config.get('set_hll_precision'),
+            set_hll_threshold=config.get('set_hll_threshold'),
+            set_hll_metric_prefixes=config.get('set_hll_metric_prefixes'),
         )
 
         # serializer
         serializer = Serializer(
             aggregator,
             forwarder,
+            context_expiry=aggregator.expiry_seconds,
+            use_v2_series=_is_affirmative((config.get('forwarder') or {}).get('use_v2_series')),
         )
 
         # collect check configurations
@@ -270,9 +284,11 @@ class Agent(Daemon):
             'agent': aggregator.stats,
             'forwarder': forwarder.stats,
             'collector': collector.status,
+            'serializer': serializer.stats,
         }
         if dsd_server:
             status['dogstatsd'] = dsd_server.aggregator.stats
+            status['dogstatsd_serializer'] = reporter.serializer.stats
 
         api = APIServer(config, status=status)
 
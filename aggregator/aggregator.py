@@ -5,22 +5,35 @@
 
 # stdlib
 import logging
+from threading import Event
 from time import time
 from collections import defaultdict
+from itertools import chain
 from collections.abc import Hashable
 
 # project
 from .types import (
+    BucketGauge,
     Counter,
+    CounterColumns,
+    Distribution,
+    GaugeColumns,
     Histogram,
     MetricResolver,
     BucketMetricResolver,
+    Set,
 )
 
-from config.default import DEFAULT_RECENT_POINT_THRESHOLD
+from config.default import DEFAULT_DOGSTATSD_CONTEXT_CACHE_SIZE, DEFAULT_RECENT_POINT_THRESHOLD
+from .cache import ContextCache
+from .expiry import ExpiryQueue
 from .formatters import api_formatter
+from .interning import ContextRegistry, get_context_registry, get_tag_registry
+from .limits import OVERFLOW_TAG, OVERFLOW_TAG_BYTES, OVERFLOW_TAGS, ContextLimiter
+from .parser import parse_metric_packet, parse_metric_values, split_metric_header
 from .types import MetricTypes
 from utils.stats import Stats
+from utils.unicode import ensure_str
 
 
 log = logging.getLogger(__name__)
@@ -35,17 +48,28 @@ class Aggregator(object):
     # Types of metrics that allow strings
     ALLOW_STRINGS = ['s', ]
     # Types that are not implemented and ignored
-    IGNORE_TYPES = ['d', ]
+    IGNORE_TYPES = []
     # prefixes
     SC_PREFIX = '_sc'
     EVENT_PREFIX = '_e'
+    SC_PREFIX_BYTES = b'_sc'
+    EVENT_PREFIX_BYTES = b'_e'
+    # magic tags
+    HOST_TAG_PREFIX = 'host:'
+    HOST_TAG_PREFIX_BYTES = b'host:'
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, tag_registry=None, histogram_backend=None,
+                 histogram_reservoir_size=None, set_backend=None, set_hll_precision=None,
+                 set_hll_threshold=None, set_hll_metric_prefixes=None, context_registry=None):
         self.events = []
         self.service_checks = []
+        # Client timestamped points, passed through without aggregation
+        self.timestamped_series = []
+        # Flushed distributions, their value being a sketch
+        self.sketches = []
         self.stats = Stats()
 
         # TODO(jaime): we can probably kill total counts
@@ -67,15 +91,62 @@ class Aggregator(object):
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
-            }
+                'percentiles': histogram_percentiles,
+                'backend': histogram_backend,
+                'reservoir_size': histogram_reservoir_size,
+            },
+            Set: {
+                'backend': set_backend,
+                'hll_precision': set_hll_precision,
+                'hll_threshold': set_hll_threshold,
+                'hll_prefixes': set_hll_metric_prefixes,
+            },
         }
 
+        # Kept for compatibility: packets aren't decoded anymore, see
+        # submit_packets
         self.utf8_decoding = utf8_decoding
 
+        # Contexts tags are interned, and shared with the other aggregators
+        self.tag_registry = tag_registry or get_tag_registry()
+        # Contexts get an integer ID, shared with the other aggregators
+        if context_registry is None:
+            context_registry = get_context_registry() if tag_registry is None else ContextRegistry(tag_registry)
+        self.context_registry = context_registry
+        # Called with the contexts evicted from the registry by this aggregator
+        self.context_expiry_callbacks = []
+
+    def on_context_expiry(self, callback):
+        """
+        Registers `callback`, called with the (name, tags, hostname) of each
+        context this aggregator stops tracking: the ones it releases last
+        from the context registry
+        """
+        self.context_expiry_callbacks.append(callback)
+
+    def release_context_id(self, context_id):
+        """ Releases a reference on a registered context, calling the expiry callbacks if it got evicted """
+        context = self.context_registry.release(context_id)
+        if context is not None:
+            for callback in self.context_expiry_callbacks:
+                callback(context)
+
     def deduplicate_tags(self, tags):
         return sorted(set(tags))
 
+    def intern_tags(self, tags):
+        """ Deduplicates and sorts tags into their interned tuple """
+        return self.tag_registry.get(tuple(self.deduplicate_tags(tags)))
+
+    def save_registry_stats(self):
+        self.stats.set_stat('interned_tags', self.tag_registry.tag_count())
+        self.stats.set_stat('interned_tag_sets', self.tag_registry.tag_set_count())
+        self.stats.set_stat('interned_tag_bytes_saved', self.tag_registry.bytes_saved())
+        self.stats.set_stat('context_registry_size', len(self.context_registry))
+        self.stats.set_stat('context_registry_lookups', self.context_registry.lookups)
+        self.stats.set_stat('context_registry_created', self.context_registry.created)
+        self.stats.set_stat('context_registry_evicted', self.context_registry.evicted)
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -86,72 +157,7 @@ class Aggregator(object):
         Schema of a dogstatsd packet:
         <name>:<value>|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>:<value>|<metric_type>...
         """
-        parsed_packets = []
-        name_and_metadata = packet.split(':', 1)
-
-        if len(name_and_metadata) != 2:
-            raise Exception('Unparseable metric packet: {}'.format(packet))
-
-        name = name_and_metadata[0]
-        broken_split = name_and_metadata[1].split(':')
-        data = []
-        partial_datum = None
-        for token in broken_split:
-            # We need to fix the tag groups that got broken by the : split
-            if partial_datum is None:
-                partial_datum = token
-            elif "|" not in token:
-                partial_datum += ":" + token
-            else:
-                data.append(partial_datum)
-                partial_datum = token
-        data.append(partial_datum)
-
-        for datum in data:
-            value_and_metadata = datum.split('|')
-
-            if len(value_and_metadata) < 2:
-                raise Exception('Unparseable metric packet: {}'.format(packet))
-
-            # Submit the metric
-            raw_value = value_and_metadata[0]
-            metric_type = value_and_metadata[1]
-
-            if metric_type in self.ALLOW_STRINGS:
-                value = raw_value
-            elif len(metric_type) > 0 and metric_type[0] in self.IGNORE_TYPES:
-                continue
-            else:
-                # Try to cast as an int first to avoid precision issues, then as a
-                # float.
-                try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
-                        value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception('Metric value must be a number: {}, {}'.format(name, raw_value))
-
-            # Parse the optional values - sample rate & tags.
-            sample_rate = 1
-            tags = None
-            try:
-                for m in value_and_metadata[2:]:
-                    # Parse the sample rate
-                    if m[0] == '@':
-                        sample_rate = float(m[1:])
-                        # in case it's in a bad state
-                        sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
-                    elif m[0] == '#':
-                        tags = tuple(sorted(m[1:].split(',')))
-            except IndexError:
-                log.warning('Incorrect metric metadata: metric_name:%s, metadata:%s',
-                            name, ' '.join(value_and_metadata[2:]))
-
-            parsed_packets.append((name, value, metric_type, tags, sample_rate))
-
-        return parsed_packets
+        return parse_metric_packet(packet, self.ALLOW_STRINGS, self.IGNORE_TYPES)
 
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace(r'm\:', 'm:')
@@ -240,16 +246,14 @@ class Aggregator(object):
             raise Exception('Unparseable service check packet: {}'.format(packet))
 
     def submit_packets(self, packets):
-        # We should probably consider that packets are always encoded
-        # in utf8, but decoding all packets has an perf overhead of 7%
-        # So we let the user decide if we wants utf8 by default
-        # Keep a very conservative approach anyhow
+        # Packets are parsed as they come: bytes straight off the socket are
+        # never decoded, metric names and tags stay bytes until they are
+        # serialized. Events and service checks are rare enough to be decoded.
         # Clients MUST always send UTF-8 encoded content
-        if self.utf8_decoding:
-            try:
-                packets = packets.decode('utf-8')
-            except AttributeError:
-                pass
+        if isinstance(packets, bytes):
+            event_prefix, sc_prefix = self.EVENT_PREFIX_BYTES, self.SC_PREFIX_BYTES
+        else:
+            event_prefix, sc_prefix = self.EVENT_PREFIX, self.SC_PREFIX
 
         for packet in packets.splitlines():
             if not packet.strip():
@@ -257,29 +261,51 @@ class Aggregator(object):
 
             self.packet_count += 1
 
-            if packet.startswith(self.EVENT_PREFIX):
-                event = self.parse_event_packet(packet)
+            if packet.startswith(event_prefix):
+                event = self.parse_event_packet(ensure_str(packet))
                 self.event(**event)
                 self.event_count += 1
-            elif packet.startswith(self.SC_PREFIX):
-                service_check = self.parse_sc_packet(packet)
+            elif packet.startswith(sc_prefix):
+                service_check = self.parse_sc_packet(ensure_str(packet))
                 self.service_check(**service_check)
                 self.service_check_count += 1
             else:
-                parsed_packets = self.parse_metric_packet(packet)
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags,
-                                       hostname=hostname, sample_rate=sample_rate)
+                self.submit_metric_packet(packet)
+
+    def submit_metric_packet(self, packet):
+        parsed_packets = self.parse_metric_packet(packet)
+        for name, values, mtype, tags, sample_rate, timestamp in parsed_packets:
+            hostname, tags = self._extract_magic_tags(tags)
+            for value in values:
+                self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
+                                   timestamp=timestamp, sample_rate=sample_rate)
+
+    def submit_packets_batch(self, datagrams):
+        """
+        Submit a batch of datagrams received on a single wake-up. Datagrams
+        may be any buffer (bytes, memoryview), each one is processed on its own
+        so a bad datagram doesn't take the rest of the batch down with it.
+        Returns the number of datagrams that were dropped.
+        """
+        dropped = 0
+        for datagram in datagrams:
+            try:
+                self.submit_packets(bytes(datagram))
+            except Exception:
+                log.debug('Error processing datagram `%s`', bytes(datagram))
+                dropped += 1
+
+        return dropped
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host) override metric hostname attributes"""
         hostname = None
         # This implementation avoid list operations for the common case
         if tags:
+            host_prefix = self.HOST_TAG_PREFIX_BYTES if isinstance(tags[0], bytes) else self.HOST_TAG_PREFIX
             tags_to_remove = []
             for tag in tags:
-                if tag.startswith('host:'):
+                if tag.startswith(host_prefix):
                     hostname = tag[5:]
                     tags_to_remove.append(tag)
             if tags_to_remove:
@@ -406,10 +432,49 @@ class Aggregator(object):
 
         return service_checks
 
+    def flush_sketches(self):
+        """ Flush the sketches of the distributions flushed since the last call """
+        sketches = self.sketches
+        self.sketches = []
+
+        self.stats.set_stat('sketches', len(sketches))
+        self.stats.inc_stat('sketches_total', len(sketches))
+
+        return sketches
+
+    def flush_timestamped(self):
+        """ Flush the client timestamped points, as they were submitted """
+        series = self.timestamped_series
+        self.timestamped_series = []
+
+        self.stats.set_stat('timestamped_metrics', len(series))
+        self.stats.inc_stat('timestamped_metrics_total', len(series))
+
+        return series
+
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.packet_count, 'g')
 
 
+class Bucket(object):
+    """
+    Metrics sampled in a time bucket: gauges and counters in columns, by
+    metric class, the other types as metric objects, by context ID.
+    """
+    __slots__ = ('metrics', 'columns')
+
+    def __init__(self):
+        self.metrics = {}
+        self.columns = {}
+
+    def context_ids(self):
+        for context_id in self.metrics:
+            yield context_id
+        for columns in self.columns.values():
+            for context_id in columns.context_ids:
+                yield context_id
+
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -418,13 +483,51 @@ class MetricsBucketAggregator(Aggregator):
     incoming metrics and thus no implicit check-run assumptions can be made.
 
     Metric types supported by this aggregator: Gauge(BucketGauge), Counter,
-                                               Histogram, Set
+                                               Histogram, Set, Distribution
+
+    Gauges and counters, the bulk of the contexts, aren't metric objects: they
+    are stored and flushed in the columns of their bucket.
+
+    Gauges and counters timestamped by the client (`|T<timestamp>`) were
+    aggregated by the client already: they skip the contexts and buckets and
+    are passed through to `flush_timestamped`.
+
+    The contexts stored can be capped per metric name and in total: the
+    samples of the contexts over the limits are folded into an overflow
+    context of their metric, tagged `dd.overflow:true`.
+
+    Aggregators sharing the packets of the same contexts, like the dogstatsd
+    workers, can flush their gauges, histograms and sets as metric objects
+    instead of series, see `keep_states`, to merge them before flushing.
+
+    Ingestion and flush run in different threads without a lock: ingestion
+    calls run in an epoch, and flush detaches the closed buckets, starts a
+    new epoch and waits for the ingestion call of the previous one, if any,
+    before draining them. Ingestion calls come from a single thread at a
+    time. The packet and metric counts are only ever incremented by
+    ingestion: flush snapshots them once the previous epoch is done, and
+    reports the difference with its last snapshot. The packet count gauge,
+    submitted by the flushing thread, has buckets of its own.
     """
+    # Series types of the metric types that can be timestamped by clients
+    TIMESTAMPED_TYPES = {
+        'g': MetricTypes.GAUGE,
+        'c': MetricTypes.COUNT,
+    }
+    # Columns of the metric classes stored in columns
+    COLUMNS = {
+        BucketGauge: GaugeColumns,
+        Counter: CounterColumns,
+    }
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, context_cache_size=DEFAULT_DOGSTATSD_CONTEXT_CACHE_SIZE,
+                 tag_registry=None, histogram_backend=None, histogram_reservoir_size=None,
+                 set_backend=None, set_hll_precision=None, set_hll_threshold=None,
+                 set_hll_metric_prefixes=None, context_registry=None,
+                 max_contexts_per_metric=None, max_total_contexts=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -433,73 +536,389 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            tag_registry,
+            histogram_backend,
+            histogram_reservoir_size,
+            set_backend,
+            set_hll_precision,
+            set_hll_threshold,
+            set_hll_metric_prefixes,
+            context_registry
         )
+        # Metric headers resolved to their context ID, 0 disables the cache.
+        # Cached contexts are referenced until their entry is evicted.
+        self.context_cache = ContextCache(
+            context_cache_size, self.release_cache_entry) if context_cache_size else None
+        # Contexts stored in the buckets or tracked as counters, when limited
+        self.context_limiter = ContextLimiter(
+            max_contexts_per_metric, max_total_contexts) if max_contexts_per_metric or max_total_contexts else None
         self.metric_by_bucket = {}
         self.last_sample_time_by_context = {}
+        # Tracked counters, by last sample time
+        self.counter_expiry = ExpiryQueue()
+        # Buckets of the packet count gauge, sampled by the flushing thread
+        self.reporter_buckets = {}
+        # Flushed gauges, histograms and sets to be merged, by bucket, if kept
+        self.states = None
+        # Epoch of the buckets, bumped by flush, and of the running ingestion
+        # call. A single call runs at a time, nested calls in its epoch.
+        # Flush waits for the call of an older epoch on `ingest_done`.
+        self.epoch = 0
+        self.ingest_epoch = None
+        self.flush_waiting = False
+        self.ingest_done = Event()
+        # Packet and metric counts at the last flush
+        self.flushed_packet_count = 0
+        self.flushed_metric_count = 0
+        # Last bucket sampled, in its epoch
         self.current_bucket = None
-        self.current_mbc = {}
+        self.current_bucket_metrics = None
+        self.current_bucket_epoch = None
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = BucketMetricResolver()
 
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      timestamp=None, sample_rate=1):
+    def keep_states(self):
+        """
+        Flushes the gauges, histograms and sets as metric objects, by bucket,
+        to be merged with the ones of other aggregators and flushed then, see
+        `flush_states`
+        """
+        if self.states is None:
+            self.states = []
+
+    def flush_states(self):
+        """ Flush the (bucket timestamp, metric) of the states kept since the last call """
+        states = self.states
+        if states is None:
+            return []
+        self.states = []
+        return states
+
+    def enter_epoch(self):
+        """
+        Announces an ingestion call in the current epoch, returns False if
+        one is running already. Flush bumps the epoch before checking the
+        announcement, and the epoch is checked again after announcing it:
+        either flush waits for the call, or the call runs in the new epoch.
+        """
+        if self.ingest_epoch is not None:
+            return False
+        epoch = self.epoch
+        self.ingest_epoch = epoch
+        while self.epoch != epoch:
+            epoch = self.epoch
+            self.ingest_epoch = epoch
+        return True
+
+    def exit_epoch(self):
+        """
+        Ends the ingestion call, waking flush up if it's waiting for it. Flush
+        announces it waits before checking the epoch of the call, and the
+        call checks for it after ending: either flush sees the call ended, or
+        the call wakes it up.
+        """
+        self.ingest_epoch = None
+        if self.flush_waiting:
+            self.ingest_done.set()
+
+    def wait_for_ingestion(self):
+        """ Starts a new epoch, and waits for the ingestion call of an older one to be done """
+        self.epoch += 1
+        epoch = self.epoch
+        self.flush_waiting = True
+        try:
+            while True:
+                self.ingest_done.clear()
+                ingest_epoch = self.ingest_epoch
+                if ingest_epoch is None or ingest_epoch >= epoch:
+                    return
+                self.ingest_done.wait()
+        finally:
+            self.flush_waiting = False
+
+    def packets_since_flush(self):
+        return self.packet_count - self.flushed_packet_count
+
+    def send_packet_count(self, metric_name):
+        """ Samples the packets count since the last flush in the reporter buckets """
+        context_id = self.context_registry.acquire(self.resolve_context(metric_name))
+        self.sample_context(context_id, self.metric_type_to_class['g'], (self.packets_since_flush(),),
+                            buckets=self.reporter_buckets)
+        self.release_context_id(context_id)
+
+    def submit_packets(self, packets):
+        entered = self.enter_epoch()
+        try:
+            super(MetricsBucketAggregator, self).submit_packets(packets)
+        finally:
+            if entered:
+                self.exit_epoch()
+
+    def submit_packets_batch(self, datagrams):
+        entered = self.enter_epoch()
+        try:
+            return super(MetricsBucketAggregator, self).submit_packets_batch(datagrams)
+        finally:
+            if entered:
+                self.exit_epoch()
+
+    def submit_metric_packet(self, packet):
+        cache = self.context_cache
+        header = split_metric_header(packet) if cache is not None else None
+        if header is not None:
+            key, raw_values = header
+            entry = cache.get(key)
+            if entry is not None:
+                context_id, name, mtype, metric_class, sample_rate = entry
+                values = parse_metric_values(name, raw_values, mtype, self.ALLOW_STRINGS)
+                self.sample_context(context_id, metric_class, values, sample_rate)
+                return
+
+        for name, values, mtype, tags, sample_rate, timestamp in self.parse_metric_packet(packet):
+            hostname, tags = self._extract_magic_tags(tags)
+            if timestamp is not None and mtype in self.TIMESTAMPED_TYPES:
+                self.submit_timestamped(name, values, mtype, tags, hostname, sample_rate, timestamp)
+                continue
+
+            # Other types are aggregated on arrival, whatever their timestamp
+            context = self.resolve_context(name, tags, hostname)
+            metric_class = self.metric_type_to_class[mtype]
+            if not self.admit_context(context, metric_class, values, sample_rate):
+                continue
+            context_id = self.context_registry.acquire(context)
+            if header is not None:
+                # The reference is handed over to the cache entry
+                cache.set(key, (context_id, name, mtype, metric_class, sample_rate))
+                self.sample_context(context_id, metric_class, values, sample_rate)
+            else:
+                self.sample_context(context_id, metric_class, values, sample_rate)
+                self.release_context_id(context_id)
+
+    def release_cache_entry(self, entry):
+        self.release_context_id(entry[0])
+
+    def submit_timestamped(self, name, values, mtype, tags, hostname, sample_rate, timestamp):
+        """ Queues the point of a client timestamped gauge or counter """
+        cur_time = time()
+        if cur_time - timestamp > self.recent_point_threshold:
+            log.debug("Discarding %s - ts = %s , current ts = %s ", name, timestamp, cur_time)
+            self.num_discarded_old_points += 1
+            return
+
+        if mtype == 'c':
+            value = sum(values) * int(1 / sample_rate)
+        else:
+            value = values[-1]
+
+        self.timestamped_series.append(self.formatter(
+            metric=name,
+            value=value,
+            timestamp=timestamp,
+            tags=tags,
+            hostname=hostname if hostname is not None else self.hostname,
+            metric_type=self.TIMESTAMPED_TYPES[mtype],
+            interval=self.interval,
+        ))
+        self.metric_count += len(values)
+
+    def resolve_context(self, name, tags=None, hostname=None):
         # Avoid calling extra functions to dedupe tags if there are none
         # Note: if you change the way that context is created, please also
-        # change create_empty_metrics, which counts on this order
+        # change zero_fill_counters, which counts on this order
 
         # Keep hostname with empty string to unset it
         hostname = hostname if hostname is not None else self.hostname
 
         if tags is None:
-            context = (name, tuple(), hostname)
-        else:
-            tags = tuple(self.deduplicate_tags(tags))
-            context = (name, tags, hostname)
+            return (name, tuple(), hostname)
+        return (name, self.intern_tags(tags), hostname)
+
+    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
+                      timestamp=None, sample_rate=1):
+        entered = self.enter_epoch()
+        try:
+            context = self.resolve_context(name, tags, hostname)
+            metric_class = self.metric_type_to_class[mtype]
+            if self.admit_context(context, metric_class, (value,), sample_rate, timestamp):
+                context_id = self.context_registry.acquire(context)
+                self.sample_context(context_id, metric_class, (value,), sample_rate, timestamp)
+                self.release_context_id(context_id)
+        finally:
+            if entered:
+                self.exit_epoch()
+
+    def resolve_overflow_context(self, name, hostname):
+        overflow_tag = OVERFLOW_TAG_BYTES if isinstance(name, bytes) else OVERFLOW_TAG
+        return (name, self.tag_registry.get((overflow_tag,)), hostname)
+
+    def admit_context(self, context, metric_class, values, sample_rate=1, timestamp=None):
+        """
+        Whether the limiter admits `context`, checked before registering it:
+        the values of a refused context are refused without registering it
+        """
+        limiter = self.context_limiter
+        if limiter is None:
+            return True
+        context_id = self.context_registry.get_id(context)
+        if context_id is not None and context_id in limiter:
+            return True
+        name, tags, hostname = context
+        if limiter.admit(name, tags in OVERFLOW_TAGS):
+            return True
+        self.refuse_context(name, tags, hostname, metric_class, values, sample_rate, timestamp)
+        return False
+
+    def refuse_context(self, name, tags, hostname, metric_class, values, sample_rate=1, timestamp=None,
+                       buckets=None):
+        """ Folds the values of a context over the limits into its overflow context, or drops them """
+        limiter = self.context_limiter
+        if tags not in OVERFLOW_TAGS:
+            overflow_id = self.context_registry.acquire(self.resolve_overflow_context(name, hostname))
+            try:
+                if overflow_id in limiter or limiter.admit(name, True):
+                    limiter.fold(name, len(values))
+                    self.sample_context(overflow_id, metric_class, values, sample_rate, timestamp, buckets)
+                    return
+            finally:
+                self.release_context_id(overflow_id)
+        limiter.drop(name, len(values))
+
+    def sample_context(self, context_id, metric_class, values, sample_rate=1, timestamp=None, buckets=None):
+        """
+        Samples the values submitted for a registered context, the caller
+        holding a reference on it, in the buckets of ingestion or in `buckets`
+        """
+        limiter = self.context_limiter
+        if limiter is not None and context_id not in limiter:
+            # Admitted before it was registered, but it may not fit anymore
+            name, tags, hostname = self.context_registry.get(context_id)
+            if not limiter.admit(name, tags in OVERFLOW_TAGS):
+                self.refuse_context(name, tags, hostname, metric_class, values, sample_rate, timestamp, buckets)
+                return
 
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is
         # not older than recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s ", name, timestamp, cur_time)
+            log.debug("Discarding %s - ts = %s , current ts = %s ",
+                      self.context_registry.get(context_id)[0], timestamp, cur_time)
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
+            if buckets is not None:
+                bucket = buckets.get(bucket_start_timestamp)
+                if bucket is None:
+                    bucket = buckets[bucket_start_timestamp] = Bucket()
+            # The last bucket sampled may have been detached by a flush since
+            elif bucket_start_timestamp == self.current_bucket and self.current_bucket_epoch == self.ingest_epoch:
+                bucket = self.current_bucket_metrics
             else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+                bucket = self.metric_by_bucket.get(bucket_start_timestamp)
+                if bucket is None:
+                    bucket = self.metric_by_bucket[bucket_start_timestamp] = Bucket()
                 self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
-
-            if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = \
-                    metric_class(self.formatter, name, tags,
-                                 hostname, self.metric_config.get(metric_class))
-
-            metric_by_context[context].sample(value, sample_rate, timestamp)
-            self.metric_count += 1
-
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
-        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
-        #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in list(sample_time_by_context.items()):
-            if last_sample_time is None or last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring.", context, self.expiry_seconds)
-                self.last_sample_time_by_context.pop(context, None)
+                self.current_bucket_metrics = bucket
+                self.current_bucket_epoch = self.ingest_epoch
+
+            columns_class = self.COLUMNS.get(metric_class)
+            if columns_class is not None:
+                columns = bucket.columns.get(metric_class)
+                if columns is None:
+                    columns = bucket.columns[metric_class] = columns_class()
+                row = columns.rows.get(context_id)
+                if row is None:
+                    self.hold_context(context_id)
+                    row = columns.add(context_id)
+                columns.sample(row, values, sample_rate, cur_time)
+            else:
+                metric_by_context = bucket.metrics
+                if context_id not in metric_by_context:
+                    self.hold_context(context_id)
+                    name, tags, hostname = self.context_registry.get(context_id)
+                    metric_by_context[context_id] = \
+                        metric_class(self.formatter, name, tags or None,
+                                     hostname, self.metric_config.get(metric_class))
+
+                metric_by_context[context_id].sample_many(values, sample_rate, timestamp)
+            if buckets is None:
+                self.metric_count += len(values)
+
+    def hold_context(self, context_id):
+        """ References a context stored in a bucket or tracked as a counter """
+        self.context_registry.acquire_id(context_id)
+        if self.context_limiter is not None:
+            self.context_limiter.hold(context_id, self.context_registry.get(context_id)[0])
+
+    def release_context(self, context_id):
+        self.release_context_id(context_id)
+        if self.context_limiter is not None:
+            self.context_limiter.release(context_id)
+
+    def track_counter_context(self, context_id, last_sample_time):
+        # Counters contexts outlive their buckets until they expire
+        if context_id not in self.last_sample_time_by_context:
+            self.hold_context(context_id)
+            self.counter_expiry.push(context_id, last_sample_time)
+        self.last_sample_time_by_context[context_id] = last_sample_time
+
+    def forget_counter_context(self, context_id):
+        if context_id in self.last_sample_time_by_context:
+            del self.last_sample_time_by_context[context_id]
+            self.release_context(context_id)
+
+    def expire_counters(self, expiry_timestamp):
+        for context_id in self.counter_expiry.pop_expired(expiry_timestamp, self.last_sample_time_by_context.get):
+            log.debug("%s hasn't been submitted in %ss. Expiring.",
+                      self.context_registry.get(context_id), self.expiry_seconds)
+            self.forget_counter_context(context_id)
+
+    def zero_fill_counters(self, flushed_buckets, sampled_buckets, metrics):
+        """
+        Even if no data is submitted, Counters keep reporting "0" for
+        expiry_seconds. The other Metrics (Set, Gauge, Histogram) do not report
+        if no data is submitted.
+
+        The tracked counters get a 0 for each of the `flushed_buckets` they
+        weren't sampled in, `sampled_buckets` holding the buckets of the ones
+        sampled in this flush. A counter only reports from the bucket it started
+        being tracked in. Each counter gets a single series of all its zeros:
+        the cost is a walk over the tracked counters per flush, not a series per
+        counter and bucket. Expired counters are expected to be forgotten
+        already, see `expire_counters`.
+        """
+        formatter = self.formatter
+        get_context = self.context_registry.get
+        zeros = [(timestamp, 0.0) for timestamp in flushed_buckets]
+        for context_id in self.last_sample_time_by_context:
+            sampled, newly_tracked = sampled_buckets.get(context_id, (None, False))
+            if sampled is None:
+                points = list(zeros)
             else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2])
-                metrics += metric.flush(flush_timestamp, self.interval)
+                first = sampled[0]
+                points = [point for point in zeros
+                          if point[0] not in sampled and (not newly_tracked or point[0] > first)]
+                if not points:
+                    continue
+
+            # This counts on the ordering of the context created in submit_metric not changing
+            name, tags, hostname = get_context(context_id)
+            serie = formatter(
+                metric=name,
+                value=0.0,
+                timestamp=points[0][0],
+                tags=tags or None,
+                hostname=hostname,
+                metric_type=MetricTypes.RATE,
+                interval=self.interval,
+            )
+            serie['points'] = points
+            metrics.append(serie)
 
     def flush(self):
         cur_time = time()
@@ -508,35 +927,67 @@ class MetricsBucketAggregator(Aggregator):
 
         metrics = []
 
-        if self.metric_by_bucket:
+        # The closed buckets are detached while ingestion goes on, copying and
+        # popping being atomic, and drained once it's done with them. The
+        # counts are snapshotted then too.
+        buckets = [(ts, self.metric_by_bucket.pop(ts))
+                   for ts in sorted(ts for ts in list(self.metric_by_bucket) if ts < flush_cutoff_time)]
+        self.wait_for_ingestion()
+        packet_count = self.packet_count
+        metric_count = self.metric_count
+        buckets += [(ts, self.reporter_buckets.pop(ts))
+                    for ts in sorted(ts for ts in self.reporter_buckets if ts < flush_cutoff_time)]
+
+        if buckets:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in list(metric_by_context.items()):
-                        if metric.last_sample_time is None or metric.last_sample_time < expiry_timestamp:
-                            # This should never happen
-                            log.warning("%s hasn't been submitted in %ss. Expiring.", context, self.expiry_seconds)
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
-                        else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
-                            if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
-                    # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
-
-                    del self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.
+            flushed_buckets = sorted(set(ts for ts, _ in buckets))
+            # Counters sampled in the flushed buckets -> (their buckets, whether they weren't tracked yet)
+            sampled_buckets = {}
+            for bucket_start_timestamp, bucket in buckets:
+                for context_id, metric in bucket.metrics.items():
+                    if metric.last_sample_time is None or metric.last_sample_time < expiry_timestamp:
+                        # This should never happen
+                        log.warning("%s hasn't been submitted in %ss. Expiring.",
+                                    self.context_registry.get(context_id), self.expiry_seconds)
+                        self.forget_counter_context(context_id)
+                    elif isinstance(metric, Distribution):
+                        self.sketches += metric.flush(bucket_start_timestamp, self.interval)
+                    elif self.states is not None and isinstance(metric, (Histogram, Set)):
+                        self.states.append((bucket_start_timestamp, metric))
+                    else:
+                        metrics += metric.flush(bucket_start_timestamp, self.interval)
+                for metric_class, columns in bucket.columns.items():
+                    if self.states is not None and metric_class is BucketGauge:
+                        self.states += [(bucket_start_timestamp, gauge)
+                                        for gauge in columns.to_metrics(self.formatter, self.context_registry.get)]
+                    else:
+                        metrics += columns.flush(self.formatter, self.context_registry.get,
+                                                 bucket_start_timestamp, self.interval)
+
+                counters = bucket.columns.get(Counter)
+                if counters is not None:
+                    for context_id, last_sample_time in zip(counters.context_ids, counters.last_sample_times):
+                        entry = sampled_buckets.get(context_id)
+                        if entry is None:
+                            entry = sampled_buckets[context_id] = \
+                                ([], context_id not in self.last_sample_time_by_context)
+                        entry[0].append(bucket_start_timestamp)
+                        self.track_counter_context(context_id, last_sample_time)
+
+                for context_id in bucket.context_ids():
+                    self.release_context(context_id)
+
+            # We need to account for the counters that have not expired and were not flushed in these buckets
+            if flushed_buckets:
+                self.expire_counters(expiry_timestamp)
+                self.zero_fill_counters(flushed_buckets, sampled_buckets, metrics)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.expire_counters(expiry_timestamp)
+                self.zero_fill_counters([flush_cutoff_time - self.interval], {}, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
@@ -544,16 +995,32 @@ class MetricsBucketAggregator(Aggregator):
             self.num_discarded_old_points = 0
 
         # Save some stats.
-        log.debug("received %s payloads since last flush", self.metric_count)
-        self.stats.set_stat('metrics', self.metric_count)
-        self.stats.inc_stat('metrics_total', self.metric_count)
-        self.stats.set_stat('packets', self.packet_count)
-        self.stats.inc_stat('packets_total', self.packet_count)
+        metrics_received = metric_count - self.flushed_metric_count
+        packets_received = packet_count - self.flushed_packet_count
+        self.flushed_metric_count = metric_count
+        self.flushed_packet_count = packet_count
+        log.debug("received %s payloads since last flush", metrics_received)
+        self.stats.set_stat('metrics', metrics_received)
+        self.stats.inc_stat('metrics_total', metrics_received)
+        self.stats.set_stat('packets', packets_received)
+        self.stats.inc_stat('packets_total', packets_received)
+        self.save_registry_stats()
+        if self.context_cache is not None:
+            hits, misses, evictions = self.context_cache.reset_counters()
+            self.stats.set_stat('context_cache_hits', hits)
+            self.stats.set_stat('context_cache_misses', misses)
+            self.stats.set_stat('context_cache_evictions', evictions)
+            self.stats.set_stat('context_cache_size', len(self.context_cache))
+        if self.context_limiter is not None:
+            folded, dropped, offenders = self.context_limiter.reset_counters()
+            self.stats.set_stat('context_limit_contexts', len(self.context_limiter))
+            self.stats.set_stat('context_limit_folded', folded)
+            self.stats.set_stat('context_limit_dropped', dropped)
+            self.stats.set_info('context_limit_offenders', [
+                [name.decode('utf-8', errors='replace') if isinstance(name, bytes) else name, refused, contexts]
+                for name, refused, contexts in offenders
+            ])
 
-        self.metric_count = 0
-        self.packet_count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -565,13 +1032,16 @@ class MetricsAggregator(Aggregator):
     This is the default aggregator used by the agent collector.
 
     Metric types supported by this aggregator: Gauge, Count, MonotonicCount,
-                                               Counter, Histogram, Set, Rate
+                                               Counter, Histogram, Set, Rate,
+                                               Distribution
     """
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
                  formatter=None, recent_point_threshold=None,
                  histogram_aggregates=None, histogram_percentiles=None,
-                 utf8_decoding=False):
+                 utf8_decoding=False, tag_registry=None, histogram_backend=None,
+                 histogram_reservoir_size=None, set_backend=None, set_hll_precision=None,
+                 set_hll_threshold=None, set_hll_metric_prefixes=None, context_registry=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -580,12 +1050,27 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            tag_registry,
+            histogram_backend,
+            histogram_reservoir_size,
+            set_backend,
+            set_hll_precision,
+            set_hll_threshold,
+            set_hll_metric_prefixes,
+            context_registry
         )
         self.sources = defaultdict(set)
+        # Sources of each context, usually one, to forget it when it expires
+        self.context_sources = {}
         self.service_check_sources = defaultdict(int)  # Track service check counts by source
         self.event_sources = defaultdict(int)  # Track event counts by source
         self.metrics = {}
+        # Contexts sampled since the last flush, and counters, which report
+        # until they expire: the only ones with something to flush
+        self.sampled_contexts = {}
+        self.counter_contexts = {}
+        self.expiry_queue = ExpiryQueue()
         self.metric_type_to_class = MetricResolver()
 
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
@@ -602,26 +1087,44 @@ class MetricsAggregator(Aggregator):
         if tags is None:
             context = (name, tuple(), hostname)
         else:
-            tags = tuple(self.deduplicate_tags(tags))
+            tags = self.intern_tags(tags)
             context = (name, tags, hostname)
 
-        if context not in self.metrics:
+        context_id = self.context_registry.get_id(context)
+        if context_id is None or context_id not in self.metrics:
+            context_id = self.context_registry.acquire(context)
+            if tags:
+                tags = self.context_registry.get(context_id)[1]
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = \
+            self.metrics[context_id] = \
                 metric_class(self.formatter, name, tags,
                              hostname, self.metric_config.get(metric_class))
+            if metric_class is Counter:
+                self.counter_contexts[context_id] = None
+            # Queued to come up at the next flush, as it's yet to be sampled
+            self.expiry_queue.push(context_id, 0)
 
-        if context not in self.sources[source]:
-            self.sources[source].add(context)
+        contexts = self.sources[source]
+        if context_id not in contexts:
+            contexts.add(context_id)
+            self.context_sources.setdefault(context_id, []).append(source)
 
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
             log.debug("Discarding %s - ts = %s , current ts = %s ", name, timestamp, cur_time)
             self.num_discarded_old_points += 1
         else:
-            self.metrics[context].sample(value, sample_rate, timestamp)
+            self.metrics[context_id].sample(value, sample_rate, timestamp)
+            self.sampled_contexts[context_id] = None
             self.metric_count += 1
 
+    def last_sample_time(self, context_id):
+        """ Last sample time of a context, 0 if it wasn't sampled, None if it's unknown """
+        metric = self.metrics.get(context_id)
+        if metric is None:
+            return None
+        return metric.last_sample_time or 0
+
     def gauge(self, name, value, tags=None, hostname=None, timestamp=None, source=None):
         self.submit_metric(name, value, 'g', tags, hostname, timestamp, source)
 
@@ -647,17 +1150,34 @@ class MetricsAggregator(Aggregator):
     def set(self, name, value, tags=None, hostname=None, source=None):
         self.submit_metric(name, value, 's', tags, hostname, source)
 
+    def distribution(self, name, value, tags=None, hostname=None, source=None):
+        self.submit_metric(name, value, 'd', tags, hostname, source=source)
+
     def flush(self):
         timestamp = time()
         expiry_timestamp = timestamp - self.expiry_seconds
 
-        # Flush points and remove expired metrics. We mutate this dictionary
-        # while iterating so don't use an iterator.
+        # Remove the metrics due to expire, then flush the points of the
+        # contexts sampled since the last flush and of the counters
+        for context_id in self.expiry_queue.pop_expired(expiry_timestamp, self.last_sample_time):
+            log.debug("%s hasn't been submitted in %ss. Expiring.",
+                      self.context_registry.get(context_id), self.expiry_seconds)
+            del self.metrics[context_id]
+            self.sampled_contexts.pop(context_id, None)
+            self.counter_contexts.pop(context_id, None)
+            # A context submitted again gets a new ID
+            for source in self.context_sources.pop(context_id, ()):
+                self.sources[source].discard(context_id)
+            self.release_context_id(context_id)
+
+        sampled_contexts = self.sampled_contexts
+        self.sampled_contexts = {}
+        idle_counters = [c for c in self.counter_contexts if c not in sampled_contexts]
         metrics = []
-        for context, metric in list(self.metrics.items()):
-            if metric.last_sample_time is None or metric.last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring.", context, self.expiry_seconds)
-                del self.metrics[context]
+        for context_id in chain(sampled_contexts, idle_counters):
+            metric = self.metrics[context_id]
+            if isinstance(metric, Distribution):
+                self.sketches += metric.flush(timestamp, self.interval)
             else:
                 metrics += metric.flush(timestamp, self.interval)
 
@@ -684,6 +1204,7 @@ class MetricsAggregator(Aggregator):
         # Save some stats.
         self.stats.set_info('sources', stats_by_source)
         self.stats.set_stat('metrics', self.metric_count)
+        self.save_registry_stats()
         self.stats.inc_stat('metrics_total', self.metric_count)
 
         log.info("Received %s metric since last flush", self.metric_count)
@@ -0,0 +1,54 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from collections import OrderedDict
+
+
+class ContextCache(object):
+    """
+    Bounded LRU cache mapping dogstatsd metric headers to what they resolve
+    to, so that repeated headers skip tag sorting, deduplication and magic
+    tags extraction. `on_evict` is called with the entries evicted or
+    replaced.
+    """
+
+    def __init__(self, size, on_evict=None):
+        self.size = int(size)
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key, entry):
+        previous = self._entries.get(key)
+        self._entries[key] = entry
+        if previous is not None:
+            if self.on_evict is not None:
+                self.on_evict(previous)
+        elif len(self._entries) > self.size:
+            _, evicted = self._entries.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+    def reset_counters(self):
+        """ Returns and resets the hits, misses and evictions counters """
+        counters = self.hits, self.misses, self.evictions
+        self.hits = self.misses = self.evictions = 0
+        return counters
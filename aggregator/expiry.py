@@ -0,0 +1,51 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from heapq import heappop, heappush
+
+
+class ExpiryQueue(object):
+    """
+    Min-heap of context IDs by last sample time, so that expiring contexts
+    only touches the ones due to expire rather than every context.
+
+    Contexts are queued once, when they start being tracked: sampling them
+    never touches the heap. When a queued context comes up, its actual last
+    sample time is checked, and a context sampled since it was queued is
+    queued back at that time. Expiry is amortized O(expired).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._queued = set()
+
+    def __len__(self):
+        return len(self._queued)
+
+    def push(self, context_id, last_sample_time):
+        if context_id not in self._queued:
+            self._queued.add(context_id)
+            heappush(self._heap, (last_sample_time, context_id))
+
+    def pop_expired(self, expiry_timestamp, get_last_sample_time):
+        """
+        Returns the IDs of the contexts last sampled before `expiry_timestamp`.
+        `get_last_sample_time` returns the last sample time of a context, or
+        None if it's not tracked anymore.
+        """
+        heap = self._heap
+        expired = []
+        while heap and heap[0][0] < expiry_timestamp:
+            _, context_id = heappop(heap)
+            last_sample_time = get_last_sample_time(context_id)
+            if last_sample_time is None:
+                self._queued.discard(context_id)
+            elif last_sample_time < expiry_timestamp:
+                self._queued.discard(context_id)
+                expired.append(context_id)
+            else:
+                heappush(heap, (last_sample_time, context_id))
+        return expired
@@ -18,6 +18,8 @@ def get_formatter(config):
             metric_prefix = config['dogstatsd']['metric_namespace']
             if metric_prefix[-1] != '.':
                 metric_prefix += '.'
+            if isinstance(metric, bytes):
+                metric_prefix = metric_prefix.encode('utf-8')
 
             return api_formatter(metric_prefix + metric, value, timestamp, tags,
                                  hostname, metric_type, interval)
@@ -0,0 +1,85 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from hashlib import blake2b
+from math import log
+
+
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+class HyperLogLog(object):
+    """
+    Cardinality estimator of fixed memory (HyperLogLog): the values are
+    hashed on 64 bits, the first `precision` bits selecting one of the
+    `2 ** precision` one-byte registers, which keeps the highest rank of
+    the first set bit seen in the rest of the hashes.
+
+    The standard error of the estimate is about `1.04 / sqrt(2 ** precision)`,
+    0.8% with the default precision, for 16KB of registers.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError('HyperLogLog precision must be between {} and {}'.format(
+                MIN_PRECISION, MAX_PRECISION))
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
+
+    @staticmethod
+    def _hash(value):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        return int.from_bytes(blake2b(value, digest_size=8).digest(), 'big')
+
+    def add(self, value):
+        h = self._hash(value)
+        index = h >> self._shift
+        rank = self._shift - (h & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        registers = self.registers
+        shift = self._shift
+        mask = self._mask
+        hash_ = self._hash
+        for value in values:
+            h = hash_(value)
+            index = h >> shift
+            rank = shift - (h & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        """ Adds the values counted by an estimator of the same precision """
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge HyperLogLogs of different precisions')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        m = self.size
+        if m == 16:
+            alpha = 0.673
+        elif m == 32:
+            alpha = 0.697
+        elif m == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / m)
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        # Small range correction: linear counting of the empty registers
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = m * log(m / float(zeros))
+        return int(round(estimate))
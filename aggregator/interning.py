@@ -0,0 +1,228 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from itertools import count
+from sys import getsizeof
+from threading import Lock
+
+
+class TagRegistry(object):
+    """
+    Interns tags and sorted tag-sets, so that contexts sharing tags share the
+    same strings and tuples.
+
+    Tag-sets are reference counted by the contexts using them: aggregators
+    `acquire` the tags of a context when they start tracking it and `release`
+    them when the context expires. Tag-sets and tags no context refers to
+    anymore are evicted. Interned tags and tag-sets get an integer ID that is
+    never reused.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # tag -> [tag, id, refs], refs being the number of tag-sets using it
+        self._tags = {}
+        # tags -> [tags, id, refs, size]
+        self._tag_sets = {}
+        self._tag_ids = count()
+        self._tag_set_ids = count()
+        # Memory taken by the interned tags and tuples, and what the contexts
+        # would take with a copy each
+        self._interned_bytes = 0
+        self._referenced_bytes = 0
+
+    def get(self, tags):
+        """ Returns the interned tuple equal to `tags`, or `tags` """
+        entry = self._tag_sets.get(tags)
+        return tags if entry is None else entry[0]
+
+    def get_id(self, tags):
+        """ Returns the ID of an interned tag-set, or None """
+        entry = self._tag_sets.get(tags)
+        return None if entry is None else entry[1]
+
+    def get_tag_id(self, tag):
+        """ Returns the ID of an interned tag, or None """
+        entry = self._tags.get(tag)
+        return None if entry is None else entry[1]
+
+    def acquire(self, tags):
+        """
+        Takes a reference on the tag-set `tags`, a sorted tuple, interning it
+        if needed. Returns the interned tuple.
+        """
+        with self._lock:
+            entry = self._tag_sets.get(tags)
+            if entry is None:
+                entry = self._intern(tags)
+            entry[2] += 1
+            self._referenced_bytes += entry[3]
+            return entry[0]
+
+    def release(self, tags):
+        """ Drops a reference on an interned tag-set """
+        with self._lock:
+            entry = self._tag_sets.get(tags)
+            if entry is None:
+                return
+            entry[2] -= 1
+            self._referenced_bytes -= entry[3]
+            if entry[2] <= 0:
+                self._evict(entry[0])
+
+    def _intern(self, tags):
+        interned = []
+        for tag in tags:
+            tag_entry = self._tags.get(tag)
+            if tag_entry is None:
+                tag_entry = self._tags[tag] = [tag, next(self._tag_ids), 0]
+                self._interned_bytes += getsizeof(tag)
+            tag_entry[2] += 1
+            interned.append(tag_entry[0])
+
+        # Keep the tuple we were given when it only holds interned tags
+        if any(a is not b for a, b in zip(interned, tags)):
+            tags = tuple(interned)
+
+        size = getsizeof(tags) + sum(getsizeof(tag) for tag in tags)
+        entry = self._tag_sets[tags] = [tags, next(self._tag_set_ids), 0, size]
+        self._interned_bytes += getsizeof(tags)
+        return entry
+
+    def _evict(self, tags):
+        del self._tag_sets[tags]
+        self._interned_bytes -= getsizeof(tags)
+        for tag in tags:
+            tag_entry = self._tags[tag]
+            tag_entry[2] -= 1
+            if tag_entry[2] <= 0:
+                del self._tags[tag]
+                self._interned_bytes -= getsizeof(tag)
+
+    def tag_count(self):
+        return len(self._tags)
+
+    def tag_set_count(self):
+        return len(self._tag_sets)
+
+    def bytes_saved(self):
+        """ Memory saved by interning, compared to a copy of the tags per context """
+        with self._lock:
+            return max(self._referenced_bytes - self._interned_bytes, 0)
+
+
+class ContextRegistry(object):
+    """
+    Assigns an integer ID to each metric context, `(name, tags, hostname)`,
+    so that the aggregators key their maps on small ints rather than hashing
+    the context tuple in each of them.
+
+    Contexts are reference counted like tag-sets: aggregators `acquire` a
+    context for each map tracking it and `release` it when it's flushed or
+    expires. The tags of the registered contexts are interned in the tag
+    registry. Context IDs are never reused.
+    """
+
+    def __init__(self, tag_registry=None):
+        self._lock = Lock()
+        self.tag_registry = tag_registry or get_tag_registry()
+        # context -> id
+        self._ids = {}
+        # id -> [context, refs]
+        self._contexts = {}
+        self._context_ids = count()
+        # Totals since the registry was created
+        self.lookups = 0
+        self.created = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._contexts)
+
+    def get_id(self, context):
+        """ Returns the ID of a registered context, or None """
+        self.lookups += 1
+        return self._ids.get(context)
+
+    def get(self, context_id):
+        """ Returns the context of a registered ID, its tags interned """
+        return self._contexts[context_id][0]
+
+    def acquire(self, context):
+        """ Takes a reference on `context`, registering it if needed. Returns its ID. """
+        with self._lock:
+            self.lookups += 1
+            context_id = self._ids.get(context)
+            if context_id is None:
+                name, tags, hostname = context
+                if tags:
+                    context = (name, self.tag_registry.acquire(tags), hostname)
+                context_id = next(self._context_ids)
+                self._ids[context] = context_id
+                self._contexts[context_id] = [context, 0]
+                self.created += 1
+            self._contexts[context_id][1] += 1
+            return context_id
+
+    def acquire_id(self, context_id):
+        """ Takes another reference on a registered context """
+        with self._lock:
+            self._contexts[context_id][1] += 1
+
+    def release(self, context_id):
+        """ Drops a reference on a registered context. Returns the context if it got evicted, else None. """
+        with self._lock:
+            entry = self._contexts.get(context_id)
+            if entry is None:
+                return None
+            entry[1] -= 1
+            if entry[1] > 0:
+                return None
+            context = entry[0]
+            del self._contexts[context_id]
+            del self._ids[context]
+            if context[1]:
+                self.tag_registry.release(context[1])
+            self.evicted += 1
+            return context
+
+
+# -------------------------------------------------------------------
+# Lazy initialization for shared singleton instance
+# -------------------------------------------------------------------
+_tag_registry = None
+_context_registry = None
+
+
+def get_tag_registry():
+    """
+    Return the TagRegistry shared by all the aggregators of the process.
+    """
+    global _tag_registry
+    if _tag_registry is None:
+        _tag_registry = TagRegistry()
+    return _tag_registry
+
+
+def get_context_registry():
+    """
+    Return the ContextRegistry shared by all the aggregators of the process.
+    """
+    global _context_registry
+    if _context_registry is None:
+        _context_registry = ContextRegistry()
+    return _context_registry
+
+
+def reset_registries():
+    """
+    Replaces the registries shared by the aggregators of the process with
+    empty ones. For child processes, which must not use those inherited from
+    their parent, with the locks of its threads.
+    """
+    global _tag_registry, _context_registry
+    _tag_registry = TagRegistry()
+    _context_registry = ContextRegistry(_tag_registry)
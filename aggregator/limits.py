@@ -0,0 +1,116 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from collections import defaultdict
+from heapq import nlargest
+from threading import Lock
+
+# Tag of the contexts the samples over the limits are folded into
+OVERFLOW_TAG = 'dd.overflow:true'
+OVERFLOW_TAG_BYTES = b'dd.overflow:true'
+OVERFLOW_TAGS = frozenset([(OVERFLOW_TAG,), (OVERFLOW_TAG_BYTES,)])
+
+# Number of metrics reported as top offenders
+TOP_OFFENDERS = 10
+
+
+class ContextLimiter(object):
+    """
+    Caps the contexts held by an aggregator, per metric name and in total, so
+    that a client tagging a metric with unbounded values (request IDs...)
+    can't make it allocate a context per value. A limit of 0 disables it.
+
+    The aggregator holds and releases the contexts it stores, the limiter
+    counting them by metric name, and asks it to admit a context before
+    storing it. Overflow contexts only count towards the total limit. The
+    samples refused are counted by metric name until `reset_counters`.
+    Contexts are held by ingestion and released by flush, hence the lock.
+    """
+
+    def __init__(self, max_contexts_per_metric=0, max_total_contexts=0):
+        self.max_contexts_per_metric = max_contexts_per_metric or 0
+        self.max_total_contexts = max_total_contexts or 0
+        self._lock = Lock()
+        # Held contexts: context ID -> [name, references]
+        self._held = {}
+        self._contexts_by_metric = defaultdict(int)
+        # Samples refused by metric name: folded into the overflow context, or
+        # dropped when even the overflow context didn't fit
+        self._folded = defaultdict(int)
+        self._dropped = defaultdict(int)
+
+    def __contains__(self, context_id):
+        return context_id in self._held
+
+    def __len__(self):
+        return len(self._held)
+
+    def admit(self, name, overflow=False):
+        """ Whether a new context of the metric `name` fits in the limits """
+        if self.max_total_contexts and len(self._held) >= self.max_total_contexts:
+            return False
+        if not overflow and self.max_contexts_per_metric and \
+                self._contexts_by_metric.get(name, 0) >= self.max_contexts_per_metric:
+            return False
+        return True
+
+    def hold(self, context_id, name):
+        with self._lock:
+            entry = self._held.get(context_id)
+            if entry is None:
+                self._held[context_id] = [name, 1]
+                self._contexts_by_metric[name] += 1
+            else:
+                entry[1] += 1
+
+    def release(self, context_id):
+        with self._lock:
+            entry = self._held[context_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._held[context_id]
+                name = entry[0]
+                self._contexts_by_metric[name] -= 1
+                if not self._contexts_by_metric[name]:
+                    del self._contexts_by_metric[name]
+
+    def fold(self, name, count=1):
+        with self._lock:
+            self._folded[name] += count
+
+    def drop(self, name, count=1):
+        with self._lock:
+            self._dropped[name] += count
+
+    def reset_counters(self):
+        """
+        Returns the samples folded and dropped since the last reset, and the
+        top offenders: (name, samples refused, contexts held) of the metrics
+        with the most samples refused.
+        """
+        with self._lock:
+            folded, dropped = self._folded, self._dropped
+            self._folded = defaultdict(int)
+            self._dropped = defaultdict(int)
+            contexts_by_metric = dict(self._contexts_by_metric)
+
+        refused = defaultdict(int, folded)
+        for name, count in dropped.items():
+            refused[name] += count
+        offenders = [(name, count, contexts_by_metric.get(name, 0))
+                     for name, count in nlargest(TOP_OFFENDERS, refused.items(), key=lambda item: item[1])]
+        return sum(folded.values()), sum(dropped.values()), offenders
+
+
+def merge_offenders(offender_lists):
+    """ Merges the top offenders reported by several limiters, see `ContextLimiter.reset_counters` """
+    merged = {}
+    for offenders in offender_lists:
+        for name, refused, contexts in offenders:
+            current = merged.get(name)
+            merged[name] = (refused, contexts) if current is None else (current[0] + refused, current[1] + contexts)
+    return [(name, refused, contexts)
+            for name, (refused, contexts) in nlargest(TOP_OFFENDERS, merged.items(), key=lambda item: item[1][0])]
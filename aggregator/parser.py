@@ -0,0 +1,198 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# Separators and metadata markers, for str and bytes packets. Indexing bytes
+# gives an int, hence the markers as ordinals.
+STR_TOKENS = (':', '|', ',', '@', '#', '.', 'T')
+BYTES_TOKENS = (b':', b'|', b',', ord('@'), ord('#'), b'.', ord('T'))
+
+# Markers of the metadata fields following the metric type
+STR_MARKERS = ('@', '#', 'T')
+BYTES_MARKERS = (b'@', b'#', b'T')
+
+# Metric types are returned as str whatever the packet type
+BYTES_METRIC_TYPES = dict((t.encode('ascii'), t) for t in ('c', 'g', 'h', 'ms', 's', 'd'))
+
+
+def _split_datums(data, colon, bar, markers):
+    """
+    Splits the colon separated datums packed in a packet. Colons before the
+    first `|` of a datum separate its packed values. In the tags field, a
+    colon starts a new datum only when the token following it has a `|`
+    followed by a metric type, otherwise it's part of a tag
+    (`#tag1:one,tag2:two|T1656581400`) and the tokens are joined back.
+    Anywhere else, a colon starts a new datum.
+    """
+    tags_marker = markers[1]
+    datums = []
+    datum = None
+    in_metadata = in_tags = False
+    for token in data.split(colon):
+        bar_index = token.find(bar)
+        if datum is None:
+            datum = token
+        elif in_metadata and (not in_tags or bar_index != -1 and not token.startswith(markers, bar_index + 1)):
+            datums.append(datum)
+            datum = token
+            in_metadata = False
+        else:
+            datum += colon + token
+        if bar_index != -1:
+            in_metadata = True
+            in_tags = token.startswith(tags_marker, token.rfind(bar) + 1)
+    datums.append(datum)
+
+    return datums
+
+
+def _parse_float(name, raw_value):
+    try:
+        return float(raw_value)
+    except ValueError:
+        # Otherwise, raise an error saying it must be a number
+        raise Exception('Metric value must be a number: {}, {}'.format(name, raw_value))
+
+
+def parse_metric_value(name, raw_value):
+    # Try to cast as an int first to avoid precision issues, then as a
+    # float.
+    try:
+        return int(raw_value)
+    except ValueError:
+        return _parse_float(name, raw_value)
+
+
+def parse_metric_values(name, raw_values, metric_type, allow_strings=('s',)):
+    """
+    Parses the colon separated values packed in a datum (`<name>:1:2:3|h`).
+    Packed values usually are of the same kind: they are all cast as ints, or
+    as floats, before falling back to casting them one by one.
+    """
+    colon, dot = (b':', b'.') if isinstance(raw_values, bytes) else (':', '.')
+    if metric_type in allow_strings:
+        return raw_values.split(colon)
+
+    # Values with a dot can't be ints, skip the failed cast
+    if colon not in raw_values:
+        if dot in raw_values:
+            return [_parse_float(name, raw_values)]
+        return [parse_metric_value(name, raw_values)]
+
+    values = raw_values.split(colon)
+    if dot not in raw_values:
+        try:
+            return [int(value) for value in values]
+        except ValueError:
+            pass
+    try:
+        return [float(value) for value in values]
+    except ValueError:
+        return [parse_metric_value(name, value) for value in values]
+
+
+def split_metric_header(packet):
+    """
+    Splits a single datum metric packet into its header, everything but the
+    values (`<name>:|<metric_type>|...`), and its raw values. Returns None
+    for packets packing several datums, carrying a timestamp or that can't be
+    split.
+    """
+    is_bytes = isinstance(packet, bytes)
+    colon, bar = BYTES_TOKENS[:2] if is_bytes else STR_TOKENS[:2]
+
+    value_start = packet.find(colon) + 1
+    if not value_start:
+        return None
+    value_end = packet.find(bar, value_start)
+    if value_end == -1 or packet.find(colon, value_end, packet.rfind(bar)) != -1:
+        return None
+    # Timestamps are unique to a packet, they would only churn the cache
+    if packet.find(bar + (b'T' if is_bytes else 'T'), value_end) != -1:
+        return None
+
+    return packet[:value_start] + packet[value_end:], packet[value_start:value_end]
+
+
+def parse_metric_packet(packet, allow_strings=('s',), ignore_types=()):
+    """
+    Single pass parser for a dogstatsd metric packet:
+    <name>:<value>:<value>...|<metric_type>|@<sample_rate>|#<tag1_name>:<tag1_value>,<tag2_name>:<tag2_value>|T<timestamp>:<value>|<metric_type>...
+
+    Each field is cut out of the packet once, with no split and re-join of the
+    tags unless several datums are packed. `packet` is either str or bytes,
+    bytes packets are never decoded: names, string values and tags are
+    returned as bytes. Returns a list of (name, values, metric_type, tags,
+    sample_rate, timestamp), `values` being the list of the values packed in
+    the datum and `timestamp` the unix timestamp set by the client, or None.
+    """
+    is_bytes = isinstance(packet, bytes)
+    colon, bar, comma, rate_marker, tags_marker, dot, ts_marker = BYTES_TOKENS if is_bytes else STR_TOKENS
+
+    name, sep, data = packet.partition(colon)
+    if not sep:
+        raise Exception('Unparseable metric packet: {}'.format(packet))
+
+    # Colons before the first `|` separate packed values, colons past the
+    # last `|` can only be in tags: most packets hold a single datum and skip
+    # the datum split.
+    if colon in data and data.find(colon, data.find(bar), data.rfind(bar)) != -1:
+        datums = _split_datums(data, colon, bar, BYTES_MARKERS if is_bytes else STR_MARKERS)
+    else:
+        datums = (data,)
+
+    parsed_packets = []
+    for datum in datums:
+        raw_values, sep, metadata = datum.partition(bar)
+        if not sep:
+            raise Exception('Unparseable metric packet: {}'.format(packet))
+        metric_type, sep, metadata = metadata.partition(bar)
+        if is_bytes:
+            metric_type = BYTES_METRIC_TYPES.get(metric_type) or metric_type.decode('utf-8')
+
+        if metric_type and metric_type[0] in ignore_types and metric_type not in allow_strings:
+            continue
+        if colon in raw_values or metric_type in allow_strings:
+            values = parse_metric_values(name, raw_values, metric_type, allow_strings)
+        elif dot in raw_values:
+            # Values with a dot can't be ints, skip the failed cast
+            values = [_parse_float(name, raw_values)]
+        else:
+            try:
+                values = [int(raw_values)]
+            except ValueError:
+                values = [_parse_float(name, raw_values)]
+
+        # Parse the optional values - sample rate, tags & timestamp.
+        sample_rate = 1
+        tags = None
+        timestamp = None
+        if sep:
+            for m in metadata.split(bar):
+                if not m:
+                    log.warning('Incorrect metric metadata: metric_name:%s, metadata:%s',
+                                name, metadata.replace(bar, b' ' if is_bytes else ' '))
+                    break
+
+                marker = m[0]
+                if marker == rate_marker:
+                    sample_rate = float(m[1:])
+                    # in case it's in a bad state
+                    sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
+                elif marker == tags_marker:
+                    tags = m[1:].split(comma)
+                    tags.sort()
+                    tags = tuple(tags)
+                elif marker == ts_marker:
+                    timestamp = int(m[1:])
+
+        parsed_packets.append((name, values, metric_type, tags, sample_rate, timestamp))
+
+    return parsed_packets
@@ -0,0 +1,196 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+from math import floor, log, log1p
+
+
+# Parameters of the sketches of the Datadog agent, whose keys the intake
+# expects
+DEFAULT_RELATIVE_ACCURACY = 1 / 128.
+DEFAULT_MAX_BINS = 4096
+# Values closer to 0 are counted as 0
+MIN_INDEXABLE_VALUE = 1e-9
+# Keys are 16 bits integers, and bins count at most 16 bits of values: larger
+# counts are sent as several bins of the same key
+MAX_KEY = 2 ** 15 - 1
+MAX_BIN_COUNT = 2 ** 16 - 1
+
+
+class DDSketch(object):
+    """
+    Quantile sketch with a relative accuracy guarantee (DDSketch), mapping
+    values to bins like the agent does: a value `x` is counted in the
+    logarithmic bin of key `round(log_gamma(|x|)) + bias`, `gamma` being
+    `1 + 2 * relative_accuracy` and the bias making the key of the smallest
+    value indexed 1. Any value of a bin is within `relative_accuracy` of the
+    bin's own value.
+
+    Positive and negative values have their own bins, the keys of the
+    negative ones being negated in payloads, and 0 has the key 0. Memory is bounded by
+    `max_bins`: past it, the bins of the values closest to 0 are collapsed
+    into their neighbour, trading their accuracy for the one of the upper
+    quantiles. Sketches with the same parameters merge by adding their bins.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = 1 + 2 * relative_accuracy
+        self._multiplier = 1 / log1p(2 * relative_accuracy)
+        self.bias = 1 - floor(log(MIN_INDEXABLE_VALUE) * self._multiplier)
+        # Values under the one of the bin of key 1 are counted as 0
+        self.min_indexable_value = self.bin_value(1)
+
+        # key -> count
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def bin_value(self, key):
+        """ Value a bin stands for, within the relative accuracy of its values """
+        return self.gamma ** (key - self.bias)
+
+    def key(self, value):
+        """ Key of the bin of a positive value, at least `min_indexable_value` """
+        return max(1, min(round(log(value) * self._multiplier) + self.bias, MAX_KEY))
+
+    def add(self, value, weight=1):
+        self._bin(value, weight)
+        self.count += weight
+        self.sum += value * weight
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def add_many(self, values, weight=1):
+        if not values:
+            return
+        # Inlined binning of the positive values falling in existing bins
+        positive = self.positive
+        multiplier = self._multiplier
+        bias = self.bias
+        min_indexable_value = self.min_indexable_value
+        for value in values:
+            if value >= min_indexable_value:
+                key = round(log(value) * multiplier) + bias
+                if key in positive:
+                    positive[key] += weight
+                    continue
+            self._bin(value, weight)
+
+        self.count += weight * len(values)
+        self.sum += sum(values) * weight
+        self.min = min(self.min, min(values))
+        self.max = max(self.max, max(values))
+
+    def _bin(self, value, weight):
+        if value >= self.min_indexable_value:
+            bins = self.positive
+            key = self.key(value)
+        elif value <= -self.min_indexable_value:
+            bins = self.negative
+            key = self.key(-value)
+        else:
+            self.zero_count += weight
+            return
+
+        if key in bins:
+            bins[key] += weight
+        else:
+            bins[key] = weight
+            if len(self.positive) + len(self.negative) > self.max_bins:
+                self._collapse()
+
+    def merge(self, other):
+        """ Adds the bins of a sketch with the same parameters to this one """
+        if other.gamma != self.gamma:
+            raise ValueError('Cannot merge sketches of different relative accuracies')
+
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in other_bins.items():
+                bins[key] = bins.get(key, 0) + count
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self._collapse()
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _collapse(self):
+        # Collapse the lowest keys, the values closest to 0, of the negative
+        # values first, then of the positive ones.
+        excess = len(self.positive) + len(self.negative) - self.max_bins
+        for bins in (self.negative, self.positive):
+            if excess <= 0 or len(bins) < 2:
+                continue
+            keys = sorted(bins)
+            collapsed = keys[:min(excess, len(keys) - 1)]
+            target = keys[len(collapsed)]
+            for key in collapsed:
+                bins[target] += bins.pop(key)
+            excess -= len(collapsed)
+
+    def quantile(self, q):
+        """ Value at the quantile `q`, between 0 and 1, or None if empty """
+        if not self.count or q < 0 or q > 1:
+            return None
+        # The bounds are exact
+        if q == 0:
+            return self.min
+        if q == 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self.bin_value(key), self.min)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self.bin_value(key), self.max)
+        return self.max
+
+    def to_dict(self, timestamp):
+        """
+        Payload of the sketch, the `Dogsketch` of the agent: its summary
+        (`cnt`, `min`, `max`, `avg`, `sum`) and the keys (`k`) and counts
+        (`n`) of its bins in increasing order of their values.
+        """
+        bins = [(-key, self.negative[key]) for key in sorted(self.negative, reverse=True)]
+        if self.zero_count:
+            bins.append((0, self.zero_count))
+        bins.extend((key, self.positive[key]) for key in sorted(self.positive))
+
+        keys = []
+        counts = []
+        for key, count in bins:
+            while count > 0:
+                keys.append(key)
+                counts.append(min(count, MAX_BIN_COUNT))
+                count -= MAX_BIN_COUNT
+        return {
+            'ts': timestamp,
+            'cnt': self.count,
+            'min': self.min,
+            'max': self.max,
+            'avg': self.sum / float(self.count) if self.count else 0,
+            'sum': self.sum,
+            'k': keys,
+            'n': counts,
+        }
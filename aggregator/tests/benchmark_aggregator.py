@@ -7,7 +7,21 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import random
+import tracemalloc
+from threading import Event, Thread
+from time import perf_counter, sleep, time
+from timeit import repeat
+
+# 3p
+import pytest
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
+from aggregator.formatters import api_formatter
+from aggregator.parser import parse_metric_packet
+from aggregator.types import HAS_NUMPY, ExactSamples, Histogram, _rank
 
 
 class TestAggregatorPerf(object):
@@ -111,6 +125,259 @@ class TestAggregatorPerf(object):
             ma.flush()
 
 
+def legacy_parse_metric_packet(packet, allow_strings=('s',), ignore_types=('d',)):
+    """
+    The split and re-join parser `aggregator.parser.parse_metric_packet`
+    replaced, kept as a baseline.
+    """
+    parsed_packets = []
+    name_and_metadata = packet.split(':', 1)
+    name = name_and_metadata[0]
+    broken_split = name_and_metadata[1].split(':')
+    data = []
+    partial_datum = None
+    for token in broken_split:
+        if partial_datum is None:
+            partial_datum = token
+        elif "|" not in token:
+            partial_datum += ":" + token
+        else:
+            data.append(partial_datum)
+            partial_datum = token
+    data.append(partial_datum)
+
+    for datum in data:
+        value_and_metadata = datum.split('|')
+        raw_value = value_and_metadata[0]
+        metric_type = value_and_metadata[1]
+
+        if metric_type in allow_strings:
+            value = raw_value
+        elif len(metric_type) > 0 and metric_type[0] in ignore_types:
+            continue
+        else:
+            try:
+                value = int(raw_value)
+            except ValueError:
+                value = float(raw_value)
+
+        sample_rate = 1
+        tags = None
+        for m in value_and_metadata[2:]:
+            if m[0] == '@':
+                sample_rate = float(m[1:])
+                sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
+            elif m[0] == '#':
+                tags = tuple(sorted(m[1:].split(',')))
+
+        parsed_packets.append((name, value, metric_type, tags, sample_rate))
+
+    return parsed_packets
+
+
+class TestParserPerf(object):
+
+    LOOPS = 20000
+    REPEAT = 10
+    PACKETS = {
+        'plain': 'page.views:1|c',
+        'tagged': 'page.views:1|c|#env:prod,service:web,version:1.2.3,host:i-0a1b2c3d',
+        'sampled': 'page.load.time:0.25|h|@0.5|#env:prod,service:web',
+        'multi': 'page.load.time:0.25|h|@0.5|#env:prod:0.3|h|#env:prod:12|h',
+        'multi_untagged': 'page.load.time:0.25|h:0.3|h:12|h:7|h',
+    }
+
+    def test_metric_packet_parsing_perf(self):
+        for kind, packet in sorted(self.PACKETS.items()):
+            assert parse_metric_packet(packet) == [
+                (name, [value], mtype, tags, sample_rate, None)
+                for name, value, mtype, tags, sample_rate in legacy_parse_metric_packet(packet)
+            ]
+            legacy = min(repeat(lambda: legacy_parse_metric_packet(packet),
+                                number=self.LOOPS, repeat=self.REPEAT))
+            single_pass = min(repeat(lambda: parse_metric_packet(packet),
+                                     number=self.LOOPS, repeat=self.REPEAT))
+            print('{:<14} legacy: {:.3f}s single pass: {:.3f}s ({:.2f}x)'.format(
+                kind, legacy, single_pass, legacy / single_pass))
+
+    def test_multi_value_submission_perf(self):
+        values = [str(0.1 * i) for i in range(32)]
+        lines = b'\n'.join(
+            'request.latency:{}|ms|#env:prod,service:web'.format(v).encode('utf-8') for v in values
+        )
+        packed = 'request.latency:{}|ms|#env:prod,service:web'.format(':'.join(values)).encode('utf-8')
+
+        ma = MetricsBucketAggregator('my.host')
+        one_per_line = min(repeat(lambda: ma.submit_packets(lines), number=self.LOOPS // 10, repeat=self.REPEAT))
+        ma = MetricsBucketAggregator('my.host')
+        multi_value = min(repeat(lambda: ma.submit_packets(packed), number=self.LOOPS // 10, repeat=self.REPEAT))
+        print('{} values one per line: {:.3f}s packed: {:.3f}s ({:.2f}x)'.format(
+            len(values), one_per_line, multi_value, one_per_line / multi_value))
+
+
+class TestBucketFlushPerf(object):
+
+    CONTEXT_COUNTS = (10000, 50000, 200000)
+    BUCKETS = 10
+    # Share of the counters sampled in each bucket
+    ACTIVE_RATIO = 0.01
+
+    def test_bucket_flush_perf(self):
+        for context_count in self.CONTEXT_COUNTS:
+            ma = MetricsBucketAggregator('my.host', interval=1)
+            names = ['counter.%d' % i for i in range(context_count)]
+            # Every counter is tracked
+            for name in names:
+                ma.submit_metric(name, 1, 'c', timestamp=time() - self.BUCKETS - 10)
+            ma.flush()
+
+            # Then a few are sampled in each bucket
+            now = time()
+            active = names[:int(context_count * self.ACTIVE_RATIO)]
+            for bucket in range(self.BUCKETS):
+                for name in active:
+                    ma.submit_metric(name, 1, 'c', timestamp=now - self.BUCKETS + bucket - 1)
+
+            start = perf_counter()
+            metrics = ma.flush()
+            elapsed = perf_counter() - start
+            assert sum(len(m['points']) for m in metrics) == context_count * self.BUCKETS
+            print('{:>7} counters, {} buckets of {} sampled: flush {:.3f}s, {} series'.format(
+                context_count, self.BUCKETS, len(active), elapsed, len(metrics)))
+
+
+class TestConcurrentFlushPerf(object):
+
+    CONTEXT_COUNTS = (10000, 200000)
+    BATCH = [b'my.counter:1|c|#shard:%d' % (i % 16) for i in range(64)]
+
+    def test_ingest_latency_during_flush(self):
+        for context_count in self.CONTEXT_COUNTS:
+            ma = MetricsBucketAggregator('my.host', interval=1)
+            for i in range(context_count):
+                ma.submit_metric('gauge.%d' % i, 1, 'g', timestamp=time() - 2)
+
+            latencies = []
+            done = Event()
+
+            def ingest():
+                while not done.is_set():
+                    start = perf_counter()
+                    ma.submit_packets_batch(self.BATCH)
+                    latencies.append(perf_counter() - start)
+
+            ingester = Thread(target=ingest)
+            ingester.start()
+            start = perf_counter()
+            metrics = ma.flush()
+            elapsed = perf_counter() - start
+            idle = len(latencies)
+            sleep(elapsed)
+            done.set()
+            ingester.join()
+
+            # Nothing sampled while flushing is lost
+            sleep(1)
+            metrics += ma.flush()
+            assert sum(m['points'][0][1] for m in metrics if m['metric'] == b'my.counter') == \
+                len(latencies) * len(self.BATCH)
+
+            def percentiles(latencies):
+                latencies = sorted(latencies)
+                return '/'.join('{:.1f}'.format(1000 * latencies[int(q * (len(latencies) - 1))])
+                                for q in (0.5, 0.99, 1))
+
+            print('{:>7} contexts: flush {:.3f}s, batch latency p50/p99/max {}ms while flushing ({} batches), '
+                  '{}ms after'.format(context_count, elapsed, percentiles(latencies[:idle]), idle,
+                                      percentiles(latencies[idle:])))
+
+
+class TestExpiryPerf(object):
+
+    CONTEXT_COUNTS = (10000, 100000, 500000)
+    # Share of the contexts sampled between two flushes
+    ACTIVE_RATIO = 0.01
+
+    def test_checks_flush_perf(self):
+        for context_count in self.CONTEXT_COUNTS:
+            ma = MetricsAggregator('my.host')
+            names = ['gauge.%d' % i for i in range(context_count)]
+            for name in names:
+                ma.gauge(name, 1)
+            ma.flush()
+
+            active = names[:int(context_count * self.ACTIVE_RATIO)]
+            for name in active:
+                ma.gauge(name, 2)
+            start = perf_counter()
+            metrics = ma.flush()
+            elapsed = perf_counter() - start
+            assert len(metrics) == len(active) + 1
+            print('{:>7} contexts, {} sampled: flush {:.4f}s'.format(context_count, len(active), elapsed))
+
+
+class ListSamples(list):
+    """
+    The list of boxed floats, sorted at flush, `aggregator.types.ExactSamples`
+    replaced, kept as a baseline.
+    """
+
+    def __init__(self, extra_config=None):
+        super(ListSamples, self).__init__()
+
+    def describe(self, quantiles):
+        self.sort()
+        length = len(self)
+        return length, self[0], self[-1], sum(self), [self[_rank(q, length)] for q in quantiles]
+
+
+class TestHistogramPerf(object):
+
+    SIZES = (10000, 100000, 1000000)
+    REPEAT = 5
+    PERCENTILES = [0.5, 0.75, 0.95, 0.99]
+
+    def fill(self, samples_class, values):
+        histogram = Histogram(api_formatter, 'request.latency', None, 'my.host',
+                              {'percentiles': self.PERCENTILES})
+        histogram.samples_class = samples_class
+        tracemalloc.start()
+        histogram.samples = samples_class()
+        # Values are parsed, as in dogstatsd packets, for every sample to be
+        # its own float object
+        for value in values:
+            histogram.sample(float(value), 1)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return histogram, memory
+
+    def flush_time(self, samples_class, values):
+        best = None
+        for _ in range(self.REPEAT):
+            histogram, _ = self.fill(samples_class, values)
+            start = perf_counter()
+            metrics = histogram.flush(0, 10)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, metrics
+
+    def test_exact_histogram_perf(self):
+        print('exact samples, numpy: {}'.format(HAS_NUMPY))
+        for size in self.SIZES:
+            values = [repr(random.lognormvariate(0, 1)) for _ in range(size)]
+            _, list_memory = self.fill(ListSamples, values)
+            _, array_memory = self.fill(ExactSamples, values)
+            list_flush, list_metrics = self.flush_time(ListSamples, values)
+            array_flush, array_metrics = self.flush_time(ExactSamples, values)
+
+            assert [m['points'][0][1] for m in list_metrics] == \
+                pytest.approx([m['points'][0][1] for m in array_metrics])
+            print('{:>8} samples list: {:>8.0f}KB {:.4f}s array: {:>8.0f}KB {:.4f}s ({:.1f}x less memory, '
+                  '{:.2f}x faster flush)'.format(
+                      size, list_memory / 1024., list_flush, array_memory / 1024., array_flush,
+                      list_memory / float(array_memory), list_flush / array_flush))
+
+
 if __name__ == '__main__':
     t = TestAggregatorPerf()
     # t.test_dogstatsd_aggregation_perf()
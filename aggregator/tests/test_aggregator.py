@@ -8,11 +8,14 @@
 import random
 import time
 
+# 3p
+import pytest
+
 # project
 from aggregator import MetricsAggregator
 from aggregator.aggregator import UNKNOWN_SOURCE
 from aggregator.formatters import get_formatter
-from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES, ReservoirSamples
 
 
 class TestMetricsAggregator():
@@ -315,19 +318,110 @@ class TestMetricsAggregator():
         assert len(metrics) == 1
         assert metrics[0]['metric'] == 'datadog.agent.running'
 
-    def test_ignore_distribution(self):
+    def test_distribution(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.dist:5.0|d')
-        stats.submit_packets('my.other.dist:5.0|dk')
+        stats.distribution('my.dist', 1, tags=['env:prod'])
+        stats.distribution('my.dist', 3, tags=['env:prod'])
         stats.submit_packets('my.gauge:1|g')
 
-        # Assert that it's treated normally, and that the distribution is ignored
+        # Assert that distributions are flushed apart, as sketches
         metrics = stats.flush()
         assert len(metrics) == 2
         m = metrics[0]
         assert m['metric'] == 'my.gauge'
         assert m['points'][0][1] == 1
 
+        sketches = sorted(stats.flush_sketches(), key=lambda m: m['tags'] or ())
+        assert len(sketches) == 2
+        assert [m['metric'] for m in sketches] == ['my.dist', 'my.dist']
+        assert [m['type'] for m in sketches] == ['distribution', 'distribution']
+        assert sketches[0]['tags'] is None
+        assert sketches[0]['points'][0][1].count == 1
+        assert sketches[1]['tags'] == ('env:prod',)
+        assert sketches[1]['points'][0][1].count == 2
+        assert sketches[1]['points'][0][1].quantile(1) == 3
+        assert stats.stats.get_stat('sketches') == 2
+        assert stats.flush_sketches() == []
+
+    def test_flush_sampled_contexts(self):
+        stats = MetricsAggregator('myhost', expiry_seconds=0.5)
+        stats.gauge('my.gauge', 1)
+        stats.increment('my.counter')
+        stats.histogram('my.histogram', 1)
+        assert len(stats.flush()) == 8
+
+        # Only the sampled contexts and the counters are flushed
+        stats.gauge('my.gauge', 2)
+        assert stats.sampled_contexts
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        assert metrics == {'my.gauge': 2, 'my.counter': 0, 'datadog.agent.running': 1}
+        assert not stats.sampled_contexts
+
+        # Then expire
+        time.sleep(0.6)
+        stats.gauge('my.gauge', 3)
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        assert metrics == {'my.gauge': 3, 'datadog.agent.running': 1}
+        assert len(stats.metrics) == 1
+        assert len(stats.expiry_queue) == 1
+        assert not stats.counter_contexts
+
+    def test_expired_context_sources(self):
+        stats = MetricsAggregator('myhost', expiry_seconds=0.1)
+        for _ in range(3):
+            stats.submit_metric('my.gauge', 1, 'g', source='foo')
+            stats.flush()
+            _, info = stats.stats.snapshot()
+            assert info['sources'] == {'foo': 1}
+
+            # Expired contexts are forgotten by their source
+            time.sleep(0.2)
+            stats.flush()
+            assert stats.sources['foo'] == set()
+            assert not stats.context_sources
+
+    def test_context_sources(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_metric('my.gauge', 1, 'g', source='foo')
+        stats.submit_metric('my.gauge', 1, 'g', source='bar')
+        stats.submit_metric('my.gauge', 1, 'g', source='foo')
+        stats.submit_metric('other.gauge', 1, 'g', source='bar')
+        assert sorted(map(sorted, stats.context_sources.values())) == [['bar'], ['bar', 'foo']]
+
+    def test_set_hll(self):
+        stats = MetricsAggregator('myhost', set_hll_threshold=100, set_hll_metric_prefixes=['my.users'])
+        for i in range(1000):
+            stats.submit_packets('my.users:%d|s' % i)
+            stats.submit_packets('my.users.by_endpoint:%d|s|#endpoint:/' % (i % 50))
+            stats.submit_packets('my.ids:%d|s' % i)
+
+        # Only the opted-in sets past the threshold are approximated
+        sets = dict((stats.context_registry.get(context_id)[0], metric)
+                    for context_id, metric in stats.metrics.items())
+        assert sets['my.users'].hll is not None and not sets['my.users'].values
+        assert sets['my.users.by_endpoint'].hll is None
+        assert sets['my.ids'].hll is None
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        assert abs(metrics['my.users'] - 1000) <= 30
+        assert metrics['my.users.by_endpoint'] == 50
+        assert metrics['my.ids'] == 1000
+
+        # The context stays approximated
+        stats.submit_packets('my.users:1|s')
+        assert sets['my.users'].hll is not None
+        assert [m['points'][0][1] for m in stats.flush() if m['metric'] == 'my.users'] == [1]
+
+    def test_set_hll_backend(self):
+        stats = MetricsAggregator('myhost', set_backend='hll', set_hll_threshold=0, set_hll_precision=10)
+        stats.submit_packets('my.set:1|s')
+        stats.submit_packets('my.set:1|s')
+        metric, = stats.metrics.values()
+        assert len(metric.hll.registers) == 1024
+        assert [m['points'][0][1] for m in stats.flush() if m['metric'] == 'my.set'] == [1]
+        assert [m for m in stats.flush() if m['metric'] == 'my.set'] == []
+
     def test_rate(self):
         stats = MetricsAggregator('myhost')
         stats.submit_packets('my.rate:10|_dd-r')
@@ -413,6 +507,58 @@ class TestMetricsAggregator():
         assert len(metrics) == 1
         assert metrics[0]['metric'] == 'datadog.agent.running'
 
+    @pytest.mark.parametrize('backend, size', [('sketch', 2048), ('reservoir', 100)])
+    def test_histogram_backends(self, backend, size):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=DEFAULT_HISTOGRAM_AGGREGATES+['min', 'sum'],
+            histogram_percentiles=[0.5, 0.99],
+            histogram_backend=backend,
+            histogram_reservoir_size=size,
+        )
+        random.seed(42)
+        values = list(range(1, 10001))
+        random.shuffle(values)
+        for i in values:
+            stats.histogram('my.p', i)
+        stats.submit_packets('my.p:1|h|@0.5')
+
+        # Memory doesn't grow with the samples
+        histogram, = stats.metrics.values()
+        samples = histogram.samples
+        assert len(samples.reservoir if backend == 'reservoir' else samples.positive) <= size
+
+        # Same metrics as the exact backend, exact count, min, max, avg and sum
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush()[:-1])
+        assert sorted(metrics) == ['my.p.50percentile', 'my.p.99percentile', 'my.p.avg', 'my.p.count',
+                                   'my.p.max', 'my.p.median', 'my.p.min', 'my.p.sum']
+        assert metrics['my.p.count'] == 10002
+        assert metrics['my.p.min'] == 1
+        assert metrics['my.p.max'] == 10000
+        assert metrics['my.p.sum'] == 50005001
+        self.assert_almost_equal(metrics['my.p.avg'], 5000, 1)
+        # Percentiles are within the backend error bounds
+        tolerance = 0.02 if backend == 'sketch' else 0.15
+        assert metrics['my.p.median'] == metrics['my.p.50percentile']
+        self.assert_almost_equal(metrics['my.p.median'], 5000, 5000 * tolerance)
+        self.assert_almost_equal(metrics['my.p.99percentile'], 9900, 9900 * tolerance)
+
+        # Ensure that histograms are reset.
+        assert len(stats.flush()) == 1
+
+    def test_merge_reservoirs(self):
+        random.seed(42)
+        first, second = ReservoirSamples({'reservoir_size': 1000}), ReservoirSamples({'reservoir_size': 1000})
+        first.extend(range(1, 1001))
+        second.extend(range(1001, 10001))
+        first.merge(second)
+
+        count, min_, max_, sum_, (median,) = first.describe([0.5])
+        assert len(first.reservoir) == 1000
+        assert (count, min_, max_, sum_) == (10000, 1, 10000, 50005000)
+        # the reservoirs are sampled in proportion of the samples they counted
+        self.assert_almost_equal(median, 5000, 5000 * 0.1)
+
     def test_sampled_histogram(self):
         # Submit a sampled histogram.
         # The min is not enabled by default
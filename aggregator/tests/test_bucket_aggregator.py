@@ -6,6 +6,8 @@
 
 # stdlib
 import random
+import sys
+import threading
 import time
 
 # project
@@ -13,7 +15,8 @@ from aggregator import (
     MetricsBucketAggregator,
 )
 
-from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator.interning import TagRegistry
+from aggregator.types import DEFAULT_HISTOGRAM_AGGREGATES, BucketGauge, Counter
 
 
 class TestUnitMetricsBucketAggregator():
@@ -78,6 +81,56 @@ class TestUnitMetricsBucketAggregator():
         assert intc['points'][0][1] == 2
         assert intc['host'] == 'myhost'
 
+    def test_scalar_columns(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        stats.submit_packets(b'my.gauge:1|g|#env:prod\nmy.gauge:2|g|#env:prod\nmy.count:1:2|c|@0.5')
+        stats.submit_packets(b'my.hist:1|h')
+
+        # Gauges and counters are stored in columns, other types as objects
+        bucket, = stats.metric_by_bucket.values()
+        get_context = stats.context_registry.get
+        assert [get_context(i) for i in bucket.metrics] == [(b'my.hist', (), 'myhost')]
+        gauges = bucket.columns[BucketGauge]
+        assert [get_context(i) for i in gauges.context_ids] == [(b'my.gauge', (b'env:prod',), 'myhost')]
+        assert gauges.values == [2]
+        counters = bucket.columns[Counter]
+        assert [get_context(i) for i in counters.context_ids] == [(b'my.count', (), 'myhost')]
+        assert list(counters.values) == [6]
+        assert not hasattr(list(bucket.metrics.values())[0], '__dict__')
+
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m) for m in stats.flush())
+        assert metrics[b'my.gauge']['points'][0][1] == 2
+        assert metrics[b'my.gauge']['tags'] == (b'env:prod',)
+        assert metrics[b'my.count']['points'][0][1] == 6 / self.interval
+        assert metrics[b'my.count']['tags'] is None
+        assert metrics[b'my.count']['type'] == 'rate'
+
+    def test_counter_zero_fill(self):
+        stats = MetricsBucketAggregator('myhost', interval=1)
+        now = int(time.time())
+        stats.submit_metric('my.idle', 1, 'c', timestamp=now - 10)
+        stats.submit_metric('my.busy', 1, 'c', timestamp=now - 10)
+        stats.flush()
+
+        stats.submit_metric('my.busy', 2, 'c', timestamp=now - 4)
+        stats.submit_metric('my.new', 3, 'c', timestamp=now - 3)
+        stats.submit_metric('my.gauge', 1, 'g', timestamp=now - 2)
+        metrics = stats.flush()
+
+        points = {}
+        for m in metrics:
+            points.setdefault(m['metric'], []).extend(m['points'])
+        # Idle counters report a 0 in each flushed bucket, in a single series,
+        # and only from the bucket they started being tracked in
+        assert points == {
+            'my.idle': [(now - 4, 0.0), (now - 3, 0.0), (now - 2, 0.0)],
+            'my.busy': [(now - 4, 2.0), (now - 3, 0.0), (now - 2, 0.0)],
+            'my.new': [(now - 3, 3.0), (now - 2, 0.0)],
+            'my.gauge': [(now - 2, 1)],
+        }
+        assert len([m for m in metrics if m['metric'] == 'my.idle']) == 1
+
     def test_histogram_normalization(self):
         ag_interval = 10
         # The min is not enabled by default
@@ -124,6 +177,78 @@ class TestUnitMetricsBucketAggregator():
         assert third['points'][0][1] == 16
         assert third['host'] == 'myhost'
 
+    def test_bytes_packets(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        stats.submit_packets(b'gauge:4|c|#tag2,tag1\ngauge:8|c|#tag1,tag2')
+        stats.submit_packets(b'gauge:1|c|#tag1,host:otherhost')
+        stats.submit_packets('histé:1|h'.encode('utf-8'))
+        stats.submit_packets(b'_e{6,4}:title1|text|#t1')
+        stats.submit_packets(b'_sc|check|0|#t1')
+
+        self.sleep_for_interval_length()
+        metrics = stats.flush()
+
+        # names, tags and magic hosts are kept as bytes
+        first, second = sorted([m for m in metrics if m['metric'] == b'gauge'], key=lambda m: len(m['tags']))
+        assert first['tags'] == (b'tag1',)
+        assert first['host'] == b'otherhost'
+        assert first['points'][0][1] == 1
+        assert second['tags'] == (b'tag1', b'tag2')
+        assert second['host'] == 'myhost'
+        assert second['points'][0][1] == 12
+        assert 'histé.max'.encode('utf-8') in [m['metric'] for m in metrics]
+
+        # events and service checks are decoded
+        assert stats.flush_events()[0]['msg_title'] == 'title1'
+        assert stats.flush_service_checks()[0]['check'] == 'check'
+
+    def test_multiple_values(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        for _ in range(2):
+            stats.submit_packets('my.hist:1:2:3:4|h|#tag1')
+            stats.submit_packets('my.counter:1:2|c|@0.5')
+            stats.submit_packets('my.gauge:1:2.5|g')
+            stats.submit_packets('my.set:a:b:a|s')
+
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+
+        assert metrics['my.hist.count'] == 8
+        assert metrics['my.hist.max'] == 4
+        assert metrics['my.hist.avg'] == 2.5
+        assert metrics['my.counter'] == 12
+        assert metrics['my.gauge'] == 2.5
+        assert metrics['my.set'] == 2
+        assert stats.stats.get_stat('metrics') == 22
+
+    def test_context_cache(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, context_cache_size=2)
+        for i in range(3):
+            stats.submit_packets(b'counter:1|c|#tag2,tag1,host:otherhost')
+            stats.submit_packets(b'set:value%d|s' % i)
+        # several datums aren't cached
+        stats.submit_packets(b'hist:1|h:2|h')
+        stats.submit_packets(b'gauge:1|g')
+
+        self.sleep_for_interval_length()
+        metrics = stats.flush()
+
+        counter = [m for m in metrics if m['metric'] == b'counter'][0]
+        assert counter['points'][0][1] == 3
+        assert counter['tags'] == (b'tag1', b'tag2')
+        assert counter['host'] == b'otherhost'
+        assert [m for m in metrics if m['metric'] == b'set'][0]['points'][0][1] == 3
+        assert [m for m in metrics if m['metric'] == b'hist.count'][0]['points'][0][1] == 2
+
+        assert stats.stats.get_stat('context_cache_hits') == 4
+        assert stats.stats.get_stat('context_cache_misses') == 3
+        assert stats.stats.get_stat('context_cache_evictions') == 1
+        assert stats.stats.get_stat('context_cache_size') == 2
+
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, context_cache_size=0)
+        stats.submit_packets(b'counter:1|c')
+        assert stats.context_cache is None
+
     # TODO: enable after dogstatsd implemented
     #
     # def test_tags_gh442(self):
@@ -1037,6 +1162,174 @@ class TestUnitMetricsBucketAggregator():
         assert h1['points'][0][0] == h4['points'][0][0]
         assert h1['points'][0][0] == h5['points'][0][0]
 
+    def test_distribution(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        for i in range(1000):
+            stats.submit_packets(b'my.dist:%d|d|#env:prod' % i)
+        stats.submit_packets(b'my.dist:1:2|d|@0.5|#env:prod')
+
+        self.sleep_for_interval_length()
+        assert stats.flush() == []
+        sketches = stats.flush_sketches()
+        assert len(sketches) == 1
+        dist = sketches[0]
+        assert dist['metric'] == b'my.dist'
+        assert dist['tags'] == (b'env:prod',)
+        assert dist['type'] == 'distribution'
+        sketch = dist['points'][0][1]
+        assert sketch.count == 1004
+        assert (sketch.min, sketch.max) == (0, 999)
+        # the median of 0-999 and of the 4 samples of 1 and 2
+        assert abs(sketch.quantile(0.5) - 497) <= 497 * sketch.relative_accuracy
+        assert stats.stats.get_stat('metrics') == 1002
+
+    def test_set_hll(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, set_hll_threshold=100,
+                                        set_hll_metric_prefixes=['my.users'])
+        stats.submit_packets(b'my.users:' + b':'.join(b'%d' % i for i in range(5000)) + b'|s')
+        stats.submit_packets(b'my.ids:' + b':'.join(b'%d' % i for i in range(5000)) + b'|s')
+
+        self.sleep_for_interval_length()
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        assert abs(metrics[b'my.users'] - 5000) <= 150
+        assert metrics[b'my.ids'] == 5000
+
+    def test_context_limits(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, max_contexts_per_metric=2,
+                                        max_total_contexts=5, context_cache_size=0)
+        for i in range(5):
+            stats.submit_packets('my.counter:1|c|#request:%d' % i)
+        stats.submit_packets('my.counter:1|c|#request:0')
+        for i in range(3):
+            stats.submit_packets('my.gauge:%d|g|#request:%d' % (i, i))
+        stats.submit_packets('other.gauge:1|g')
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(stats.flush())
+        assert [(m['metric'], m['tags'], m['points'][0][1]) for m in metrics] == [
+            ('my.counter', ('dd.overflow:true',), 3),
+            ('my.counter', ('request:0',), 2),
+            ('my.counter', ('request:1',), 1),
+            ('my.gauge', ('request:0',), 0),
+            ('my.gauge', ('request:1',), 1),
+        ]
+
+        # The counters are still tracked: the gauge and its overflow context don't fit in the total
+        assert stats.stats.get_stat('context_limit_contexts') == 3
+        assert stats.stats.get_stat('context_limit_folded') == 3
+        assert stats.stats.get_stat('context_limit_dropped') == 2
+        assert stats.stats.get_info('context_limit_offenders') == [
+            ['my.counter', 3, 3], ['my.gauge', 1, 0], ['other.gauge', 1, 0]]
+
+    def test_context_limits_before_registering(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, max_contexts_per_metric=2,
+                                        max_total_contexts=5, tag_registry=TagRegistry())
+        for _ in range(2):
+            for i in range(5):
+                stats.submit_packets('my.counter:1|c|#request:%d' % i)
+            stats.submit_metric('my.gauge', 1, 'g', tags=['request:%d' % i])
+
+        # The contexts over the limits are neither registered nor cached
+        assert len(stats.context_registry) == 4
+        assert len(stats.context_cache) == 2
+        assert stats.context_registry.get_id(('my.counter', ('request:4',), 'myhost')) is None
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(stats.flush())
+        assert [(m['metric'], m['tags'], m['points'][0][1]) for m in metrics] == [
+            ('my.counter', ('dd.overflow:true',), 6),
+            ('my.counter', ('request:0',), 2),
+            ('my.counter', ('request:1',), 2),
+            ('my.gauge', ('request:4',), 1),
+        ]
+
+    def test_concurrent_flush(self):
+        interval = 0.01
+        stats = MetricsBucketAggregator('myhost', interval=interval, context_cache_size=0)
+        packets = [b'my.counter:1|c|#shard:%d' % (i % 100) for i in range(50000)]
+        ingester = threading.Thread(target=lambda: [stats.submit_packets_batch([p]) for p in packets])
+        ingester.start()
+
+        # The closed buckets are drained once ingestion is done with them
+        metrics = []
+        while ingester.is_alive():
+            metrics += stats.flush()
+        ingester.join()
+        time.sleep(interval * 2)
+        metrics += stats.flush()
+        assert stats.ingest_epoch is None
+        total = sum(value * interval for m in metrics for _, value in m['points'])
+        self.assert_almost_equal(total, len(packets), 0.01)
+
+    def test_concurrent_packet_count(self):
+        interval = 0.01
+        stats = MetricsBucketAggregator('myhost', interval=interval, context_cache_size=0)
+        packets = [b'my.counter:1|c|#shard:%d' % (i % 100) for i in range(50000)]
+        ingester = threading.Thread(target=lambda: [stats.submit_packets_batch([p]) for p in packets])
+        # The reporter submits the packet count gauge and flushes while the
+        # server ingests
+        metrics = []
+        packets_flushed = []
+
+        def report():
+            stats.send_packet_count('datadog.dogstatsd.packet.count')
+            metrics.extend(stats.flush())
+            packets_flushed.append(stats.stats.get_stat('packets'))
+
+        # Switch threads as often as possible to interleave them
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            ingester.start()
+            while ingester.is_alive():
+                report()
+            ingester.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        time.sleep(interval * 2)
+        report()
+        assert stats.ingest_epoch is None
+        total = sum(value * interval for m in metrics if m['metric'] == b'my.counter' for _, value in m['points'])
+        self.assert_almost_equal(total, len(packets), 0.01)
+        # No packet is lost or counted twice by the counts snapshots
+        assert sum(packets_flushed) == len(packets)
+        gauges = [value for m in metrics if m['metric'] == 'datadog.dogstatsd.packet.count' for _, value in m['points']]
+        assert gauges and max(gauges) <= len(packets)
+
+    def test_timestamped_metrics(self):
+        threshold = 100
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, recent_point_threshold=threshold)
+        recent = int(time.time()) - threshold // 2
+        old = int(time.time()) - threshold * 2
+
+        stats.submit_packets('my.gauge:1:5|g|#env:prod|T%d' % recent)
+        stats.submit_packets('my.count:2:3|c|@0.5|#host:otherhost|T%d' % recent)
+        stats.submit_packets('my.gauge:2|g|T%d' % old)
+        # only gauges and counters can be timestamped
+        stats.submit_packets('my.hist:4|h|T%d' % recent)
+
+        # timestamped points skip the buckets
+        assert [[stats.context_registry.get(i) for i in bucket.context_ids()]
+                for bucket in stats.metric_by_bucket.values()] == [[('my.hist', (), 'myhost')]]
+        self.sleep_for_interval_length()
+        assert [m['metric'] for m in stats.flush()] == ['my.hist.max', 'my.hist.median', 'my.hist.avg', 'my.hist.count',
+                                                        'my.hist.95percentile']
+
+        gauge, count = stats.flush_timestamped()
+        assert gauge['metric'] == 'my.gauge'
+        assert gauge['points'] == [(recent, 5)]
+        assert gauge['tags'] == ('env:prod',)
+        assert gauge['host'] == 'myhost'
+        assert gauge['type'] == 'gauge'
+        assert count['metric'] == 'my.count'
+        assert count['points'] == [(recent, 10)]
+        assert count['tags'] is None
+        assert count['host'] == 'otherhost'
+        assert count['type'] == 'count'
+
+        assert stats.stats.get_stat('timestamped_metrics') == 2
+        assert stats.flush_timestamped() == []
+
     def test_calculate_bucket_start(self):
         stats = MetricsBucketAggregator('myhost', interval=10)
         assert stats.calculate_bucket_start(13284283) == 13284280
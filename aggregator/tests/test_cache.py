@@ -0,0 +1,33 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from aggregator.cache import ContextCache
+
+
+def test_context_cache_lru():
+    cache = ContextCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    # `b` is the least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+    assert cache.reset_counters() == (3, 1, 1)
+    assert cache.reset_counters() == (0, 0, 0)
+
+
+def test_context_cache_on_evict():
+    evicted = []
+    cache = ContextCache(1, evicted.append)
+    cache.set('a', 1)
+    cache.set('a', 2)
+    cache.set('b', 3)
+    # replaced and evicted entries
+    assert evicted == [1, 2]
+    assert cache.reset_counters() == (0, 0, 1)
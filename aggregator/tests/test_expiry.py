@@ -0,0 +1,27 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator.expiry import ExpiryQueue
+
+
+def test_expiry_queue():
+    last_sample_times = {1: 10, 2: 20, 3: 30}
+    queue = ExpiryQueue()
+    for context_id, last_sample_time in last_sample_times.items():
+        queue.push(context_id, last_sample_time)
+    # Contexts are queued once
+    queue.push(1, 10)
+    assert len(queue) == 3
+
+    # 1 was sampled since it was queued, 3 isn't tracked anymore
+    last_sample_times[1] = 40
+    del last_sample_times[3]
+    assert queue.pop_expired(35, last_sample_times.get) == [2]
+    assert len(queue) == 1
+
+    assert queue.pop_expired(35, last_sample_times.get) == []
+    assert queue.pop_expired(50, last_sample_times.get) == [1]
+    assert len(queue) == 0
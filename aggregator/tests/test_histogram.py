@@ -3,9 +3,12 @@
 # This product includes software developed at Datadog (https://www.datadoghq.com/).
 # Copyright 2018 Datadog, Inc.
 
+# stdlib
+from random import randint
+
 # project
 from aggregator import MetricsAggregator
-from aggregator.types import Histogram
+from aggregator.types import SELECT_MIN_SAMPLES, ExactSamples, Histogram
 from config import Config
 
 
@@ -143,3 +146,32 @@ class TestHistogram():
         assert value_by_type['max'] == 19
         assert value_by_type['sum'] == 190
         assert value_by_type['95percentile'] == 18
+
+    def test_exact_int_samples(self):
+        stats = MetricsAggregator('myhost', histogram_aggregates=['min', 'max', 'median', 'sum'])
+
+        for i in range(20):
+            stats.submit_packets('myhistogram:{0}|h'.format(i))
+        stats.submit_packets('myfloathistogram:1|h')
+        stats.submit_packets('myfloathistogram:2.5|h')
+
+        metrics = stats.flush()[:-1]  # we remove the datadog.agent.running metric
+        values = dict((m['metric'], m['points'][0][1]) for m in metrics)
+
+        assert all(isinstance(values['myhistogram.' + suffix], int)
+                   for suffix in ('min', 'max', 'median', 'sum', '95percentile'))
+        assert values['myfloathistogram.min'] == 1.0
+        assert isinstance(values['myfloathistogram.min'], float)
+        assert values['myfloathistogram.sum'] == 3.5
+
+    def test_exact_selection(self):
+        length = SELECT_MIN_SAMPLES * 4
+        values = [randint(0, 1000) for _ in range(length)]
+        samples = ExactSamples()
+        samples.extend(values)
+        quantiles = [0.5, 0.95, 0.99]
+
+        ordered = sorted(values)
+        assert samples.describe(quantiles) == (
+            length, ordered[0], ordered[-1], sum(values),
+            [ordered[int(round(q * length - 1))] for q in quantiles])
@@ -0,0 +1,43 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# 3p
+import pytest
+
+# project
+from aggregator.hll import HyperLogLog
+
+
+@pytest.mark.parametrize('cardinality', [0, 10, 1000, 100000])
+def test_hll_estimate(cardinality):
+    hll = HyperLogLog()
+    hll.update(b'user:%d' % i for i in range(cardinality))
+    # Duplicates aren't counted
+    for i in range(cardinality // 2):
+        hll.add(b'user:%d' % i)
+
+    assert len(hll.registers) == 2 ** 14
+    assert abs(hll.estimate() - cardinality) <= 0.03 * cardinality
+
+
+def test_hll_values():
+    hll = HyperLogLog(precision=10)
+    hll.update(['a', 1, 1.0, b'a'])
+    # Values are hashed on their string representation
+    assert hll.estimate() == 3
+
+
+def test_hll_merge():
+    hll = HyperLogLog()
+    other = HyperLogLog()
+    hll.update(range(0, 20000))
+    other.update(range(10000, 30000))
+    hll.merge(other)
+    assert abs(hll.estimate() - 30000) <= 0.03 * 30000
+
+    with pytest.raises(ValueError):
+        hll.merge(HyperLogLog(precision=10))
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=20)
@@ -0,0 +1,135 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import time
+
+# project
+from aggregator import MetricsAggregator, MetricsBucketAggregator
+from aggregator import interning
+from aggregator.interning import ContextRegistry, TagRegistry, get_context_registry, get_tag_registry
+
+
+def test_tag_registry():
+    registry = TagRegistry()
+    first = registry.acquire(('env:prod', 'role:db'))
+    # equal tag-sets are interned to the same tuple, and tags across sets
+    assert registry.acquire(tuple(['env:prod', 'role:db'])) is first
+    second = registry.acquire(('env:prod', 'role:' + 'web'))
+    assert second[0] is first[0]
+    assert registry.get(('env:prod', 'role:db')) is first
+    assert registry.get(('env:dev',)) == ('env:dev',)
+
+    assert registry.tag_count() == 3
+    assert registry.tag_set_count() == 2
+    assert registry.get_id(first) == 0
+    assert registry.get_id(second) == 1
+    assert registry.get_tag_id('role:web') == 2
+    assert registry.bytes_saved() > 0
+
+    registry.release(first)
+    assert registry.tag_set_count() == 2
+    registry.release(first)
+    registry.release(second)
+    assert registry.tag_set_count() == 0
+    assert registry.tag_count() == 0
+    assert registry.bytes_saved() == 0
+
+    # IDs aren't reused
+    registry.acquire(('env:prod', 'role:db'))
+    assert registry.get_id(('env:prod', 'role:db')) == 2
+
+
+def test_shared_registry():
+    assert MetricsAggregator('myhost').tag_registry is get_tag_registry()
+    assert MetricsBucketAggregator('myhost').tag_registry is get_tag_registry()
+    assert MetricsAggregator('myhost').context_registry is get_context_registry()
+    assert MetricsBucketAggregator('myhost').context_registry is get_context_registry()
+
+
+def test_reset_registries(monkeypatch):
+    # restored after the test
+    monkeypatch.setattr(interning, '_tag_registry', get_tag_registry())
+    monkeypatch.setattr(interning, '_context_registry', get_context_registry())
+    tag_registry = get_tag_registry()
+    tag_registry.acquire(('env:prod',))
+
+    interning.reset_registries()
+    assert get_tag_registry() is not tag_registry
+    assert get_tag_registry().tag_set_count() == 0
+    assert get_context_registry().tag_registry is get_tag_registry()
+    assert MetricsBucketAggregator('myhost').context_registry is get_context_registry()
+
+
+def test_aggregators_release_expired_contexts():
+    registry = TagRegistry()
+    aggregator = MetricsAggregator('myhost', expiry_seconds=0.5, tag_registry=registry)
+    aggregator.gauge('my.gauge', 1, tags=['role:db', 'env:prod'])
+    aggregator.gauge('my.other.gauge', 1, tags=['env:prod', 'role:db'])
+    metrics = aggregator.flush()
+    assert metrics[0]['tags'] is metrics[1]['tags']
+    assert aggregator.stats.get_stat('interned_tag_sets') == 1
+    assert aggregator.stats.get_stat('interned_tag_bytes_saved') > 0
+
+    # Cached contexts are kept until they are evicted, see test_context_cache_references
+    bucket_aggregator = MetricsBucketAggregator('myhost', interval=0.1, expiry_seconds=0.5,
+                                                tag_registry=registry, context_cache_size=0)
+    bucket_aggregator.submit_packets('my.counter:1|c|#role:db,env:prod')
+    bucket_aggregator.submit_packets('my.gauge:1|g|#role:web')
+    time.sleep(0.2)
+    bucket_aggregator.flush()
+    # counters contexts are kept until they expire
+    assert registry.tag_set_count() == 1
+
+    time.sleep(0.6)
+    aggregator.flush()
+    bucket_aggregator.flush()
+    assert registry.tag_set_count() == 0
+
+
+def test_context_registry():
+    tag_registry = TagRegistry()
+    registry = ContextRegistry(tag_registry)
+    first = registry.acquire(('my.gauge', ('env:prod',), 'myhost'))
+    assert registry.acquire(('my.gauge', ('env:prod',), 'myhost')) == first
+    second = registry.acquire(('my.gauge', (), 'myhost'))
+    assert second != first
+    assert registry.get_id(('my.gauge', ('env:prod',), 'myhost')) == first
+    assert registry.get_id(('my.gauge', ('env:dev',), 'myhost')) is None
+    assert registry.get(first)[1] is tag_registry.get(('env:prod',))
+    assert len(registry) == 2
+    assert tag_registry.tag_set_count() == 1
+
+    registry.release(first)
+    registry.acquire_id(first)
+    registry.release(first)
+    assert len(registry) == 2
+    registry.release(first)
+    registry.release(second)
+    assert len(registry) == 0
+    assert tag_registry.tag_set_count() == 0
+    assert (registry.lookups, registry.created, registry.evicted) == (5, 2, 2)
+
+    # IDs aren't reused
+    assert registry.acquire(('my.gauge', (), 'myhost')) not in (first, second)
+
+
+def test_context_cache_references():
+    registry = ContextRegistry(TagRegistry())
+    aggregator = MetricsBucketAggregator('myhost', interval=0.1, expiry_seconds=0.5,
+                                         context_registry=registry, context_cache_size=1)
+    aggregator.submit_packets('my.gauge:1|g|#role:web')
+    aggregator.submit_packets('my.gauge:2|g|#role:web')
+    time.sleep(0.2)
+    aggregator.flush()
+    assert aggregator.stats.get_stat('context_registry_created') == 1
+    assert aggregator.stats.get_stat('context_registry_size') == 1
+
+    # The cache keeps its contexts registered until it evicts them
+    aggregator.submit_packets('my.other.gauge:1|g')
+    time.sleep(0.2)
+    aggregator.flush()
+    assert aggregator.stats.get_stat('context_registry_evicted') == 1
+    assert aggregator.stats.get_stat('context_registry_size') == 1
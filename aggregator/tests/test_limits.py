@@ -0,0 +1,40 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# project
+from aggregator.limits import ContextLimiter, merge_offenders
+
+
+def test_context_limiter():
+    limiter = ContextLimiter(max_contexts_per_metric=2, max_total_contexts=3)
+    limiter.hold(1, 'my.gauge')
+    limiter.hold(1, 'my.gauge')
+    limiter.hold(2, 'my.gauge')
+    assert 1 in limiter and len(limiter) == 2
+    assert not limiter.admit('my.gauge')
+    # overflow contexts only count towards the total
+    assert limiter.admit('my.gauge', overflow=True)
+    limiter.hold(3, 'other.gauge')
+    assert not limiter.admit('another.gauge')
+
+    limiter.release(1)
+    assert 1 in limiter
+    limiter.release(1)
+    assert 1 not in limiter
+    assert limiter.admit('my.gauge')
+
+    limiter.fold('my.gauge', 3)
+    limiter.drop('other.gauge')
+    limiter.drop('my.gauge')
+    assert limiter.reset_counters() == (3, 2, [('my.gauge', 4, 1), ('other.gauge', 1, 1)])
+    assert limiter.reset_counters() == (0, 0, [])
+
+
+def test_merge_offenders():
+    merged = merge_offenders([
+        [('my.gauge', 4, 1), ('other.gauge', 1, 1)],
+        [['other.gauge', 5, 2]],
+    ])
+    assert merged == [('other.gauge', 6, 3), ('my.gauge', 4, 1)]
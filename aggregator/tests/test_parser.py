@@ -0,0 +1,87 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# 3p
+import pytest
+
+# project
+from aggregator.parser import parse_metric_packet
+
+
+class TestParseMetricPacket():
+
+    def test_plain(self):
+        assert parse_metric_packet('my.counter:1|c') == [('my.counter', [1], 'c', None, 1, None)]
+        assert parse_metric_packet('my.gauge:1.5|g') == [('my.gauge', [1.5], 'g', None, 1, None)]
+        assert parse_metric_packet('my.set:foo|s') == [('my.set', ['foo'], 's', None, 1, None)]
+
+    def test_metadata(self):
+        assert parse_metric_packet('my.hist:2|h|@0.5|#b:2,a:1') == \
+            [('my.hist', [2], 'h', ('a:1', 'b:2'), 0.5, None)]
+        assert parse_metric_packet('my.hist:2|h|#b,a|@0.5') == \
+            [('my.hist', [2], 'h', ('a', 'b'), 0.5, None)]
+        # out of bounds sample rates are reset
+        assert parse_metric_packet('my.hist:2|h|@2') == [('my.hist', [2], 'h', None, 1, None)]
+
+    def test_multiple_datums(self):
+        assert parse_metric_packet('my.hist:0.3|ms:2.5|ms|@0.5:3|ms|#env:prod,role:db') == [
+            ('my.hist', [0.3], 'ms', None, 1, None),
+            ('my.hist', [2.5], 'ms', None, 0.5, None),
+            ('my.hist', [3], 'ms', ('env:prod', 'role:db'), 1, None),
+        ]
+
+    def test_multiple_values(self):
+        assert parse_metric_packet('my.hist:1:2.5:3|h|@0.5|#env:prod,role:db') == [
+            ('my.hist', [1, 2.5, 3], 'h', ('env:prod', 'role:db'), 0.5, None),
+        ]
+        assert parse_metric_packet('my.hist:1:2|h:3:4|ms|#env:prod:5|h') == [
+            ('my.hist', [1, 2], 'h', None, 1, None),
+            ('my.hist', [3, 4], 'ms', ('env:prod',), 1, None),
+            ('my.hist', [5], 'h', None, 1, None),
+        ]
+        assert parse_metric_packet(b'my.set:a:b|s') == [(b'my.set', [b'a', b'b'], 's', None, 1, None)]
+
+    def test_bytes(self):
+        assert parse_metric_packet(b'my.hist:0.3|ms|@0.5|#env:prod,role:db:2|ms') == [
+            (b'my.hist', [0.3], 'ms', (b'env:prod', b'role:db'), 0.5, None),
+            (b'my.hist', [2], 'ms', None, 1, None),
+        ]
+        assert parse_metric_packet(b'my.set:foo|s') == [(b'my.set', [b'foo'], 's', None, 1, None)]
+        assert parse_metric_packet(b'my.dist:1|d') == [(b'my.dist', [1], 'd', None, 1, None)]
+
+    def test_timestamp(self):
+        assert parse_metric_packet('my.gauge:1|g|#env:prod|T1656581400') == \
+            [('my.gauge', [1], 'g', ('env:prod',), 1, 1656581400)]
+        assert parse_metric_packet(b'my.count:2|c|T1656581400|@0.5:3|c') == [
+            (b'my.count', [2], 'c', None, 0.5, 1656581400),
+            (b'my.count', [3], 'c', None, 1, None),
+        ]
+        # metadata following the tags doesn't start a new datum
+        assert parse_metric_packet('my.count:2|c|#env:prod|@0.5:3|c') == [
+            ('my.count', [2], 'c', ('env:prod',), 0.5, None),
+            ('my.count', [3], 'c', None, 1, None),
+        ]
+
+    def test_ignored_types(self):
+        assert parse_metric_packet('my.dist:1|d', ignore_types=('d',)) == []
+        assert parse_metric_packet('my.dist:1|d:2|c', ignore_types=('d',)) == [('my.dist', [2], 'c', None, 1, None)]
+
+    def test_empty_metadata(self):
+        # the metadata parsed before the empty field is kept
+        assert parse_metric_packet('my.hist:2|h|@0.5||#a') == [('my.hist', [2], 'h', None, 0.5, None)]
+
+    @pytest.mark.parametrize('packet', [
+        'my.counter',
+        'my.counter:1',
+        'my.counter:1:|c',
+        'my.counter:a|c',
+        'my.counter:1|c|@a',
+        'my.counter:1|c|Tnow',
+        b'my.counter:1',
+        b'my.counter:a|c',
+    ])
+    def test_bad_packets(self, packet):
+        with pytest.raises(Exception):
+            parse_metric_packet(packet)
@@ -0,0 +1,101 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+# stdlib
+import random
+
+# 3p
+import pytest
+
+# project
+from aggregator.sketch import DDSketch
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def assert_relative_accuracy(sketch, values):
+    for q in (0, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1):
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= sketch.relative_accuracy * abs(expected) + 1e-12
+
+
+def test_sketch_quantiles():
+    random.seed(42)
+    values = [random.lognormvariate(0, 2) for _ in range(10000)] + [-v for v in range(1, 100)] + [0] * 50
+    sketch = DDSketch()
+    sketch.add_many(values)
+
+    assert sketch.count == len(values)
+    assert sketch.min == min(values)
+    assert sketch.max == max(values)
+    assert sketch.sum == pytest.approx(sum(values))
+    assert_relative_accuracy(sketch, values)
+    assert sketch.quantile(2) is None
+    assert DDSketch().quantile(0.5) is None
+
+
+def test_sketch_weights():
+    sketch = DDSketch()
+    sketch.add(10, 4)
+    sketch.add(1000)
+    assert sketch.count == 5
+    assert sketch.sum == 1040
+    assert sketch.quantile(0.5) == pytest.approx(10, rel=0.01)
+
+
+def test_sketch_merge():
+    random.seed(42)
+    values1 = [random.expovariate(0.1) for _ in range(5000)]
+    values2 = [random.uniform(-100, 100) for _ in range(5000)]
+    sketch1, sketch2 = DDSketch(), DDSketch()
+    sketch1.add_many(values1)
+    sketch2.add_many(values2)
+
+    sketch1.merge(sketch2)
+    assert sketch1.count == 10000
+    assert sketch1.min == min(values2)
+    assert_relative_accuracy(sketch1, values1 + values2)
+
+    with pytest.raises(ValueError):
+        sketch1.merge(DDSketch(relative_accuracy=0.05))
+
+
+def test_sketch_max_bins():
+    sketch = DDSketch(max_bins=64)
+    values = [1.1 ** i for i in range(-200, 200)]
+    sketch.add_many(values)
+
+    assert len(sketch.positive) == 64
+    assert sketch.count == len(values)
+    # the values closest to 0 are collapsed, the upper quantiles stay accurate
+    assert sketch.quantile(0.99) == pytest.approx(exact_quantile(values, 0.99), rel=0.01)
+    assert sketch.quantile(0.01) > exact_quantile(values, 0.01) * (1 + sketch.relative_accuracy)
+
+
+def test_sketch_keys():
+    # keys of the agent's sketches
+    sketch = DDSketch()
+    assert (sketch.gamma, sketch.bias) == (1.015625, 1338)
+    assert [sketch.key(value) for value in (1e-9, 0.5, 1, 2, 10, 1e9, 1e300)] == [1, 1293, 1338, 1383, 1487, 2675, 32767]
+    sketch.add_many([5e-10, 1e-9, -1e-9])
+    assert (sketch.zero_count, sketch.positive, sketch.negative) == (1, {1: 1}, {1: 1})
+
+
+def test_sketch_to_dict():
+    sketch = DDSketch()
+    sketch.add_many([1, 1, -1, 0, 10, -2])
+    sketch.add(2, 70000)
+    payload = sketch.to_dict(10)
+    assert payload['ts'] == 10
+    assert payload['cnt'] == 70006
+    assert (payload['min'], payload['max'], payload['sum']) == (-2, 10, 140009)
+    assert payload['avg'] == 140009 / 70006.
+    # negative keys first, the counts over 16 bits split in several bins
+    assert payload['k'] == [-1383, -1338, 0, 1338, 1383, 1383, 1487]
+    assert payload['n'] == [1, 1, 1, 2, 65535, 4465, 1]
+    assert set(payload) == {'ts', 'cnt', 'min', 'max', 'avg', 'sum', 'k', 'n'}
@@ -5,8 +5,22 @@
 
 # stdlib
 import logging
+from array import array
+from math import fsum
+from random import random, sample
 from time import time
 
+# 3p
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# project
+from .hll import DEFAULT_PRECISION as DEFAULT_SET_HLL_PRECISION, HyperLogLog
+from .sketch import DDSketch
+
 
 log = logging.getLogger(__name__)
 
@@ -25,24 +39,36 @@ class MetricTypes(object):
     COUNTER = 'counter'
     RATE = 'rate'
     COUNT = 'count'
+    DISTRIBUTION = 'distribution'
 
 class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
     """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
         raise NotImplementedError()
 
+    def sample_many(self, values, sample_rate, timestamp=None):
+        """ Add several points, packed in a single datum, to the given metric. """
+        for value in values:
+            self.sample(value, sample_rate, timestamp)
+
     def flush(self, timestamp, interval):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Adds the samples of a metric of the same context, sampled by another aggregator. """
+        raise NotImplementedError()
+
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -58,6 +84,17 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def sample_many(self, values, sample_rate, timestamp=None):
+        self.sample(values[-1], sample_rate, timestamp)
+
+    def merge(self, other):
+        """ Keeps the value sampled last """
+        if other.value is not None and \
+                (self.value is None or (other.last_sample_time or 0) >= (self.last_sample_time or 0)):
+            self.value = other.value
+            self.timestamp = other.timestamp
+            self.last_sample_time = other.last_sample_time
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -81,6 +118,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -101,6 +139,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -131,6 +170,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -177,6 +217,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -190,6 +231,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def sample_many(self, values, sample_rate, timestamp=None):
+        self.value += sum(values) * int(1 / sample_rate)
+        self.last_sample_time = time()
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -206,23 +251,302 @@ class Counter(Metric):
             self.value = 0
 
 
+class ScalarColumns(object):
+    """
+    Columnar store of the scalar metrics of one type sampled in a bucket.
+    Context IDs get a row on their first sample, their values and last sample
+    times are kept in parallel arrays instead of one metric object each, and
+    the bucket is flushed in a single walk over the columns.
+    """
+    __slots__ = ('rows', 'context_ids', 'values', 'last_sample_times')
+    METRIC_TYPE = None
+
+    def __init__(self):
+        self.rows = {}
+        self.context_ids = array('q')
+        self.values = self._new_values()
+        self.last_sample_times = array('d')
+
+    def __len__(self):
+        return len(self.context_ids)
+
+    def _new_values(self):
+        raise NotImplementedError()
+
+    def add(self, context_id):
+        """ Adds a row for a new context, returns its index """
+        row = len(self.context_ids)
+        self.rows[context_id] = row
+        self.context_ids.append(context_id)
+        self.values.append(0)
+        self.last_sample_times.append(0)
+        return row
+
+    def sample(self, row, values, sample_rate, sample_time):
+        raise NotImplementedError()
+
+    def flushed_values(self, interval):
+        return self.values
+
+    def flush(self, formatter, get_context, timestamp, interval):
+        """ Formats the rows, `get_context` resolving their context ID """
+        metric_type = self.METRIC_TYPE
+        return [formatter(
+            metric=name,
+            value=value,
+            timestamp=timestamp,
+            tags=tags or None,
+            hostname=hostname,
+            metric_type=metric_type,
+            interval=interval,
+        ) for (name, tags, hostname), value in zip(map(get_context, self.context_ids),
+                                                    self.flushed_values(interval))]
+
+
+class GaugeColumns(ScalarColumns):
+    """ The gauges of a bucket, flushed as `BucketGauge` at the bucket's time """
+    __slots__ = ()
+    METRIC_TYPE = MetricTypes.GAUGE
+
+    def _new_values(self):
+        # Values are kept as parsed: ints aren't cast to floats
+        return []
+
+    def sample(self, row, values, sample_rate, sample_time):
+        self.values[row] = values[-1]
+        self.last_sample_times[row] = sample_time
+
+    def to_metrics(self, formatter, get_context):
+        """ The rows as `BucketGauge`, to be merged with the gauges of other aggregators """
+        gauges = []
+        for (name, tags, hostname), value, sample_time in zip(map(get_context, self.context_ids),
+                                                              self.values, self.last_sample_times):
+            gauge = BucketGauge(formatter, name, tags or None, hostname)
+            gauge.value = value
+            gauge.last_sample_time = sample_time
+            gauges.append(gauge)
+        return gauges
+
+
+class CounterColumns(ScalarColumns):
+    """ The counters of a bucket, flushed as `Counter` """
+    __slots__ = ()
+    METRIC_TYPE = MetricTypes.RATE
+
+    def _new_values(self):
+        return array('d')
+
+    def sample(self, row, values, sample_rate, sample_time):
+        self.values[row] += sum(values) * int(1 / sample_rate)
+        self.last_sample_times[row] = sample_time
+
+    def flushed_values(self, interval):
+        return [value / interval for value in self.values]
+
+
 DEFAULT_HISTOGRAM_AGGREGATES = ['max', 'median', 'avg', 'count']
 DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
+DEFAULT_HISTOGRAM_BACKEND = 'exact'
+DEFAULT_HISTOGRAM_RESERVOIR_SIZE = 1024
+DEFAULT_SET_BACKEND = 'exact'
+DEFAULT_SET_HLL_THRESHOLD = 10000
+# Below this many exact samples, sorting them all is faster than `_select`
+SELECT_MIN_SAMPLES = 4096
+
+
+def _rank(q, length):
+    """ Index of the quantile `q` in `length` sorted samples """
+    return max(int(round(q * length - 1)), 0)
+
+
+def _select(values, ranks):
+    """
+    Returns the values at the given ranks of the unsorted `values`, without
+    sorting them all: the bounds of a window around each rank are read from a
+    sorted random sample, and only the values within that window get sorted.
+    Sorts everything when a rank falls outside of its window, which is rare.
+    """
+    length = len(values)
+    size = int(length ** (2 / 3.))
+    picked = sorted(sample(values, size))
+    margin = 1.5 * size ** 0.5
+
+    selected = []
+    for rank in ranks:
+        position = rank * size / float(length)
+        low = picked[max(int(position - margin), 0)]
+        high = picked[min(int(position + margin), size - 1)]
+        above = [value for value in values if value >= low]
+        window = sorted([value for value in above if value <= high])
+        index = rank - (length - len(above))
+        if not 0 <= index < len(window):
+            ordered = sorted(values)
+            return [ordered[rank] for rank in ranks]
+        selected.append(window[index])
+    return selected
+
+
+class ExactSamples(array):
+    """
+    Keeps every sample, unboxed in an array of doubles: quantiles are exact,
+    memory grows with the samples. Quantiles are selected with NumPy when
+    it's available, with `_select` otherwise. Values are flushed as ints as
+    long as every sample is an int.
+    """
+
+    def __new__(cls, extra_config=None):
+        samples = super(ExactSamples, cls).__new__(cls, 'd')
+        samples.floats = False
+        return samples
+
+    def append(self, value):
+        if not self.floats and type(value) is not int:
+            self.floats = True
+        super(ExactSamples, self).append(value)
+
+    def extend(self, values):
+        if not self.floats:
+            values = list(values)
+            self.floats = any(type(value) is not int for value in values)
+        super(ExactSamples, self).extend(values)
+
+    def describe(self, quantiles):
+        """ Returns the number, min, max, sum and the given quantiles of the samples """
+        length = len(self)
+        ranks = [_rank(q, length) for q in quantiles]
+
+        if HAS_NUMPY:
+            # Copied, the array can't grow while its buffer is exported
+            samples = numpy.array(self, dtype=numpy.float64)
+            samples.partition(sorted(set(ranks + [0, length - 1])))
+            min_, max_, sum_ = samples[0], samples[-1], samples.sum()
+            selected = [samples[rank] for rank in ranks]
+        elif length < SELECT_MIN_SAMPLES:
+            ordered = sorted(self)
+            min_, max_, sum_ = ordered[0], ordered[-1], fsum(ordered)
+            selected = [ordered[rank] for rank in ranks]
+        else:
+            values = self.tolist()
+            min_, max_, sum_ = min(values), max(values), fsum(values)
+            selected = _select(values, ranks)
+
+        cast = float if self.floats else int
+        return length, cast(min_), cast(max_), cast(sum_), [cast(value) for value in selected]
+
+    def merge(self, other):
+        self.floats = self.floats or other.floats
+        super(ExactSamples, self).extend(other)
+
+
+class SketchSamples(DDSketch):
+    """
+    Counts the samples in a DDSketch: constant memory, quantiles are within
+    the sketch relative accuracy (1%) of their value.
+    """
+
+    def __init__(self, extra_config=None):
+        super(SketchSamples, self).__init__()
+
+    append = DDSketch.add
+    extend = DDSketch.add_many
+
+    def __len__(self):
+        return self.count
+
+    def describe(self, quantiles):
+        return self.count, self.min, self.max, self.sum, [self.quantile(q) for q in quantiles]
+
+
+class ReservoirSamples(object):
+    """
+    Keeps a uniform random sample of `reservoir_size` samples (Algorithm R):
+    constant memory, the count, min, max and sum stay exact, quantiles are
+    exact for the reservoir and their rank is off by about
+    1/sqrt(reservoir_size) beyond it.
+    """
+
+    def __init__(self, extra_config=None):
+        self.size = (extra_config or {}).get('reservoir_size') or DEFAULT_HISTOGRAM_RESERVOIR_SIZE
+        self.reservoir = []
+        self.count = 0
+        self.sum = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def append(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        if len(self.reservoir) < self.size:
+            self.reservoir.append(value)
+        else:
+            index = int(random() * self.count)
+            if index < self.size:
+                self.reservoir[index] = value
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def merge(self, other):
+        """
+        Adds the samples counted by another reservoir, keeping a random sample
+        of both: each sample kept comes from one reservoir or the other in
+        proportion of the number of samples they counted.
+        """
+        if not other.count:
+            return
+        reservoir = self.reservoir + other.reservoir
+        if len(reservoir) > self.size:
+            total = self.count + other.count
+            kept = sum(1 for _ in range(self.size) if random() * total < self.count)
+            kept = max(self.size - len(other.reservoir), min(kept, len(self.reservoir)))
+            reservoir = sample(self.reservoir, kept) + sample(other.reservoir, self.size - kept)
+        self.reservoir = reservoir
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def __len__(self):
+        return self.count
+
+    def describe(self, quantiles):
+        self.reservoir.sort()
+        length = len(self.reservoir)
+        return (self.count, self.min, self.max, self.sum,
+                [self.reservoir[_rank(q, length)] for q in quantiles])
+
+
+HISTOGRAM_BACKENDS = {
+    'exact': ExactSamples,
+    'sketch': SketchSamples,
+    'reservoir': ReservoirSamples,
+}
+
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'aggregates', 'percentiles', 'samples_class', 'extra_config', 'samples')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
         self.name = name
         self.count = 0
-        self.samples = []
         self.aggregates = extra_config['aggregates'] if\
             extra_config is not None and extra_config.get('aggregates') is not None\
             else DEFAULT_HISTOGRAM_AGGREGATES
         self.percentiles = extra_config['percentiles'] if\
             extra_config is not None and extra_config.get('percentiles') is not None\
             else DEFAULT_HISTOGRAM_PERCENTILES
+        self.samples_class = HISTOGRAM_BACKENDS[
+            (extra_config or {}).get('backend') or DEFAULT_HISTOGRAM_BACKEND]
+        self.extra_config = extra_config
+        self.samples = self.samples_class(extra_config)
         self.tags = tags
         self.hostname = hostname
         self.last_sample_time = None
@@ -232,17 +556,28 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
+    def sample_many(self, values, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate) * len(values)
+        self.samples.extend(values)
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.samples.merge(other.samples)
+        self.last_sample_time = max(self.last_sample_time or 0, other.last_sample_time or 0)
+
+    def _suffixed_name(self, suffix):
+        # dogstatsd names are bytes until serialization
+        if isinstance(self.name, bytes):
+            return self.name + b'.' + suffix.encode('ascii')
+        return '%s.%s' % (self.name, suffix)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
-
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        sum_ = sum(self.samples)
+        length, min_, max_, sum_, quantiles = self.samples.describe([0.5] + list(self.percentiles))
+        med = quantiles[0]
         avg = sum_ / float(length)
 
         aggregators = [
@@ -263,16 +598,15 @@ class Histogram(Metric):
         metrics = [self.formatter(
             hostname=self.hostname,
             tags=self.tags,
-            metric='%s.%s' % (self.name, suffix),
+            metric=self._suffixed_name(suffix),
             value=value,
             timestamp=ts,
             metric_type=metric_type,
             interval=interval) for suffix, value, metric_type in metric_aggrs
         ]
 
-        for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
-            name = '%s.%spercentile' % (self.name, int(p * 100))
+        for p, val in zip(self.percentiles, quantiles[1:]):
+            name = self._suffixed_name('%spercentile' % int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
                 tags=self.tags,
@@ -284,14 +618,22 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
+        self.samples = self.samples_class(self.extra_config)
         self.count = 0
 
         return metrics
 
 
 class Set(Metric):
-    """ A metric to track the number of unique elements in a set. """
+    """
+    A metric to track the number of unique elements in a set.
+
+    Sets opted in to HyperLogLog, all of them with the `hll` backend or the
+    ones whose name starts with one of `hll_prefixes`, count their elements
+    exactly until `hll_threshold` of them, then estimate their number with a
+    HyperLogLog of fixed memory, for the lifetime of the context.
+    """
+    __slots__ = ('values', 'hll', 'hll_precision', 'hll_threshold')
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -299,31 +641,131 @@ class Set(Metric):
         self.tags = tags
         self.hostname = hostname
         self.values = set()
+        self.hll = None
         self.last_sample_time = None
 
+        extra_config = extra_config or {}
+        self.hll_precision = extra_config.get('hll_precision') or DEFAULT_SET_HLL_PRECISION
+        self.hll_threshold = None
+        if (extra_config.get('backend') or DEFAULT_SET_BACKEND) == 'hll' or self._has_prefix(name, extra_config.get('hll_prefixes')):
+            self.hll_threshold = extra_config.get('hll_threshold')
+            if self.hll_threshold is None:
+                self.hll_threshold = DEFAULT_SET_HLL_THRESHOLD
+            if not self.hll_threshold:
+                self.hll = HyperLogLog(self.hll_precision)
+
+    @staticmethod
+    def _has_prefix(name, prefixes):
+        if not prefixes:
+            return False
+        if isinstance(name, bytes):
+            prefixes = tuple(prefix.encode('utf-8') for prefix in prefixes)
+        return name.startswith(tuple(prefixes))
+
+    def _switch_to_hll(self):
+        self.hll = HyperLogLog(self.hll_precision)
+        self.hll.update(self.values)
+        self.values = set()
+
     def sample(self, value, sample_rate, timestamp=None):
-        self.values.add(value)
+        if self.hll is not None:
+            self.hll.add(value)
+        else:
+            self.values.add(value)
+            if self.hll_threshold is not None and len(self.values) > self.hll_threshold:
+                self._switch_to_hll()
         self.last_sample_time = time()
 
+    def sample_many(self, values, sample_rate, timestamp=None):
+        if self.hll is not None:
+            self.hll.update(values)
+        else:
+            self.values.update(values)
+            if self.hll_threshold is not None and len(self.values) > self.hll_threshold:
+                self._switch_to_hll()
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        if other.hll is not None:
+            if self.hll is None:
+                self._switch_to_hll()
+            self.hll.merge(other.hll)
+        elif self.hll is not None:
+            self.hll.update(other.values)
+        else:
+            self.values |= other.values
+            if self.hll_threshold is not None and len(self.values) > self.hll_threshold:
+                self._switch_to_hll()
+        self.last_sample_time = max(self.last_sample_time or 0, other.last_sample_time or 0)
+
     def flush(self, timestamp, interval):
-        if not self.values:
+        if self.hll is not None:
+            value = self.hll.estimate()
+        else:
+            value = len(self.values)
+        if not value:
             return []
         try:
             return [self.formatter(
                 hostname=self.hostname,
                 tags=self.tags,
                 metric=self.name,
-                value=len(self.values),
+                value=value,
                 timestamp=timestamp,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             )]
         finally:
-            self.values = set()
+            if self.hll is not None:
+                self.hll = HyperLogLog(self.hll_precision)
+            else:
+                self.values = set()
+
+
+class Distribution(Metric):
+    """
+    A metric to track the global distribution of a set of values. Values are
+    counted in a quantile sketch of bounded size, flushed as is to be merged
+    with the sketches of the other hosts.
+    """
+    __slots__ = ('sketch',)
+
+    def __init__(self, formatter, name, tags, hostname, extra_config=None):
+        self.formatter = formatter
+        self.name = name
+        self.tags = tags
+        self.hostname = hostname
+        self.sketch = DDSketch()
+        self.last_sample_time = None
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.sketch.add(value, int(1 / sample_rate))
+        self.last_sample_time = time()
+
+    def sample_many(self, values, sample_rate, timestamp=None):
+        self.sketch.add_many(values, int(1 / sample_rate))
+        self.last_sample_time = time()
+
+    def flush(self, timestamp, interval):
+        if not self.sketch.count:
+            return []
+        try:
+            return [self.formatter(
+                hostname=self.hostname,
+                tags=self.tags,
+                metric=self.name,
+                value=self.sketch,
+                timestamp=timestamp,
+                metric_type=MetricTypes.DISTRIBUTION,
+                interval=interval,
+            )]
+        finally:
+            self.sketch = DDSketch(self.sketch.relative_accuracy, self.sketch.max_bins)
 
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, extra_config=None):
         self.formatter = formatter
@@ -376,6 +818,7 @@ class Rate(Metric):
 class TextualMetricTypes(object):
     COUNT = 'ct'
     COUNTER = 'c'
+    DISTRIBUTION = 'd'
     GAUGE = 'g'
     HISTOGRAM = 'h'
     HISTOGRAM_TIMING = 'ms'
@@ -395,6 +838,7 @@ class MetricResolver(object):
         'ct-c': MonotonicCount,
         '_dd-r': Rate,
         's': Set,
+        'd': Distribution,
     }
 
     def __init__(self):
@@ -421,4 +865,5 @@ class BucketMetricResolver(MetricResolver):
         'h': Histogram,
         'ms': Histogram,
         's': Set,
+        'd': Distribution,
     }
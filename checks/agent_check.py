@@ -66,6 +66,9 @@ class AgentCheck(object):
     def histogram(self, name, value, tags=None):
         self._submit_metric(TextualMetricTypes.HISTOGRAM, name, value, tags=tags)
 
+    def distribution(self, name, value, tags=None):
+        self._submit_metric(TextualMetricTypes.DISTRIBUTION, name, value, tags=tags)
+
     def historate(self, name, value, tags=None):
         self._submit_metric(TextualMetricTypes.HISTORATE, name, value, tags=tags)
 
@@ -189,6 +189,9 @@ class Config(object):
     def validate(self):
         self.validate_histogram_aggregates()
         self.validate_histogram_percentiles()
+        self.validate_histogram_backend()
+        self.validate_set_backend()
+        self.validate_dogstatsd_context_limits()
 
     def validate_histogram_aggregates(self):
         aggregates_config = self.data.get('histogram_aggregates')
@@ -250,6 +253,83 @@ class Config(object):
 
         self.data['histogram_percentiles'] = result
 
+    def validate_histogram_backend(self):
+        backend = self.data.get('histogram_backend')
+        valid_values = ['exact', 'sketch', 'reservoir']
+        if backend and backend not in valid_values:
+            log.warning("Unknown histogram backend %s, must be one of %s - using exact",
+                        backend, ', '.join(valid_values))
+            self.data['histogram_backend'] = 'exact'
+
+        # Validated even when the backend is unset
+        reservoir_size = self.data.get('histogram_reservoir_size')
+        if reservoir_size is None:
+            return
+        try:
+            reservoir_size = int(reservoir_size)
+            if reservoir_size <= 0:
+                raise ValueError
+            self.data['histogram_reservoir_size'] = reservoir_size
+        except (TypeError, ValueError):
+            log.warning("Bad histogram reservoir size %s, must be a positive integer - ignoring", reservoir_size)
+            self.data.pop('histogram_reservoir_size')
+
+    def validate_set_backend(self):
+        backend = self.data.get('set_backend')
+        if backend:
+            valid_values = ['exact', 'hll']
+            if backend not in valid_values:
+                log.warning("Unknown set backend %s, must be one of %s - using exact",
+                            backend, ', '.join(valid_values))
+                self.data['set_backend'] = 'exact'
+
+        precision = self.data.get('set_hll_precision')
+        if precision is not None:
+            try:
+                precision = int(precision)
+                if precision < 4 or precision > 18:
+                    raise ValueError
+                self.data['set_hll_precision'] = precision
+            except (TypeError, ValueError):
+                log.warning("Bad set HLL precision %s, must be an integer in [4;18] - ignoring", precision)
+                self.data.pop('set_hll_precision')
+
+        threshold = self.data.get('set_hll_threshold')
+        if threshold is not None:
+            try:
+                threshold = int(threshold)
+                if threshold < 0:
+                    raise ValueError
+                self.data['set_hll_threshold'] = threshold
+            except (TypeError, ValueError):
+                log.warning("Bad set HLL threshold %s, must be a positive integer - ignoring", threshold)
+                self.data.pop('set_hll_threshold')
+
+        prefixes = self.data.get('set_hll_metric_prefixes')
+        if prefixes and not isinstance(prefixes, list):
+            log.warning("set_hll_metric_prefixes should be a list - ignoring")
+            self.data.pop('set_hll_metric_prefixes')
+        elif prefixes:
+            self.data['set_hll_metric_prefixes'] = [str(prefix).strip() for prefix in prefixes if prefix]
+
+    def validate_dogstatsd_context_limits(self):
+        dogstatsd_config = self.data.get('dogstatsd')
+        if not isinstance(dogstatsd_config, dict):
+            return
+
+        for option in ['max_contexts_per_metric', 'max_total_contexts']:
+            limit = dogstatsd_config.get(option)
+            if limit is None:
+                continue
+            try:
+                limit = int(limit)
+                if limit < 0:
+                    raise ValueError
+                dogstatsd_config[option] = limit
+            except (TypeError, ValueError):
+                log.warning("Bad dogstatsd %s %s, must be a positive integer - ignoring", option, limit)
+                dogstatsd_config.pop(option)
+
     def add_provider(self, source, provider):
         """ Adds ConfigProvider for check configurations """
         if not isinstance(provider, ConfigProvider):
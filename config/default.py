@@ -23,6 +23,8 @@ DEFAULT_EXT_HOST_TAGS_INTERVAL = 5 * 60
 DEFAULT_LOG_LEVEL = 'info'
 DEFAULT_API_PORT = 8050
 DEFAULT_DOGSTATSD_PORT = 8125
+DEFAULT_DOGSTATSD_RECV_BATCH_SIZE = 64
+DEFAULT_DOGSTATSD_CONTEXT_CACHE_SIZE = 4096
 DEFAULT_BIND_HOST = 'localhost'
 DEFAULT_LOGGING_CONFIG = {
     'disable_file_logging': False,
@@ -80,6 +82,16 @@ def init(config):
             'forward_host': None,
             'forward_port': None,
             'so_rcvbuf': None,
+            'recv_batch_size': DEFAULT_DOGSTATSD_RECV_BATCH_SIZE,
+            'workers': 1,
+            'socket': None,
+            'socket_rcvbuf': None,
+            'ring_buffer_size': 0,
+            'ring_overflow_policy': 'drop-newest',
+            'consumers': 1,
+            'context_cache_size': DEFAULT_DOGSTATSD_CONTEXT_CACHE_SIZE,
+            'max_contexts_per_metric': 0,
+            'max_total_contexts': 0,
             'metric_namespace': None,
             'utf8_decoding': True,
         },
@@ -91,6 +103,7 @@ def init(config):
             'use_compression': DEFAULT_COMPRESSION_USE,
             'compression_kind': DEFAULT_COMPRESSION_KIND,
             'compression_level': DEFAULT_COMPRESSION_LEVEL,
+            'use_v2_series': False,
         },
     }
 
@@ -285,6 +285,96 @@ class TestConfig():
         os.close(fd)
         os.remove(tmpfile)
 
+    def test_validate_histogram_backend(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\nhistogram_backend: sketch\nhistogram_reservoir_size: '512'")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf.get("histogram_backend") == 'sketch'
+        assert conf.get("histogram_reservoir_size") == 512
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_histogram_backend_badval(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\nhistogram_backend: foo\nhistogram_reservoir_size: -1")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf.get("histogram_backend") == 'exact'
+        assert conf.get("histogram_reservoir_size") is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_histogram_reservoir_size_without_backend(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\nhistogram_reservoir_size: 0")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf.get("histogram_backend") is None
+        assert conf.get("histogram_reservoir_size") is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_set_backend(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\nset_backend: hll\nset_hll_precision: '12'\nset_hll_threshold: 0\n"
+                     b"set_hll_metric_prefixes: [' users.', api.]")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf.get("set_backend") == 'hll'
+        assert conf.get("set_hll_precision") == 12
+        assert conf.get("set_hll_threshold") == 0
+        assert conf.get("set_hll_metric_prefixes") == ['users.', 'api.']
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_set_backend_badval(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\nset_backend: foo\nset_hll_precision: 20\nset_hll_threshold: foo\n"
+                     b"set_hll_metric_prefixes: users.")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf.get("set_backend") == 'exact'
+        assert conf.get("set_hll_precision") is None
+        assert conf.get("set_hll_threshold") is None
+        assert conf.get("set_hll_metric_prefixes") is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
+    def test_validate_dogstatsd_context_limits(self, conf):
+        fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
+        os.write(fd, b"---\ndogstatsd:\n  max_contexts_per_metric: '1000'\n  max_total_contexts: -1")
+
+        conf.add_search_path(os.path.dirname(tmpfile))
+        conf.conf_name = os.path.basename(tmpfile)
+        conf.load()
+
+        assert conf['dogstatsd'].get('max_contexts_per_metric') == 1000
+        assert conf['dogstatsd'].get('max_total_contexts') is None
+
+        os.close(fd)
+        os.remove(tmpfile)
+
     def test_validate_percentiles_bounds(self, conf):
         fd, tmpfile = tempfile.mkstemp(prefix="datadog-unix-agent_test_")
         os.write(fd, b"---\ntest: 123\ntest2: true\nhistogram_percentiles: [1, 0]")
@@ -4,6 +4,7 @@
 # Copyright 2018 Datadog, Inc.
 
 import logging
+import socket
 from threading import Thread
 
 from aggregator import MetricsBucketAggregator
@@ -12,6 +13,7 @@ from forwarder import Forwarder
 from serialize import Serializer
 from utils.hostname import get_hostname
 from utils.network import get_proxy, get_site_url
+from utils.util import _is_affirmative
 
 from .constants import (  # pylint: disable=no-name-in-module
     DOGSTATSD_FLUSH_INTERVAL,
@@ -21,6 +23,7 @@ from . import (
     Server,
     Reporter,
 )
+from .workers import WorkerPool
 
 # Globals
 PID_NAME = 'datadog-unix-agent.dogstatsd'
@@ -38,7 +41,18 @@ def init_dogstatsd(config, forwarder=None):
     forward_to_port = config['dogstatsd'].get('forward_port')
     non_local_traffic = config['dogstatsd'].get('non_local_traffic')
     so_rcvbuf = config['dogstatsd'].get('so_rcvbuf')
+    recv_batch_size = config['dogstatsd'].get('recv_batch_size')
+    socket_path = config['dogstatsd'].get('socket')
+    socket_rcvbuf = config['dogstatsd'].get('socket_rcvbuf')
+    ring_buffer_size = config['dogstatsd'].get('ring_buffer_size')
+    ring_overflow_policy = config['dogstatsd'].get('ring_overflow_policy')
+    consumers = config['dogstatsd'].get('consumers')
     utf8_decoding = config['dogstatsd'].get('utf8_decoding')
+    context_cache_size = config['dogstatsd'].get('context_cache_size')
+    max_contexts_per_metric = config['dogstatsd'].get('max_contexts_per_metric')
+    max_total_contexts = config['dogstatsd'].get('max_total_contexts')
+
+    workers = int(config['dogstatsd'].get('workers') or 1)
 
     interval = DOGSTATSD_FLUSH_INTERVAL
     aggregator_interval = DOGSTATSD_AGGREGATOR_BUCKET_SIZE
@@ -55,24 +69,6 @@ def init_dogstatsd(config, forwarder=None):
             proxies=proxies,
         )
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(config),
-        histogram_aggregates=config.get('histogram_aggregates'),
-        histogram_percentiles=config.get('histogram_percentiles'),
-        utf8_decoding=utf8_decoding
-    )
-    # serializer
-    serializer = Serializer(
-        aggregator,
-        forwarder,
-    )
-
-    reporter = Reporter(interval, aggregator, serializer, api_key,
-                        use_watchdog=False, hostname=hostname)
-
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
     # network settings), so it's enough to just pass an empty string '' to the library.
@@ -82,8 +78,56 @@ def init_dogstatsd(config, forwarder=None):
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host,
-                    forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf)
+    def aggregator_factory():
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=get_formatter(config),
+            histogram_aggregates=config.get('histogram_aggregates'),
+            histogram_percentiles=config.get('histogram_percentiles'),
+            utf8_decoding=utf8_decoding,
+            context_cache_size=context_cache_size,
+            histogram_backend=config.get('histogram_backend'),
+            histogram_reservoir_size=config.get('histogram_reservoir_size'),
+            set_backend=config.get('set_backend'),
+            set_hll_precision=config.get('set_hll_precision'),
+            set_hll_threshold=config.get('set_hll_threshold'),
+            set_hll_metric_prefixes=config.get('set_hll_metric_prefixes'),
+            max_contexts_per_metric=max_contexts_per_metric,
+            max_total_contexts=max_total_contexts,
+        )
+
+    def server_factory(aggregator, reuse_port=False, unix_socket=True):
+        return Server(aggregator, server_host, port, forward_to_host=forward_to_host,
+                      forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf,
+                      recv_batch_size=recv_batch_size, reuse_port=reuse_port,
+                      socket_path=socket_path if unix_socket else None, socket_rcvbuf=socket_rcvbuf,
+                      ring_buffer_size=ring_buffer_size, ring_overflow_policy=ring_overflow_policy,
+                      consumers=consumers)
+
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        log.warning('SO_REUSEPORT is not supported on this platform, running a single dogstatsd worker')
+        workers = 1
+
+    if workers > 1:
+        # each worker process owns its socket and aggregator, the reporter
+        # flushes them all through the pool's sharded aggregator.
+        server = WorkerPool(workers, hostname, aggregator_factory, server_factory)
+        aggregator = server.aggregator
+    else:
+        aggregator = aggregator_factory()
+        server = server_factory(aggregator)
+
+    # serializer
+    serializer = Serializer(
+        aggregator,
+        forwarder,
+        use_v2_series=_is_affirmative((config.get('forwarder') or {}).get('use_v2_series')),
+    )
+
+    reporter = Reporter(interval, aggregator, serializer, api_key,
+                        use_watchdog=False, hostname=hostname)
 
     return reporter, server, forwarder
 
@@ -6,10 +6,89 @@
 import logging
 import threading
 
+from aggregator.types import MetricTypes
 from utils.hostname import get_hostname
 
 log = logging.getLogger('dogstatsd')
 
+# Series types whose points from different shards add up
+ADDITIVE_TYPES = (MetricTypes.COUNT, MetricTypes.RATE)
+
+
+def merge_series(shards):
+    """
+    Merge the series flushed by several aggregator shards by context. Points
+    sharing a context and a timestamp are summed for counts and rates, any
+    other type keeps the value of the last shard: shards flush their gauges,
+    histograms and sets as their state instead, see `merge_states`. Series
+    of several points, like the zeros of idle counters, are merged point by
+    point.
+    """
+    if len(shards) == 1:
+        return shards[0]
+
+    merged = {}
+    for series in shards:
+        for serie in series:
+            points = serie['points']
+            for ts, value in points:
+                context = (serie['metric'], tuple(serie['tags'] or ()), serie['host'], serie['type'], ts)
+                current = merged.get(context)
+                if current is not None and serie['type'] in ADDITIVE_TYPES:
+                    current['points'] = [(ts, current['points'][0][1] + value)]
+                elif len(points) == 1:
+                    merged[context] = serie
+                else:
+                    merged[context] = dict(serie, points=[(ts, value)])
+
+    return list(merged.values())
+
+
+def merge_states(shards, interval):
+    """
+    Merge the gauges, histograms and sets flushed as their state by several
+    aggregator shards, see `MetricsBucketAggregator.keep_states`, and flush
+    them: the metrics of the same type, context and bucket are merged, so
+    that gauges keep the value sampled last and the aggregates of histograms
+    and the cardinality of sets account for the samples of every shard.
+    """
+    merged = {}
+    for states in shards:
+        for ts, metric in states:
+            key = (type(metric), metric.name, metric.tags, metric.hostname, ts)
+            current = merged.get(key)
+            if current is not None:
+                current.merge(metric)
+            else:
+                merged[key] = metric
+
+    series = []
+    for key, metric in merged.items():
+        series += metric.flush(key[-1], interval)
+    return series
+
+
+def merge_sketches(shards):
+    """
+    Merge the distributions flushed by several aggregator shards: the sketches
+    sharing a context and a timestamp are merged into one.
+    """
+    if len(shards) == 1:
+        return shards[0]
+
+    merged = {}
+    for sketches in shards:
+        for serie in sketches:
+            ts, sketch = serie['points'][0]
+            context = (serie['metric'], tuple(serie['tags'] or ()), serie['host'], ts)
+            current = merged.get(context)
+            if current is not None:
+                current['points'][0][1].merge(sketch)
+            else:
+                merged[context] = serie
+
+    return list(merged.values())
+
 
 class Reporter(threading.Thread):
     """
@@ -38,10 +117,15 @@ class Reporter(threading.Thread):
 
         log.info("Reporting every %ss", self.interval)
 
-        while not self.finished.is_set():
-            self.finished.wait(self.interval)
-            self.aggregator.send_packet_count('datadog.dogstatsd.packet.count')
-            self.flush()
+        # Flushes are serialized off the reporting loop
+        self.serializer.start()
+        try:
+            while not self.finished.is_set():
+                self.finished.wait(self.interval)
+                self.aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+                self.flush()
+        finally:
+            self.serializer.stop()
 
         # Clean up the status messages.
         log.info("Stopped reporter")
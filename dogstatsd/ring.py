@@ -0,0 +1,141 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import logging
+from threading import Condition, Thread
+
+log = logging.getLogger('dogstatsd')
+
+
+class RingBuffer(object):
+    """
+    Fixed-capacity, thread-safe FIFO of datagrams sitting between the
+    receive thread and the parse/aggregate consumers. When it's full, either
+    the incoming datagrams (drop-newest) or the queued ones (drop-oldest)
+    are dropped.
+    """
+    DROP_NEWEST = 'drop-newest'
+    DROP_OLDEST = 'drop-oldest'
+    OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+    def __init__(self, capacity, overflow_policy=DROP_NEWEST, stats=None):
+        if overflow_policy not in self.OVERFLOW_POLICIES:
+            raise ValueError('invalid ring buffer overflow policy: {}'.format(overflow_policy))
+
+        self.capacity = int(capacity)
+        self.overflow_policy = overflow_policy
+        self.stats = stats
+        self.high_water = 0
+        self.dropped = 0
+        self.closed = False
+
+        self._slots = [None] * self.capacity
+        self._head = 0
+        self._size = 0
+        self._cond = Condition()
+
+    def __len__(self):
+        return self._size
+
+    def put_many(self, items):
+        """ Queue the items, returns the number of datagrams dropped. """
+        dropped = 0
+        high_water = None
+        with self._cond:
+            slots = self._slots
+            capacity = self.capacity
+            drop_newest = self.overflow_policy == self.DROP_NEWEST
+            for item in items:
+                if self._size == capacity:
+                    dropped += 1
+                    if drop_newest:
+                        continue
+                    # the oldest slot gets overwritten
+                    self._head = (self._head + 1) % capacity
+                    self._size -= 1
+
+                slots[(self._head + self._size) % capacity] = item
+                self._size += 1
+
+            if self._size > self.high_water:
+                self.high_water = high_water = self._size
+            self.dropped += dropped
+            self._cond.notify()
+
+        if self.stats is not None:
+            if high_water is not None:
+                self.stats.set_stat('ring_depth_high_water', high_water)
+            if dropped:
+                self.stats.inc_stat('ring_dropped', dropped)
+
+        return dropped
+
+    def get_many(self, max_items, timeout=None):
+        """
+        Dequeue up to `max_items`, waiting up to `timeout` for some to be
+        available. Returns an empty list on timeout or once closed and empty.
+        """
+        with self._cond:
+            while not self._size:
+                if self.closed or not self._cond.wait(timeout):
+                    return []
+
+            slots = self._slots
+            capacity = self.capacity
+            count = min(self._size, max_items)
+            items = []
+            for _ in range(count):
+                items.append(slots[self._head])
+                slots[self._head] = None
+                self._head = (self._head + 1) % capacity
+            self._size -= count
+
+            # let another consumer pick up what's left
+            if self._size:
+                self._cond.notify()
+
+        return items
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class PacketConsumer(Thread):
+    """
+    Parses and aggregates the datagrams queued in the ring buffer. Several
+    consumers share the aggregator through `aggregator_lock`.
+    """
+    BATCH_SIZE = 64
+    WAIT_TIMEOUT = 1
+
+    def __init__(self, ring, aggregator, aggregator_lock):
+        super(PacketConsumer, self).__init__()
+        self.daemon = True
+        self._ring = ring
+        self._aggregator = aggregator
+        self._aggregator_lock = aggregator_lock
+
+    def run(self):
+        ring = self._ring
+        submit = self._aggregator.submit_packets_batch
+        stats = self._aggregator.stats
+        while True:
+            batch = ring.get_many(self.BATCH_SIZE, self.WAIT_TIMEOUT)
+            if not batch:
+                if ring.closed:
+                    break
+                continue
+
+            try:
+                with self._aggregator_lock:
+                    dropped = submit(batch)
+            except Exception:
+                log.exception('Error aggregating datagram batch')
+                continue
+
+            if dropped:
+                stats.inc_stat('datagrams_dropped', dropped)
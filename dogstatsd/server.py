@@ -4,10 +4,12 @@
 # Copyright 2018 Datadog, Inc.
 
 import logging
+import os
 import select
 import socket
+import stat
 
-from threading import Event
+from threading import Event, Lock
 
 from utils.network import (
     IPPROTO_IPV6,
@@ -16,23 +18,65 @@ from utils.network import (
     get_socket_address,
 )
 
+from .ring import PacketConsumer, RingBuffer
+
 log = logging.getLogger('dogstatsd')
 
 
 class Server(object):
     """
-    A statsd udp server.
+    A statsd server, listening on UDP and/or a unix datagram socket.
     """
     UDP_SOCKET_TIMEOUT = 5
+    # Transports
+    UDP = 'udp'
+    UDS = 'uds'
+    TRANSPORT_STATS = {
+        UDP: 'udp_datagrams',
+        UDS: 'uds_datagrams',
+    }
+    # Datagrams the ring buffer had no room for, by transport
+    TRANSPORT_RING_DROP_STATS = {
+        UDP: 'udp_datagrams_ring_dropped',
+        UDS: 'uds_datagrams_ring_dropped',
+    }
+    # Maximum number of datagrams drained from the socket on a single wake-up
+    RECV_BATCH_SIZE = 64
 
-    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None):
+    def __init__(self, aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None,
+                 recv_batch_size=None, reuse_port=False, socket_path=None, socket_rcvbuf=None,
+                 ring_buffer_size=None, ring_overflow_policy=RingBuffer.DROP_NEWEST, consumers=1):
         self.sockaddr = None
         self.socket = None
+        self.unix_socket = None
         self.aggregator = aggregator
+        self.stats = aggregator.stats
         self.host = host
         self.port = port
         self.buffer_size = 1024 * 8
         self.so_rcvbuf = so_rcvbuf
+        self.reuse_port = reuse_port
+        self.socket_path = socket_path
+        self.socket_rcvbuf = socket_rcvbuf
+        self.recv_batch_size = int(recv_batch_size or self.RECV_BATCH_SIZE)
+        self.batch_size_max = 0
+        # Whether the ring buffer dropped datagrams of the last batch, to log
+        # when it starts and stops rather than on every batch
+        self.ring_full = False
+
+        # Pool of receive buffers, allocated once and reused on every wake-up
+        self._recv_views = [memoryview(bytearray(self.buffer_size)) for _ in range(self.recv_batch_size)]
+
+        # When a ring buffer is configured the receive thread only queues
+        # datagrams, parsing and aggregation happen in the consumer threads.
+        self.ring = None
+        self.consumers = []
+        if ring_buffer_size:
+            self.ring = RingBuffer(ring_buffer_size, ring_overflow_policy or RingBuffer.DROP_NEWEST,
+                                   stats=self.stats)
+            aggregator_lock = Lock()
+            self.consumers = [PacketConsumer(self.ring, aggregator, aggregator_lock)
+                              for _ in range(max(int(consumers or 1), 1))]
 
         self.running = Event()
 
@@ -52,29 +96,31 @@ class Server(object):
             except Exception:
                 log.exception("Error while setting up connection to external statsd server")
 
-    def start(self):
-        """
-        Run the server.
-        """
+    def open_udp_socket(self):
         ipv4_only = not ipv6_support()
         addr_family = socket.AF_INET if ipv4_only else socket.AF_INET6
 
-        self.socket = socket.socket(addr_family, socket.SOCK_DGRAM)
+        udp_socket = socket.socket(addr_family, socket.SOCK_DGRAM)
         if not ipv4_only:
             # Configure the socket so that it accepts connections from both
             # IPv4 and IPv6 networks in a portable manner.
-            self.socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
+            udp_socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
 
         # Set SO_RCVBUF on the socket if a specific value has been
         # configured.
         if self.so_rcvbuf is not None:
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
 
-        self.socket.setblocking(0)
+        # Let several workers bind the same address, the kernel balances
+        # datagrams across their sockets.
+        if self.reuse_port:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        udp_socket.setblocking(0)
         try:
             # let's get the sockaddr
             self.sockaddr = get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only)
-            self.socket.bind(self.sockaddr)
+            udp_socket.bind(self.sockaddr)
         except TypeError:
             log.error('Unable to start Dogstatsd server loop, exiting...')
             raise
@@ -83,12 +129,59 @@ class Server(object):
             raise
 
         log.info('Listening on socket address: %s', str(self.sockaddr))
+        return udp_socket
+
+    def open_unix_socket(self):
+        # A stale socket file is left behind if the previous run crashed.
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise OSError('{} exists and is not a socket'.format(self.socket_path))
+            os.unlink(self.socket_path)
+
+        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if self.socket_rcvbuf is not None:
+            unix_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.socket_rcvbuf))
+
+        unix_socket.setblocking(0)
+        try:
+            unix_socket.bind(self.socket_path)
+            # any local user may write to the socket
+            os.chmod(self.socket_path, 0o722)
+        except socket.error as e:
+            log.warn('unable to bind to unix socket (%s): %s', self.socket_path, e)
+            unix_socket.close()
+            raise
+
+        log.info('Listening on unix socket: %s', self.socket_path)
+        return unix_socket
+
+    def start(self):
+        """
+        Run the server.
+        """
+        listeners = {}
+        try:
+            if self.port:
+                self.socket = self.open_udp_socket()
+                listeners[self.socket] = self.UDP
+            if self.socket_path:
+                self.unix_socket = self.open_unix_socket()
+                listeners[self.unix_socket] = self.UDS
+        except Exception:
+            self.close(listeners)
+            raise
+
+        if not listeners:
+            raise OSError('No dogstatsd listener configured, set a port or a socket path')
+
+        for consumer in self.consumers:
+            consumer.start()
 
         # Inline variables for quick look-up.
-        buffer_size = self.buffer_size
-        aggregator_submit = self.aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        aggregator_submit = self.aggregator.submit_packets_batch
+        ring = self.ring
+        socks = list(listeners)
+        drain = self.drain
         select_select = select.select
         select_error = select.error
         timeout = self.UDP_SOCKET_TIMEOUT
@@ -96,16 +189,25 @@ class Server(object):
         forward_udp_sock = self.forward_udp_sock
 
         # Run our select loop.
-        message = None
+        batch = None
         while not self.running.is_set():
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
+                ready = select_select(socks, [], [], timeout)
+                for sock in ready[0]:
+                    batch = drain(sock)
+                    if not batch:
+                        continue
 
                     if should_forward:
-                        forward_udp_sock.send(message)
+                        for datagram in batch:
+                            forward_udp_sock.send(datagram)
+
+                    if ring is not None:
+                        # copy out of the receive buffers, they're reused on the next wake-up
+                        ring_dropped = ring.put_many([bytes(datagram) for datagram in batch])
+                        self.update_batch_stats(listeners[sock], len(batch), 0, ring_dropped)
+                    else:
+                        self.update_batch_stats(listeners[sock], len(batch), aggregator_submit(batch))
             except select_error as se:
                 # Ignore interrupted system calls from sigterm.
                 errno = se.args[0]
@@ -114,7 +216,62 @@ class Server(object):
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
-                log.debug('Error receiving datagram `%s`', message)
+                log.debug('Error receiving datagram batch `%s`', batch)
+
+        self.close(listeners)
+
+        if ring is not None:
+            # consumers drain whatever is left before exiting
+            ring.close()
+            for consumer in self.consumers:
+                consumer.join(self.UDP_SOCKET_TIMEOUT)
+
+    def close(self, listeners):
+        for sock in listeners:
+            sock.close()
+        if self.unix_socket is not None:
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+            self.unix_socket = None
+
+    def drain(self, sock):
+        """
+        Receive every datagram ready on the socket, up to `recv_batch_size`,
+        into the reusable buffer pool. Returns a list of memoryviews that are
+        only valid until the next call.
+        """
+        recv_into = sock.recv_into
+        batch = []
+        for view in self._recv_views:
+            try:
+                nbytes = recv_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            batch.append(view[:nbytes])
+
+        return batch
+
+    def update_batch_stats(self, transport, batch_size, dropped, ring_dropped=0):
+        stats = self.stats
+        stats.inc_stat('datagrams_received', batch_size)
+        stats.inc_stat(self.TRANSPORT_STATS[transport], batch_size)
+        stats.inc_stat('datagram_batches', 1)
+        stats.set_stat('datagram_batch_size', batch_size)
+        if batch_size > self.batch_size_max:
+            self.batch_size_max = batch_size
+            stats.set_stat('datagram_batch_size_max', batch_size)
+        if dropped:
+            stats.inc_stat('datagrams_dropped', dropped)
+        if ring_dropped:
+            stats.inc_stat(self.TRANSPORT_RING_DROP_STATS[transport], ring_dropped)
+            if not self.ring_full:
+                log.warning('The ring buffer is full, %s datagrams are dropped until it drains', transport)
+                self.ring_full = True
+        elif self.ring_full:
+            log.info('The ring buffer has room again, %s datagrams are queued', transport)
+            self.ring_full = False
 
     def stop(self):
         self.running.set()
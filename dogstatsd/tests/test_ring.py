@@ -0,0 +1,61 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from threading import Lock
+
+import pytest
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd.ring import PacketConsumer, RingBuffer
+from utils.stats import Stats
+
+
+def test_ring_fifo():
+    ring = RingBuffer(4)
+    assert ring.put_many([b'a', b'b', b'c']) == 0
+    assert ring.get_many(2) == [b'a', b'b']
+    assert ring.put_many([b'd', b'e', b'f']) == 0
+    assert len(ring) == 4
+    assert ring.get_many(10) == [b'c', b'd', b'e', b'f']
+    assert ring.get_many(10, timeout=0.01) == []
+    assert ring.high_water == 4
+
+
+def test_ring_drop_newest():
+    stats = Stats()
+    ring = RingBuffer(3, RingBuffer.DROP_NEWEST, stats=stats)
+    assert ring.put_many([b'a', b'b', b'c', b'd', b'e']) == 2
+    assert ring.get_many(10) == [b'a', b'b', b'c']
+    assert ring.dropped == 2
+    assert stats.get_stat('ring_dropped') == 2
+    assert stats.get_stat('ring_depth_high_water') == 3
+
+
+def test_ring_drop_oldest():
+    ring = RingBuffer(3, RingBuffer.DROP_OLDEST)
+    assert ring.put_many([b'a', b'b', b'c', b'd', b'e']) == 2
+    assert ring.get_many(10) == [b'c', b'd', b'e']
+    assert ring.dropped == 2
+
+
+def test_ring_invalid_policy():
+    with pytest.raises(ValueError):
+        RingBuffer(3, 'drop-everything')
+
+
+def test_consumer():
+    aggregator = MetricsBucketAggregator('myhost')
+    ring = RingBuffer(16)
+    consumer = PacketConsumer(ring, aggregator, Lock())
+    consumer.start()
+
+    ring.put_many([b'my.counter:1|c\nmy.gauge:1|g', b'my.counter:bad|c', b'my.counter:1|c'])
+    ring.close()
+    consumer.join(5)
+
+    # everything queued before close is consumed
+    assert not consumer.is_alive()
+    assert aggregator.packet_count == 4
+    assert aggregator.stats.get_stat('datagrams_dropped') == 1
@@ -0,0 +1,118 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import os
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from aggregator import MetricsBucketAggregator
+from dogstatsd import Server
+
+
+@pytest.fixture
+def udp_pair():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(0)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(receiver.getsockname())
+    yield receiver, sender
+    receiver.close()
+    sender.close()
+
+
+def test_drain_batch(udp_pair):
+    receiver, sender = udp_pair
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, recv_batch_size=4)
+
+    for i in range(6):
+        sender.send('metric.{}:1|c'.format(i).encode('utf-8'))
+    # loopback delivery is quick but not synchronous
+    time.sleep(0.1)
+
+    batch = server.drain(receiver)
+    assert [bytes(d) for d in batch] == [b'metric.0:1|c', b'metric.1:1|c', b'metric.2:1|c', b'metric.3:1|c']
+
+    # the buffer pool is reused on the next wake-up
+    batch = server.drain(receiver)
+    assert [bytes(d) for d in batch] == [b'metric.4:1|c', b'metric.5:1|c']
+    assert server.drain(receiver) == []
+
+
+def test_submit_batch_stats():
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0)
+
+    batch = [memoryview(b'metric.a:1|c'), memoryview(b'metric.b:not_a_number|c'), memoryview(b'metric.c:1|g')]
+    dropped = aggregator.submit_packets_batch(batch)
+    server.update_batch_stats(Server.UDP, len(batch), dropped)
+    server.update_batch_stats(Server.UDS, 1, 0)
+
+    assert dropped == 1
+    assert aggregator.packet_count == 3
+    assert aggregator.stats.get_stat('datagrams_received') == 4
+    assert aggregator.stats.get_stat('datagram_batches') == 2
+    assert aggregator.stats.get_stat('datagram_batch_size') == 1
+    assert aggregator.stats.get_stat('datagram_batch_size_max') == 3
+    assert aggregator.stats.get_stat('datagrams_dropped') == 1
+    assert aggregator.stats.get_stat('udp_datagrams') == 3
+    assert aggregator.stats.get_stat('uds_datagrams') == 1
+
+
+def test_ring_dropped_stats(caplog):
+    aggregator = MetricsBucketAggregator('myhost')
+    server = Server(aggregator, '127.0.0.1', 0, ring_buffer_size=2)
+
+    dropped = server.ring.put_many([b'metric.a:1|c', b'metric.b:1|c', b'metric.c:1|c'])
+    server.update_batch_stats(Server.UDP, 3, 0, dropped)
+    server.update_batch_stats(Server.UDS, 2, 0, 2)
+    assert server.ring_full
+    assert len([r for r in caplog.records if r.levelname == 'WARNING']) == 1
+    server.update_batch_stats(Server.UDP, 1, 0, 0)
+    assert not server.ring_full
+
+    assert dropped == 1
+    assert aggregator.stats.get_stat('udp_datagrams_ring_dropped') == 1
+    assert aggregator.stats.get_stat('uds_datagrams_ring_dropped') == 2
+    assert aggregator.stats.get_stat('datagrams_dropped') == 0
+
+def test_unix_socket(tmpdir):
+    socket_path = str(tmpdir.join('dsd.socket'))
+    aggregator = MetricsBucketAggregator('myhost')
+    # UDP disabled
+    server = Server(aggregator, '127.0.0.1', 0, socket_path=socket_path, socket_rcvbuf=1 << 16)
+    server.UDP_SOCKET_TIMEOUT = 0.1
+
+    runner = Thread(target=server.start)
+    runner.start()
+    try:
+        deadline = time.time() + 2
+        while not os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.01)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.connect(socket_path)
+        client.send(b'my.counter:1|c\nmy.gauge:2|g')
+        client.send(b'my.counter:1|c')
+        client.close()
+
+        deadline = time.time() + 2
+        while aggregator.packet_count < 3 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        server.stop()
+        runner.join(2)
+
+    assert not runner.is_alive()
+    assert server.socket is None
+    assert aggregator.packet_count == 3
+    assert aggregator.stats.get_stat('uds_datagrams') == 2
+    assert aggregator.stats.get_stat('udp_datagrams') == 0
+    # the socket file is cleaned up on stop
+    assert not os.path.exists(socket_path)
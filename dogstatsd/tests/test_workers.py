@@ -0,0 +1,249 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import multiprocessing
+import socket
+import time
+from threading import Thread
+
+import pytest
+from mock import patch
+
+from aggregator import MetricsBucketAggregator
+from aggregator.formatters import api_formatter
+from aggregator.interning import get_context_registry, get_tag_registry
+from dogstatsd import Server
+from aggregator.sketch import DDSketch
+from dogstatsd.reporter import merge_series, merge_sketches, merge_states
+from dogstatsd.workers import FLUSH, STOP, ShardedAggregator, WorkerPool, run_worker
+
+
+def test_merge_series():
+    shard1 = [
+        api_formatter('my.counter', 2, 10, ('a:b',), 'myhost', 'rate', 10),
+        api_formatter('my.gauge', 1, 10, None, 'myhost', 'gauge', 10),
+        api_formatter('my.count', 3, 10, None, 'myhost', 'count', 10),
+    ]
+    shard2 = [
+        api_formatter('my.counter', 0.5, 10, ('a:b',), 'myhost', 'rate', 10),
+        api_formatter('my.counter', 1, 10, ('c:d',), 'myhost', 'rate', 10),
+        api_formatter('my.gauge', 7, 10, None, 'myhost', 'gauge', 10),
+        api_formatter('my.count', 4, 10, None, 'otherhost', 'count', 10),
+    ]
+
+    merged = {(m['metric'], m['tags'], m['host']): m['points'][0][1] for m in merge_series([shard1, shard2])}
+    assert merged == {
+        ('my.counter', ('a:b',), 'myhost'): 2.5,
+        ('my.counter', ('c:d',), 'myhost'): 1,
+        ('my.gauge', None, 'myhost'): 7,
+        ('my.count', None, 'myhost'): 3,
+        ('my.count', None, 'otherhost'): 4,
+    }
+
+    # The zeros of idle counters are merged point by point
+    zeros = api_formatter('my.counter', 0.0, 10, ('c:d',), 'myhost', 'rate', 10)
+    zeros['points'] = [(10, 0.0), (20, 0.0)]
+    merged = merge_series([[zeros], shard2])
+    assert sorted(m['points'] for m in merged if m['tags'] == ('c:d',)) == [[(10, 1)], [(20, 0.0)]]
+
+
+def flush_shards(*shards, **config):
+    """
+    Flushes an aggregator per shard of (sample time, packet) and merges them,
+    and flushes an aggregator of all the packets
+    """
+    clock = [0]
+    aggregators = [MetricsBucketAggregator('myhost', interval=10, **config) for _ in range(len(shards) + 1)]
+    with patch('aggregator.aggregator.time', lambda: clock[0]):
+        for aggregator, packets in zip(aggregators, shards + (sorted(sum(shards, [])),)):
+            for clock[0], packet in packets:
+                aggregator.submit_packets(packet)
+
+        clock[0] = 200
+        for aggregator in aggregators[:-1]:
+            aggregator.keep_states()
+        merged = merge_series([aggregator.flush() for aggregator in aggregators[:-1]]) + \
+            merge_states([aggregator.flush_states() for aggregator in aggregators[:-1]], 10)
+        expected = aggregators[-1].flush()
+    return ({(m['metric'], m['type']): m['points'] for m in merged},
+            {(m['metric'], m['type']): m['points'] for m in expected})
+
+
+def test_merge_shards():
+    merged, expected = flush_shards(
+        [(1, b'my.counter:2|c'), (2, b'my.count:1|c'), (5, b'my.gauge:7|g')],
+        [(3, b'my.counter:3|c'), (3, b'my.gauge:1|g')],
+    )
+    # Counters add up, gauges keep the value sampled last
+    assert merged == expected
+    assert merged[(b'my.gauge', 'gauge')] == [(0, 7)]
+
+
+@pytest.mark.parametrize('backend', ['exact', 'sketch', 'reservoir'])
+def test_merge_histogram_shards(backend):
+    merged, expected = flush_shards(
+        [(1, b'my.histogram:%d|h' % i) for i in (1, 2, 3)],
+        [(2, b'my.histogram:%d|h' % i) for i in (10, 20)],
+        histogram_backend=backend, histogram_aggregates=['max', 'min', 'median', 'avg', 'sum', 'count'],
+        histogram_percentiles=[0.5, 0.95],
+    )
+    # The aggregates are those of the samples of every shard
+    assert merged == expected
+    assert merged[(b'my.histogram.median', 'gauge')][0][1] == pytest.approx(3, rel=0.01)
+
+
+@pytest.mark.parametrize('backend', ['exact', 'hll'])
+def test_merge_set_shards(backend):
+    merged, expected = flush_shards(
+        [(1, b'my.set:a|s'), (1, b'my.set:b|s')],
+        [(2, b'my.set:b|s'), (2, b'my.set:c|s'), (2, b'my.set:d|s')],
+        set_backend=backend,
+    )
+    assert merged == expected
+    assert merged[(b'my.set', 'gauge')][0][1] == pytest.approx(4, rel=0.05)
+
+
+def test_merge_stats():
+    aggregator = ShardedAggregator('myhost', [])
+    aggregator._merge_stats([
+        {'stats': {'metrics': 10, 'ring_depth_high_water': 5, 'context_cache_size': 100,
+                   'datagram_batch_size': 2, 'datagram_batches': 30, 'datagram_batch_size_max': 8}},
+        {'stats': {'metrics': 20, 'ring_depth_high_water': 7, 'context_cache_size': 50,
+                   'datagram_batch_size': 6, 'datagram_batches': 10, 'datagram_batch_size_max': 6}},
+    ])
+    stats = aggregator.stats
+    assert stats.get_stat('metrics') == 30
+    assert stats.get_stat('datagram_batches') == 40
+    # high-water marks and sizes are the largest of the workers'
+    assert stats.get_stat('ring_depth_high_water') == 7
+    assert stats.get_stat('context_cache_size') == 100
+    assert stats.get_stat('datagram_batch_size_max') == 8
+    # batch sizes are averaged over the batches of every worker
+    assert stats.get_stat('datagram_batch_size') == 3
+
+
+def test_merge_sketches():
+    sketches = [DDSketch() for _ in range(3)]
+    for i, sketch in enumerate(sketches):
+        sketch.add(i)
+    shard1 = [api_formatter('my.dist', sketches[0], 10, ('a:b',), 'myhost', 'distribution', 10)]
+    shard2 = [
+        api_formatter('my.dist', sketches[1], 10, ('a:b',), 'myhost', 'distribution', 10),
+        api_formatter('my.dist', sketches[2], 20, ('a:b',), 'myhost', 'distribution', 10),
+    ]
+
+    merged = {m['points'][0][0]: m['points'][0][1].count for m in merge_sketches([shard1, shard2])}
+    assert merged == {10: 2, 20: 1}
+
+
+class PacketServer(object):
+    """ Server submitting a tagged packet, then idle until stopped """
+    UDP_SOCKET_TIMEOUT = 1
+    PACKET = b'my.counter:1|c|#env:prod'
+
+    def __init__(self, aggregator, reuse_port=False, unix_socket=True):
+        self.aggregator = aggregator
+        self.running = multiprocessing.Event()
+
+    def start(self):
+        self.aggregator.submit_packets(self.PACKET)
+        self.running.wait()
+
+    def stop(self):
+        self.running.set()
+
+
+def test_worker_forked_registries():
+    def aggregator_factory():
+        return MetricsBucketAggregator('myhost', interval=1)
+
+    # forked while other threads hold the registries of the parent
+    parent_conn, child_conn = multiprocessing.get_context('fork').Pipe()
+    process = multiprocessing.get_context('fork').Process(
+        target=run_worker, args=(child_conn, aggregator_factory, PacketServer, False))
+    process.daemon = True
+    with get_tag_registry()._lock, get_context_registry()._lock:
+        process.start()
+    try:
+        time.sleep(1.1)
+        parent_conn.send((FLUSH, 1))
+        assert parent_conn.poll(5), 'worker deadlocked on the registries of its parent'
+        reply = parent_conn.recv()
+        assert [(m['metric'], m['tags']) for m in reply['series']] == [(b'my.counter', (b'env:prod',))]
+        parent_conn.send((STOP, None))
+        process.join(5)
+        assert process.exitcode == 0
+    finally:
+        if process.is_alive():
+            process.kill()
+
+
+class GaugePacketServer(PacketServer):
+    PACKET = b'my.gauge:1|g|#env:prod'
+
+
+def test_worker_expired_contexts():
+    def aggregator_factory():
+        return MetricsBucketAggregator('myhost', interval=1, context_cache_size=0)
+
+    parent_conn, child_conn = multiprocessing.get_context('fork').Pipe()
+    process = multiprocessing.get_context('fork').Process(
+        target=run_worker, args=(child_conn, aggregator_factory, GaugePacketServer, False))
+    process.daemon = True
+    process.start()
+    try:
+        time.sleep(1.1)
+        aggregator = ShardedAggregator('myhost', [parent_conn])
+        expired = []
+        aggregator.on_context_expiry(expired.append)
+        # the gauge's context is released once flushed
+        assert [m['metric'] for m in aggregator.flush()] == [b'my.gauge']
+        assert expired == [(b'my.gauge', (b'env:prod',), 'myhost')]
+        parent_conn.send((STOP, None))
+        process.join(5)
+    finally:
+        if process.is_alive():
+            process.kill()
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_REUSEPORT'), reason='SO_REUSEPORT not supported')
+def test_worker_pool():
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    def aggregator_factory():
+        return MetricsBucketAggregator('myhost', interval=1)
+
+    def server_factory(aggregator, reuse_port=False, unix_socket=True):
+        return Server(aggregator, '127.0.0.1', port, reuse_port=reuse_port)
+
+    pool = WorkerPool(2, 'myhost', aggregator_factory, server_factory)
+    runner = Thread(target=pool.start)
+    runner.start()
+    try:
+        time.sleep(0.5)
+        # several source ports so the kernel spreads them across workers
+        for i in range(8):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(b'my.counter:1|c\nmy.gauge:1|g\nmy.count:1|c|T%d' % time.time(), ('127.0.0.1', port))
+            sender.close()
+        time.sleep(1.2)
+
+        pool.aggregator.send_packet_count('datadog.dogstatsd.packet.count')
+        series = {m['metric']: m for m in pool.aggregator.flush()}
+        assert series[b'my.counter']['points'][0][1] == 8
+        assert series[b'my.gauge']['points'][0][1] == 1
+        assert series['datadog.dogstatsd.packet.count']['points'][0][1] == 24
+        assert pool.aggregator.stats.get_stat('workers_flushed') == 2
+        assert pool.aggregator.stats.get_stat('metrics') == 24
+        assert len(pool.aggregator.flush_timestamped()) == 8
+        assert pool.aggregator.stats.get_stat('timestamped_metrics') == 8
+    finally:
+        pool.stop()
+        runner.join(10)
+
+    assert not runner.is_alive()
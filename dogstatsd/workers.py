@@ -0,0 +1,284 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import logging
+import multiprocessing
+import signal
+from collections import defaultdict, deque
+from threading import Event, Lock, Thread
+from time import time
+
+from aggregator.formatters import api_formatter
+from aggregator.interning import reset_registries
+from aggregator.limits import merge_offenders
+from aggregator.types import MetricTypes
+from utils.stats import Stats
+
+from .reporter import merge_series, merge_sketches, merge_states
+
+log = logging.getLogger('dogstatsd')
+
+# Commands sent to the workers over their pipe
+FLUSH = 'flush'
+STOP = 'stop'
+
+# Stats of the workers merged by their max rather than summed: high-water
+# marks and sizes
+MAX_STAT_SUFFIXES = ('_max', '_high_water', '_size')
+# Stats averaged over the workers, weighted by another of their stats
+WEIGHTED_STATS = {
+    'datagram_batch_size': 'datagram_batches',
+}
+
+
+def run_worker(conn, aggregator_factory, server_factory, unix_socket):
+    """
+    Entry point of a dogstatsd worker process: runs its own server and
+    bucket aggregator, flushing it whenever the parent asks for it. Gauges,
+    histograms and sets are sent as their state, to be merged with the ones
+    of the other workers.
+    """
+    # Shutdown is driven by the parent through the pipe.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The registries of the parent, forked, may be held by its other threads
+    reset_registries()
+    aggregator = aggregator_factory()
+    aggregator.keep_states()
+    # Appended to by ingestion, drained by the flushes
+    expired_contexts = deque()
+    aggregator.on_context_expiry(expired_contexts.append)
+    server = server_factory(aggregator, reuse_port=True, unix_socket=unix_socket)
+    listener = Thread(target=server.start)
+    listener.daemon = True
+    listener.start()
+
+    try:
+        while listener.is_alive():
+            if not conn.poll(1):
+                continue
+
+            command, flush_id = conn.recv()
+            if command == STOP:
+                break
+            elif command == FLUSH:
+                packet_count = aggregator.packets_since_flush()
+                reply = {
+                    'flush_id': flush_id,
+                    'series': aggregator.flush(),
+                    'states': aggregator.flush_states(),
+                    'interval': aggregator.interval,
+                    'events': aggregator.flush_events(),
+                    'service_checks': aggregator.flush_service_checks(),
+                    'timestamped_series': aggregator.flush_timestamped(),
+                    'sketches': aggregator.flush_sketches(),
+                    'packet_count': packet_count,
+                    'expired_contexts': [expired_contexts.popleft() for _ in range(len(expired_contexts))],
+                }
+                reply['stats'], reply['info'] = aggregator.stats.snapshot()
+                conn.send(reply)
+    except (EOFError, OSError):
+        # the parent went away
+        pass
+    finally:
+        server.stop()
+        listener.join(server.UDP_SOCKET_TIMEOUT)
+
+
+class ShardedAggregator(object):
+    """
+    Aggregator facade over the bucket aggregators of the dogstatsd workers.
+    Flushing it flushes every shard and merges their series and the states
+    of their gauges, histograms and sets by context.
+    """
+    FLUSH_TIMEOUT = 5
+
+    def __init__(self, hostname, conns):
+        self.hostname = hostname
+        self.stats = Stats()
+        self._conns = conns
+        self._conns_lock = Lock()
+        self._flush_id = 0
+        self._events = []
+        self._service_checks = []
+        self._timestamped_series = []
+        self._sketches = []
+        self._packet_count_metric = None
+        self._context_expiry_callbacks = []
+
+    def on_context_expiry(self, callback):
+        """ Registers `callback`, called with the contexts expired by the shards, see `Aggregator.on_context_expiry` """
+        self._context_expiry_callbacks.append(callback)
+
+    def send_packet_count(self, metric_name):
+        # the shards' packet counts are only known once they've been flushed
+        self._packet_count_metric = metric_name
+
+    def _flush_shards(self):
+        replies = []
+        with self._conns_lock:
+            self._flush_id += 1
+            for conn in self._conns:
+                try:
+                    conn.send((FLUSH, self._flush_id))
+                except (OSError, ValueError) as e:
+                    log.warning("Unable to flush dogstatsd worker: %s", e)
+
+            for conn in self._conns:
+                try:
+                    while conn.poll(self.FLUSH_TIMEOUT):
+                        reply = conn.recv()
+                        # discard late replies to a previous flush
+                        if reply['flush_id'] == self._flush_id:
+                            replies.append(reply)
+                            break
+                    else:
+                        log.warning("Timed out flushing a dogstatsd worker")
+                except (EOFError, OSError, ValueError) as e:
+                    log.warning("Unable to flush dogstatsd worker: %s", e)
+
+        return replies
+
+    def _merge_stats(self, replies):
+        totals = defaultdict(int)
+        weights = defaultdict(int)
+        for reply in replies:
+            stats = reply['stats']
+            for key, value in stats.items():
+                if key in WEIGHTED_STATS:
+                    weight = stats.get(WEIGHTED_STATS[key], 0)
+                    totals[key] += value * weight
+                    weights[key] += weight
+                elif key.endswith(MAX_STAT_SUFFIXES):
+                    totals[key] = max(totals[key], value)
+                else:
+                    totals[key] += value
+        for key, weight in weights.items():
+            totals[key] = totals[key] / float(weight) if weight else 0
+
+        for key, value in totals.items():
+            self.stats.set_stat(key, value)
+        self.stats.set_stat('workers_flushed', len(replies))
+
+        offenders = [reply['info']['context_limit_offenders'] for reply in replies
+                     if 'context_limit_offenders' in reply.get('info', {})]
+        if offenders:
+            self.stats.set_info('context_limit_offenders', [list(offender) for offender in merge_offenders(offenders)])
+
+    def flush(self):
+        replies = self._flush_shards()
+
+        series = merge_series([reply['series'] for reply in replies])
+        if replies:
+            series += merge_states([reply['states'] for reply in replies], replies[0]['interval'])
+        for reply in replies:
+            # Another shard may still track the context, which costs nothing but a cache miss
+            for context in reply['expired_contexts']:
+                for callback in self._context_expiry_callbacks:
+                    callback(context)
+            self._events.extend(reply['events'])
+            self._service_checks.extend(reply['service_checks'])
+            self._timestamped_series.extend(reply['timestamped_series'])
+        self._sketches.extend(merge_sketches([reply['sketches'] for reply in replies]))
+
+        if self._packet_count_metric:
+            series.append(api_formatter(
+                metric=self._packet_count_metric,
+                value=sum(reply['packet_count'] for reply in replies),
+                timestamp=int(time()),
+                tags=None,
+                hostname=self.hostname,
+                metric_type=MetricTypes.GAUGE,
+            ))
+            self._packet_count_metric = None
+
+        self._merge_stats(replies)
+        return series
+
+    def flush_events(self):
+        events = self._events
+        self._events = []
+        return events
+
+    def flush_service_checks(self):
+        service_checks = self._service_checks
+        self._service_checks = []
+        return service_checks
+
+    def flush_sketches(self):
+        sketches = self._sketches
+        self._sketches = []
+        return sketches
+
+    def flush_timestamped(self):
+        timestamped_series = self._timestamped_series
+        self._timestamped_series = []
+        return timestamped_series
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                try:
+                    conn.send((STOP, None))
+                except (OSError, ValueError):
+                    pass
+                conn.close()
+
+
+class WorkerPool(object):
+    """
+    Runs N dogstatsd workers, each one in its own process with its own
+    SO_REUSEPORT socket and bucket aggregator, so that ingestion isn't
+    bound to a single core. Exposes the same start/stop interface as
+    `Server` and a sharded `aggregator` for the reporter to flush.
+    """
+    JOIN_TIMEOUT = 5
+
+    def __init__(self, workers, hostname, aggregator_factory, server_factory):
+        context = multiprocessing.get_context('fork')
+        self._processes = []
+        conns = []
+        for i in range(workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=run_worker,
+                name='dogstatsd-worker-{}'.format(i),
+                # a unix socket can't be shared, the first worker owns it
+                args=(child_conn, aggregator_factory, server_factory, i == 0),
+            )
+            process.daemon = True
+            self._processes.append(process)
+            conns.append(parent_conn)
+
+        self.aggregator = ShardedAggregator(hostname, conns)
+        self.running = Event()
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        log.info('Started %s dogstatsd workers', len(self._processes))
+
+        while not self.running.is_set():
+            self.running.wait(1)
+            for process in self._processes:
+                if process.exitcode is not None and not self.running.is_set():
+                    self.stop()
+                    raise OSError('dogstatsd worker {} exited with code {}'.format(process.name, process.exitcode))
+
+    def stop(self):
+        if self.running.is_set():
+            return
+        self.running.set()
+
+        self.aggregator.close()
+        for process in self._processes:
+            if process.pid is None:
+                continue
+            process.join(self.JOIN_TIMEOUT)
+            if process.is_alive():
+                log.error("Could not stop dogstatsd worker '%s', terminating it", process.name)
+                process.terminate()
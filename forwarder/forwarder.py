@@ -19,7 +19,9 @@ class Forwarder(object):
 
     V1_ENDPOINT = "/intake/"
     V1_SERIES_ENDPOINT = "/api/v1/series"
+    V2_SERIES_ENDPOINT = "/api/v2/series"
     V1_SERVICE_CHECKS_ENDPOINT = "/api/v1/check_run"
+    SKETCHES_ENDPOINT = "/api/beta/sketches"
 
     DD_API_HEADER = "DD-API-KEY"
 
@@ -100,10 +102,30 @@ class Forwarder(object):
     # --------------------------------------------------------------------------
     # Public submission helpers
     # --------------------------------------------------------------------------
+    def stream_compressor(self):
+        """
+        Return a compressor to stream a payload into, None when payloads
+        aren't compressed. Its payload is submitted with its Content-Encoding.
+        """
+        return get_shared_requests().stream_compressor()
+
+    def record_payload_splits(self, kind, splits, dropped=0):
+        """
+        Count the extra payloads a flush of `kind` (series, service_check,
+        intake...) was split into to fit the intake limits, and the items
+        dropped for being too large still.
+        """
+        self.stats.inc_stat("{}_payload_splits".format(kind), splits)
+        self.stats.inc_stat("{}_payload_items_dropped".format(kind), dropped)
+
     def submit_v1_series(self, payload, extra_headers=None):
         self.stats.inc_stat("series_payloads", 1)
         self._submit_payload(self.V1_SERIES_ENDPOINT, payload, extra_headers)
 
+    def submit_v2_series(self, payload, extra_headers=None):
+        self.stats.inc_stat("series_payloads", 1)
+        self._submit_payload(self.V2_SERIES_ENDPOINT, payload, extra_headers)
+
     def submit_v1_intake(self, payload, extra_headers=None):
         self.stats.inc_stat("intake_payloads", 1)
         self._submit_payload(self.V1_ENDPOINT, payload, extra_headers)
@@ -112,3 +134,7 @@ class Forwarder(object):
         self.stats.inc_stat("service_check_payloads", 1)
         self._submit_payload(
             self.V1_SERVICE_CHECKS_ENDPOINT, payload, extra_headers)
+
+    def submit_sketches(self, payload, extra_headers=None):
+        self.stats.inc_stat("sketch_payloads", 1)
+        self._submit_payload(self.SKETCHES_ENDPOINT, payload, extra_headers)
@@ -84,6 +84,14 @@ def test_submit_v1_series():
     assert t.endpoint == "/api/v1/series"
     assert t.payload == "data"
 
+def test_submit_sketches():
+    f = Forwarder("api_key", DOMAIN, TIMEOUT)
+    f.submit_sketches("data", None)
+    t = get_transaction(f)
+
+    assert t.endpoint == "/api/beta/sketches"
+    assert t.payload == "data"
+
 def test_submit_v1_service_checks():
     f = Forwarder("api_key", DOMAIN, TIMEOUT)
     f.submit_v1_service_checks("data", None)
@@ -91,3 +99,20 @@ def test_submit_v1_service_checks():
 
     assert t.endpoint == "/api/v1/check_run"
     assert t.payload == "data"
+
+def test_record_payload_splits():
+    f = Forwarder("api_key", DOMAIN, TIMEOUT)
+    f.record_payload_splits("series", 2)
+    f.record_payload_splits("series", 1, 3)
+    stats, _ = f.stats.snapshot()
+
+    assert stats["series_payload_splits"] == 3
+    assert stats["series_payload_items_dropped"] == 3
+
+def test_submit_v2_series():
+    f = Forwarder("api_key", DOMAIN, TIMEOUT)
+    f.submit_v2_series(b"data", None)
+    t = get_transaction(f)
+
+    assert t.endpoint == "/api/v2/series"
+    assert t.payload == b"data"
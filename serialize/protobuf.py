@@ -0,0 +1,210 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Encoders of the series in the protobuf `MetricPayload` of the v2 series API
+and of the distributions in the `SketchPayload` of the sketches API, written
+by hand so that they need no protobuf runtime:
+
+    message MetricPayload {
+      enum MetricType { UNSPECIFIED = 0; COUNT = 1; RATE = 2; GAUGE = 3; }
+      message MetricPoint { double value = 1; int64 timestamp = 2; }
+      message Resource { string type = 1; string name = 2; }
+      message MetricSeries {
+        repeated Resource resources = 1;
+        string metric = 2;
+        repeated string tags = 3;
+        repeated MetricPoint points = 4;
+        MetricType type = 5;
+        string unit = 6;
+        string source_type_name = 7;
+        int64 interval = 8;
+      }
+      repeated MetricSeries series = 1;
+    }
+
+    message SketchPayload {
+      message Sketch {
+        message Dogsketch {
+          int64 ts = 1; int64 cnt = 2;
+          double min = 3; double max = 4; double avg = 5; double sum = 6;
+          repeated sint32 k = 7; repeated uint32 n = 8;
+        }
+        string metric = 1;
+        string host = 2;
+        repeated string tags = 4;
+        repeated Dogsketch dogsketches = 7;
+      }
+      repeated Sketch sketches = 1;
+    }
+
+A payload being a repeated field, encoded series and sketches are simply
+concatenated.
+"""
+
+import struct
+from functools import lru_cache
+
+from aggregator.types import MetricTypes
+from utils.unicode import ENCODING
+
+# Wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+
+METRIC_TYPES = {
+    MetricTypes.COUNT: 1,
+    MetricTypes.RATE: 2,
+    MetricTypes.GAUGE: 3,
+}
+
+_double = struct.Struct('<d').pack
+
+
+def key(field, wire_type):
+    return encode_varint(field << 3 | wire_type)
+
+
+def encode_varint(value):
+    """ Encodes an integer as a varint, negative ones as 64 bits two's complement """
+    if value < 0:
+        value &= 0xFFFFFFFFFFFFFFFF
+    if value < 0x80:
+        return bytes((value,))
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_string(value):
+    if not isinstance(value, bytes):
+        return value.encode(ENCODING)
+    # Strings must be valid UTF-8
+    return value.decode(ENCODING, errors='replace').encode(ENCODING)
+
+
+def encode_length_delimited(field_key, value):
+    return field_key + encode_varint(len(value)) + value
+
+
+# Keys of the fields encoded
+SERIES_KEY = key(1, LENGTH_DELIMITED)
+RESOURCE_KEY = key(1, LENGTH_DELIMITED)
+RESOURCE_TYPE_KEY = key(1, LENGTH_DELIMITED)
+RESOURCE_NAME_KEY = key(2, LENGTH_DELIMITED)
+METRIC_KEY = key(2, LENGTH_DELIMITED)
+TAG_KEY = key(3, LENGTH_DELIMITED)
+POINT_KEY = key(4, LENGTH_DELIMITED)
+TYPE_KEY = key(5, VARINT)
+SOURCE_TYPE_NAME_KEY = key(7, LENGTH_DELIMITED)
+INTERVAL_KEY = key(8, VARINT)
+VALUE_KEY = key(1, FIXED64)
+TIMESTAMP_KEY = key(2, VARINT)
+SKETCH_KEY = key(1, LENGTH_DELIMITED)
+SKETCH_METRIC_KEY = key(1, LENGTH_DELIMITED)
+SKETCH_HOST_KEY = key(2, LENGTH_DELIMITED)
+SKETCH_TAG_KEY = key(4, LENGTH_DELIMITED)
+DOGSKETCH_KEY = key(7, LENGTH_DELIMITED)
+DOGSKETCH_TS_KEY = key(1, VARINT)
+DOGSKETCH_CNT_KEY = key(2, VARINT)
+DOGSKETCH_MIN_KEY = key(3, FIXED64)
+DOGSKETCH_MAX_KEY = key(4, FIXED64)
+DOGSKETCH_AVG_KEY = key(5, FIXED64)
+DOGSKETCH_SUM_KEY = key(6, FIXED64)
+DOGSKETCH_K_KEY = key(7, LENGTH_DELIMITED)
+DOGSKETCH_N_KEY = key(8, LENGTH_DELIMITED)
+
+HOST_RESOURCE_TYPE = encode_length_delimited(RESOURCE_TYPE_KEY, b'host')
+
+
+def encode_series_fields(serie):
+    """
+    Encodes the fields of a `MetricSeries` but its points, from a series as
+    built by `aggregator.formatters.api_formatter`. The host is a resource.
+    """
+    fields = []
+    host = serie.get('host')
+    if host:
+        resource = HOST_RESOURCE_TYPE + encode_length_delimited(RESOURCE_NAME_KEY, encode_string(host))
+        fields.append(encode_length_delimited(RESOURCE_KEY, resource))
+    fields.append(encode_length_delimited(METRIC_KEY, encode_string(serie['metric'])))
+    for tag in serie.get('tags') or ():
+        fields.append(encode_length_delimited(TAG_KEY, encode_string(tag)))
+    metric_type = METRIC_TYPES.get(serie.get('type'))
+    if metric_type:
+        fields.append(TYPE_KEY + encode_varint(metric_type))
+    source_type_name = serie.get('source_type_name')
+    if source_type_name:
+        fields.append(encode_length_delimited(SOURCE_TYPE_NAME_KEY, encode_string(source_type_name)))
+    interval = serie.get('interval')
+    if interval:
+        fields.append(INTERVAL_KEY + encode_varint(int(interval)))
+    return b''.join(fields)
+
+
+@lru_cache(maxsize=1024)
+def encode_timestamp(timestamp):
+    """ Encodes the timestamp field of a point, the same few timestamps being shared by a flush """
+    return TIMESTAMP_KEY + encode_varint(timestamp)
+
+
+def encode_point(timestamp, value):
+    timestamp = encode_timestamp(int(timestamp))
+    # A point is at most 20 bytes long, its length a single byte
+    return POINT_KEY + bytes((9 + len(timestamp),)) + VALUE_KEY + _double(value) + timestamp
+
+
+def encode_points(points):
+    """ Encodes the points of a series as repeated `MetricPoint` fields """
+    if len(points) == 1:
+        return encode_point(*points[0])
+    return b''.join([encode_point(timestamp, value) for timestamp, value in points])
+
+
+def encode_series(fields, points):
+    """ Encodes a `MetricSeries` of a `MetricPayload` from its encoded fields and its points """
+    return encode_length_delimited(SERIES_KEY, fields + encode_points(points))
+
+
+def encode_packed(field_key, values):
+    """ Encodes a packed repeated field of non negative integers """
+    return encode_length_delimited(field_key, b''.join([encode_varint(value) for value in values]))
+
+
+def zigzag(value):
+    """ ZigZag encoding of a sint32 """
+    return (value << 1) ^ (value >> 31)
+
+
+def encode_dogsketch(sketch):
+    """ Encodes a `Dogsketch` from the payload of a sketch, as built by `DDSketch.to_dict` """
+    fields = [
+        DOGSKETCH_TS_KEY + encode_varint(int(sketch['ts'])),
+        DOGSKETCH_CNT_KEY + encode_varint(int(sketch['cnt'])),
+        DOGSKETCH_MIN_KEY + _double(sketch['min']),
+        DOGSKETCH_MAX_KEY + _double(sketch['max']),
+        DOGSKETCH_AVG_KEY + _double(sketch['avg']),
+        DOGSKETCH_SUM_KEY + _double(sketch['sum']),
+    ]
+    if sketch['k']:
+        fields.append(encode_packed(DOGSKETCH_K_KEY, [zigzag(k) for k in sketch['k']]))
+        fields.append(encode_packed(DOGSKETCH_N_KEY, sketch['n']))
+    return b''.join(fields)
+
+
+def encode_sketch(metric, host, tags, sketches):
+    """ Encodes a `Sketch` of a `SketchPayload`, the sketches of a context over time """
+    fields = [encode_length_delimited(SKETCH_METRIC_KEY, encode_string(metric))]
+    if host:
+        fields.append(encode_length_delimited(SKETCH_HOST_KEY, encode_string(host)))
+    for tag in tags or ():
+        fields.append(encode_length_delimited(SKETCH_TAG_KEY, encode_string(tag)))
+    for sketch in sketches:
+        fields.append(encode_length_delimited(DOGSKETCH_KEY, encode_dogsketch(sketch)))
+    return encode_length_delimited(SKETCH_KEY, b''.join(fields))
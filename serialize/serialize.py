@@ -4,19 +4,115 @@
 # Copyright 2018 Datadog, Inc.
 
 import json
-from collections import defaultdict
+import logging
+from collections import defaultdict, deque, namedtuple
 
 from utils.hostname import get_hostname
-from utils.unicode import ensure_unicode
+from utils.stats import Stats
+from utils.http import (
+    MAX_COMPRESSED_SIZE,
+    MAX_SPLIT_DEPTH,
+    MAX_UNCOMPRESSED_SIZE,
+    V2_SERIES_MAX_COMPRESSED_SIZE,
+    V2_SERIES_MAX_UNCOMPRESSED_SIZE,
+)
+from utils.unicode import ENCODING, ensure_unicode
+
+from . import protobuf
+from .worker import SerializerWorker
+
+log = logging.getLogger(__name__)
+
+# Fields of the series built by `aggregator.formatters.api_formatter`
+SERIES_FIELDS = frozenset(['metric', 'points', 'tags', 'host', 'type', 'interval'])
+# Types of the timestamps and values encoded without json
+NUMBER_TYPES = frozenset([int, float])
+
+
+class PayloadBuffer(object):
+    """ Uncompressed counterpart of `utils.http.StreamCompressor` """
+    __slots__ = ('_chunks', 'encoding', 'raw_size', 'size', 'pending')
+
+    def __init__(self):
+        self._chunks = []
+        self.encoding = None
+        self.raw_size = 0
+        self.size = 0
+        self.pending = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self.raw_size += len(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+# Rows flushed by the aggregator, handed over to be serialized
+Flush = namedtuple('Flush', ['series', 'sketches', 'service_checks', 'events'])
+
+
+def fits(size, raw_size, limits=None):
+    """
+    Whether a payload is under the (compressed, uncompressed) size `limits`
+    of its endpoint, the v1 intake limits by default
+    """
+    max_size, max_raw_size = limits or (MAX_COMPRESSED_SIZE, MAX_UNCOMPRESSED_SIZE)
+    return size <= max_size and raw_size <= max_raw_size
+
+
+def decode(value):
+    """ Decodes a bytes name or host, or a tuple of bytes tags """
+    if isinstance(value, bytes):
+        return value.decode(ENCODING, errors='replace')
+    return tuple(v.decode(ENCODING, errors='replace') for v in value)
+
+
+def is_bytes(value):
+    return isinstance(value, bytes) or (isinstance(value, tuple) and bool(value) and isinstance(value[0], bytes))
+
+
+def encode_points(points):
+    """ Encodes the points of a series like json.dumps, formatting single finite points directly """
+    if len(points) == 1:
+        timestamp, value = points[0]
+        if type(timestamp) in NUMBER_TYPES and type(value) in NUMBER_TYPES and value - value == 0:
+            return b'[[%r, %r]]' % (timestamp, value)
+    return json.dumps(points).encode(ENCODING)
 
 
 class Serializer(object):
     JSON_HEADERS = {'Content-Type': 'application/json'}
+    PROTOBUF_HEADERS = {'Content-Type': 'application/x-protobuf'}
+    # Size limits of the v2 series intake, tighter than the v1 ones
+    V2_SERIES_LIMITS = (V2_SERIES_MAX_COMPRESSED_SIZE, V2_SERIES_MAX_UNCOMPRESSED_SIZE)
+    # Items encoded at once when streaming a list into a payload
+    BATCH_SIZE = 1000
+    WORKER_JOIN_TIME = 2
 
-    def __init__(self, aggregator, forwarder):
+    def __init__(self, aggregator, forwarder, use_v2_series=False):
         self._aggregator = aggregator
         self._forwarder = forwarder
+        # Series are submitted as protobuf to the v2 API rather than as JSON
+        self.use_v2_series = use_v2_series
         self._internal_hostname = get_hostname()
+        # Encoded JSON of the series fields after their points, by series
+        # key: (name, tags, host, type, interval) -> fields, and their
+        # protobuf counterpart. They're forgotten once the aggregator expires
+        # their context, the keys of a context being indexed by its
+        # (name, tags, host): a series is named after its context, or one of
+        # its histogram aggregates.
+        self._series_fields = {}
+        self._series_fields_v2 = {}
+        self._series_keys = {}
+        # Appended to by the aggregator, drained after serializing
+        self._expired_contexts = deque()
+        if aggregator is not None:
+            aggregator.on_context_expiry(self._expired_contexts.append)
+        self.stats = Stats()
+        # Serializes the flushes off the caller's thread once started
+        self._worker = None
 
     @classmethod
     def split_payload(cls, payload):
@@ -57,59 +153,328 @@ class Serializer(object):
 
         return payload, metrics_payload, service_checks_payload
 
-    def serialize_metrics(self, add_meta):
-        series = self._aggregator.flush()
-        try:
-            metrics = {'series': series}
-            return json.dumps(metrics), len(metrics['series'])
-        except (UnicodeDecodeError, TypeError):
-            metrics = {'series': ensure_unicode(series)}
-            return json.dumps(metrics), len(metrics['series'])
+    @staticmethod
+    def new_writer(compressor_factory):
+        compressor = compressor_factory() if compressor_factory is not None else None
+        return compressor if compressor is not None else PayloadBuffer()
 
-    def serialize_service_checks(self, add_meta):
-        service_checks = self._aggregator.flush_service_checks()
+    @staticmethod
+    def encode_batch(batch):
+        """ Encodes the items of a batch, comma separated """
         try:
-            return json.dumps(service_checks), len(service_checks)
+            encoded = json.dumps(batch)
         except (UnicodeDecodeError, TypeError):
-            service_checks = ensure_unicode(service_checks)
-            return json.dumps(service_checks), len(service_checks)
+            encoded = json.dumps(ensure_unicode(batch))
+        return encoded[1:-1].encode(ENCODING)
+
+    def encode_series_batch(self, batch):
+        """
+        Encodes a batch of series like `encode_batch`. Only the points change
+        from a flush to the next: the other fields are encoded once per
+        context, the points being concatenated with the cached encoding.
+        Series not shaped by `api_formatter` are encoded whole.
+        """
+        chunks = []
+        for serie in batch:
+            if serie.keys() != SERIES_FIELDS:
+                chunks.append(self.encode_batch([serie]))
+                continue
+            fields = self.series_fields(serie, self._series_fields, self.encode_series_fields)
+            chunks.append(b'{"points": ' + encode_points(serie['points']) + fields)
+        return b', '.join(chunks)
+
+    def encode_series_batch_v2(self, batch):
+        """ Encodes a batch of series in a protobuf `MetricPayload`, like `encode_series_batch` """
+        return b''.join([
+            protobuf.encode_series(
+                self.series_fields(serie, self._series_fields_v2, protobuf.encode_series_fields),
+                serie['points'])
+            for serie in batch
+        ])
+
+    def series_fields(self, serie, cached, encode_fields):
+        """
+        Returns the fields of a series but its points encoded by
+        `encode_fields`, cached by series key in `cached`. Series not shaped
+        by `api_formatter` are encoded every time.
+        """
+        if serie.keys() != SERIES_FIELDS:
+            return encode_fields(serie)
+
+        tags = serie['tags']
+        if type(tags) is list:
+            tags = tuple(tags)
+        key = (serie['metric'], tags, serie['host'], serie['type'], serie['interval'])
+        fields = cached.get(key)
+        if fields is None:
+            fields = cached[key] = encode_fields(serie)
+            for context in self.series_contexts(key):
+                self._series_keys.setdefault(context, set()).add(key)
+        return fields
 
-    def serialize_events(self, add_meta):
-        events = ensure_unicode(self._aggregator.flush_events())
-        serialized_events = defaultdict(list)
-        for event in events:
-            source_type = event.get('source_type_name')
-            if not source_type:
-                source_type = 'api'
+    @staticmethod
+    def series_contexts(key):
+        """ The contexts a series key may belong to: the one named after it, and its parent's """
+        name, tags, host = key[:3]
+        tags = tags or ()
+        parent = name.rpartition(b'.' if is_bytes(name) else '.')[0]
+        if not parent:
+            return [(name, tags, host)]
+        return [(name, tags, host), (parent, tags, host)]
 
-            event_list = serialized_events[source_type]
-            event_list.append(event)
+    def encode_series_fields(self, serie):
+        """ Encodes the fields of a series following its points, decoding the bytes ones """
+        fields = {field: decode(value) if value and is_bytes(value) else value
+                  for field, value in serie.items() if field != 'points'}
+        return b', ' + self.encode_batch([fields])[1:]
 
-        payload = {
-            'apiKey': '',
-            'events': serialized_events,
-            'internalHostname': self._internal_hostname,
-        }
+    def expire_series_fields(self):
+        """ Forgets the encoded fields of the series of the contexts expired by the aggregator """
+        expired_contexts = self._expired_contexts
+        series_keys = self._series_keys
+        for _ in range(len(expired_contexts)):
+            name, tags, hostname = expired_contexts.popleft()
+            for key in series_keys.pop((name, tags or (), hostname), ()):
+                self._series_fields.pop(key, None)
+                self._series_fields_v2.pop(key, None)
+                # Unindexed from the other context it may belong to
+                for context in self.series_contexts(key):
+                    keys = series_keys.get(context)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del series_keys[context]
 
-        return json.dumps(payload), len(events)
+    def encode_list(self, items, prefix, suffix, compressor_factory=None, encode_batch=None, separator=b',',
+                    limits=None):
+        """
+        Encodes `items` as a list between `prefix` and `suffix`, into as
+        many payloads as it takes to stay under the size `limits`. Items
+        are encoded a batch at a time and streamed into a compressor from
+        `compressor_factory`, if any, so a payload is never held whole before
+        it's compressed. Batches are encoded by `encode_batch`, defaulting to
+        the JSON `encode_batch`, and joined by `separator`.
+
+        A payload is closed before a batch would take it over a limit, going
+        by the compressor output so far and the input it still buffers. The
+        payloads still too large are bisected, see `fit_payloads`. Returns the
+        (payload, content encoding) pairs, and the number of items dropped.
+        """
+        encode_batch = encode_batch or self.encode_batch
+
+        def encode(chunk):
+            writer = self.new_writer(compressor_factory)
+            writer.write(prefix)
+            for start in range(0, len(chunk), self.BATCH_SIZE):
+                if start:
+                    writer.write(separator)
+                writer.write(encode_batch(chunk[start:start + self.BATCH_SIZE]))
+            writer.write(suffix)
+            return writer.getvalue(), writer.raw_size, writer.encoding
+
+        payloads = []
+        dropped = 0
+        writer = None
+        first = 0
+        for start in range(0, len(items), self.BATCH_SIZE):
+            encoded = encode_batch(items[start:start + self.BATCH_SIZE])
+            if writer is not None:
+                extra = len(separator) + len(encoded) + len(suffix)
+                if fits(writer.size + writer.pending + extra, writer.raw_size + extra, limits):
+                    writer.write(separator)
+                    writer.write(encoded)
+                    continue
+                dropped += self.close_payload(writer, suffix, items[first:start], encode, payloads, limits)
+
+            writer = self.new_writer(compressor_factory)
+            first = start
+            writer.write(prefix)
+            writer.write(encoded)
+
+        if writer is None:
+            # An empty list is still sent
+            payload, _, encoding = encode(items)
+            payloads.append((payload, encoding))
+        else:
+            dropped += self.close_payload(writer, suffix, items[first:], encode, payloads, limits)
+        return payloads, dropped
+
+    def close_payload(self, writer, suffix, chunk, encode, payloads, limits=None):
+        writer.write(suffix)
+        payload = writer.getvalue()
+        if fits(len(payload), writer.raw_size, limits):
+            payloads.append((payload, writer.encoding))
+            return 0
+        fitted, dropped = self.fit_payloads(chunk, encode, 1, limits)
+        payloads.extend(fitted)
+        return dropped
+
+    def fit_payloads(self, items, encode, depth=0, limits=None):
+        """
+        Encodes `items` with `encode`, bisecting them while the payload is
+        over the size `limits`, up to MAX_SPLIT_DEPTH times. Returns the
+        (payload, content encoding) pairs, and the number of items dropped
+        for being too large still.
+        """
+        payload, raw_size, encoding = encode(items)
+        if fits(len(payload), raw_size, limits):
+            return [(payload, encoding)], 0
+        if depth >= MAX_SPLIT_DEPTH or len(items) < 2:
+            log.error("Dropping a payload of %s item(s) over the intake limits: %s bytes, %s uncompressed",
+                      len(items), len(payload), raw_size)
+            return [], len(items)
+
+        half = len(items) // 2
+        first, first_dropped = self.fit_payloads(items[:half], encode, depth + 1, limits)
+        second, second_dropped = self.fit_payloads(items[half:], encode, depth + 1, limits)
+        return first + second, first_dropped + second_dropped
+
+    def flush(self):
+        """ Flushes the rows of the aggregator to serialize """
+        return Flush(
+            # Client timestamped points bypass aggregation
+            self._aggregator.flush() + self._aggregator.flush_timestamped(),
+            self._aggregator.flush_sketches(),
+            self._aggregator.flush_service_checks(),
+            self._aggregator.flush_events(),
+        )
+
+    def serialize_metrics(self, add_meta, compressor_factory=None, series=None):
+        """
+        Serializes the series, flushed from the aggregator if None, into
+        payloads under the intake limits, as JSON or as protobuf for the v2
+        API. Returns the (payload, content encoding) pairs, the number of
+        series, and the number of series dropped.
+        """
+        if series is None:
+            series = self._aggregator.flush() + self._aggregator.flush_timestamped()
+        if self.use_v2_series:
+            payloads, dropped = self.encode_list(series, b'', b'', compressor_factory,
+                                                 self.encode_series_batch_v2, b'', self.V2_SERIES_LIMITS)
+        else:
+            payloads, dropped = self.encode_list(series, b'{"series":[', b']}', compressor_factory,
+                                                 self.encode_series_batch)
+        self.expire_series_fields()
+        return payloads, len(series), dropped
+
+    def serialize_sketches(self, add_meta, sketches=None):
+        """
+        Serializes the distributions, flushed from the aggregator if None, as
+        the protobuf `SketchPayload` of the agent, grouping the sketches of
+        each context. Returns None when there's none.
+        """
+        if sketches is None:
+            sketches = self._aggregator.flush_sketches()
+        sketch_series = {}
+        for serie in sketches:
+            ts, sketch = serie['points'][0]
+            context = (serie['metric'], tuple(serie['tags'] or ()), serie['host'])
+            sketch_series.setdefault(context, []).append(sketch.to_dict(ts))
+
+        if not sketch_series:
+            return None, 0
+        payload = b''.join([protobuf.encode_sketch(metric, host, tags, context_sketches)
+                            for (metric, tags, host), context_sketches in sketch_series.items()])
+        return payload, len(sketch_series)
+
+    def serialize_service_checks(self, add_meta, compressor_factory=None, service_checks=None):
+        """ Serializes the service checks, like `serialize_metrics` """
+        if service_checks is None:
+            service_checks = self._aggregator.flush_service_checks()
+        payloads, dropped = self.encode_list(service_checks, b'[', b']', compressor_factory)
+        return payloads, len(service_checks), dropped
+
+    def serialize_events(self, add_meta, compressor_factory=None, events=None):
+        """
+        Serializes the events, like `serialize_metrics`. Events are few: they
+        are only split by bisection.
+        """
+        def encode(chunk):
+            serialized_events = defaultdict(list)
+            for event in chunk:
+                source_type = event.get('source_type_name')
+                if not source_type:
+                    source_type = 'api'
+
+                event_list = serialized_events[source_type]
+                event_list.append(event)
+
+            payload = {
+                'apiKey': '',
+                'events': serialized_events,
+                'internalHostname': self._internal_hostname,
+            }
+
+            writer = self.new_writer(compressor_factory)
+            writer.write(json.dumps(payload).encode(ENCODING))
+            return writer.getvalue(), writer.raw_size, writer.encoding
+
+        if events is None:
+            events = self._aggregator.flush_events()
+        events = ensure_unicode(events)
+        payloads, dropped = self.fit_payloads(events, encode)
+        return payloads, len(events), dropped
+
+    def push_payloads(self, submit, kind, payloads, dropped, content_headers=None):
+        """ Submits the payloads of a kind, reporting how they were split to the forwarder """
+        for payload, encoding in payloads:
+            headers = content_headers or self.JSON_HEADERS
+            if encoding is not None:
+                headers = dict(headers, **{'Content-Encoding': encoding})
+            submit(payload, headers)
+        if len(payloads) > 1 or dropped:
+            self._forwarder.record_payload_splits(kind, max(len(payloads) - 1, 0), dropped)
+
+    def start(self):
+        """
+        Starts serializing off the caller's thread: `serialize_and_push` then
+        only flushes the aggregator, a worker encoding, compressing and
+        submitting the flushes in order.
+        """
+        if self._worker is None:
+            self._worker = SerializerWorker(self.push, self.stats)
+            self._worker.start()
+
+    def stop(self):
+        """ Stops the worker, once it has pushed the flushes still queued """
+        worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        worker.stop()
+        worker.join(self.WORKER_JOIN_TIME)
+        if worker.is_alive():
+            log.error("Could not stop thread '%s'", worker.name)
 
     def serialize_and_push(self, add_meta=False):
-        metrics, m_count = self.serialize_metrics(add_meta)
-        service_checks, sc_count = self.serialize_service_checks(add_meta)
-        events, e_count = self.serialize_events(add_meta)
+        """
+        Flushes the aggregator and serializes the rows flushed, on the worker
+        if started. Returns the number of series, service checks and events.
+        """
+        flushed = self.flush()
+        worker = self._worker
+        if worker is not None:
+            worker.submit(flushed)
+        else:
+            self.push(flushed)
+        return len(flushed.series), len(flushed.service_checks), len(flushed.events)
 
-        extra_headers = self.JSON_HEADERS
-        if metrics:
-            self._forwarder.submit_v1_series(
-                metrics, extra_headers)
-        if service_checks:
-            self._forwarder.submit_v1_service_checks(
-                service_checks, extra_headers)
-        if events:
-            self._forwarder.submit_v1_intake(
-                events, extra_headers)
-
-        return m_count, sc_count, e_count
+    def push(self, flushed, add_meta=False):
+        """ Serializes a `Flush` and submits its payloads to the forwarder """
+        compressor_factory = self._forwarder.stream_compressor
+        metrics, _, m_dropped = self.serialize_metrics(add_meta, compressor_factory, flushed.series)
+        sketches, _ = self.serialize_sketches(add_meta, flushed.sketches)
+        service_checks, _, sc_dropped = self.serialize_service_checks(
+            add_meta, compressor_factory, flushed.service_checks)
+        events, _, e_dropped = self.serialize_events(add_meta, compressor_factory, flushed.events)
+
+        if self.use_v2_series:
+            self.push_payloads(self._forwarder.submit_v2_series, 'series', metrics, m_dropped, self.PROTOBUF_HEADERS)
+        else:
+            self.push_payloads(self._forwarder.submit_v1_series, 'series', metrics, m_dropped)
+        if sketches:
+            self._forwarder.submit_sketches(sketches, self.PROTOBUF_HEADERS)
+        self.push_payloads(self._forwarder.submit_v1_service_checks, 'service_check', service_checks, sc_dropped)
+        self.push_payloads(self._forwarder.submit_v1_intake, 'intake', events, e_dropped)
 
     def submit_metadata(self, metadata):
         extra_headers = self.JSON_HEADERS
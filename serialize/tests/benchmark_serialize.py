@@ -0,0 +1,106 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+"""
+Performance tests for the series serialization.
+"""
+# stdlib
+import json
+import tracemalloc
+from time import perf_counter
+
+# 3p
+import pytest
+from mock import MagicMock
+
+# project
+from aggregator.formatters import api_formatter
+from serialize import Serializer
+from utils import http
+
+
+class TestSeriesSerializationPerf(object):
+
+    SERIES_COUNT = 100000
+
+    def flush(self):
+        return [
+            api_formatter('my.metric.%d' % (i % 100), i * 0.5, 1500000000, ('env:prod', 'shard:%d' % i),
+                          'myhost', 'rate', 10)
+            for i in range(self.SERIES_COUNT)
+        ]
+
+    def measure(self, serialize):
+        series = self.flush()
+        start = perf_counter()
+        payload = serialize(series)
+        elapsed = perf_counter() - start
+
+        # Timed without tracing, which slows allocations down
+        tracemalloc.start()
+        serialize(series)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return payload, elapsed, peak
+
+    @pytest.mark.parametrize('kind', ['none', 'zlib', 'zstd'])
+    def test_series_serialization_perf(self, kind):
+        if kind == 'zstd' and not http.HAS_ZSTD:
+            pytest.skip('zstandard not available')
+        compress_func = http._compress_with_zstd if kind == 'zstd' else http._compress_with_zlib
+        stream_compressor_func = {
+            'none': None,
+            'zlib': http._stream_compressor_zlib,
+            'zstd': http._stream_compressor_zstd,
+        }[kind]
+        serializer = Serializer(MagicMock(), MagicMock())
+
+        def serialize_whole(series):
+            # Dumped whole, encoded, then compressed by the requests wrapper
+            payload = json.dumps({'series': series}).encode('utf-8')
+            if stream_compressor_func is None:
+                return payload
+            return http._compress_payload(payload, compress_func)[0]
+
+        def serialize_streaming(series):
+            payloads, _ = serializer.encode_list(series, b'{"series":[', b']}', stream_compressor_func)
+            return b''.join(payload for payload, _ in payloads)
+
+        def serialize_cached(series):
+            # Flushing the same contexts again, their fields are cached
+            payloads, _ = serializer.encode_list(series, b'{"series":[', b']}', stream_compressor_func,
+                                                 serializer.encode_series_batch)
+            return b''.join(payload for payload, _ in payloads)
+
+        serialize_cached(self.flush())
+        for name, serialize in (('whole', serialize_whole), ('streaming', serialize_streaming),
+                                ('cached', serialize_cached)):
+            payload, elapsed, peak = self.measure(serialize)
+            print('{} series, {:<4} {:<9}: {:.3f}s, peak {:.1f}MB, payload {:.1f}MB'.format(
+                self.SERIES_COUNT, kind, name, elapsed, peak / 1e6, len(payload) / 1e6))
+
+    @pytest.mark.parametrize('kind', ['none', 'zstd'])
+    def test_series_format_perf(self, kind):
+        if kind == 'zstd' and not http.HAS_ZSTD:
+            pytest.skip('zstandard not available')
+        stream_compressor_func = http._stream_compressor_zstd if kind == 'zstd' else None
+        serializer = Serializer(MagicMock(), MagicMock())
+
+        def serialize_json(series):
+            payloads, _ = serializer.encode_list(series, b'{"series":[', b']}', stream_compressor_func,
+                                                 serializer.encode_series_batch)
+            return b''.join(payload for payload, _ in payloads)
+
+        def serialize_protobuf(series):
+            payloads, _ = serializer.encode_list(series, b'', b'', stream_compressor_func,
+                                                 serializer.encode_series_batch_v2, b'')
+            return b''.join(payload for payload, _ in payloads)
+
+        for name, serialize in (('json', serialize_json), ('protobuf', serialize_protobuf)):
+            # The first flush of the contexts, then the next ones
+            for flush in ('cold', 'warm'):
+                payload, elapsed, peak = self.measure(serialize)
+                print('{} series, {:<4} {:<8} {}: {:.3f}s, peak {:.1f}MB, payload {:.2f}MB'.format(
+                    self.SERIES_COUNT, kind, name, flush, elapsed, peak / 1e6, len(payload) / 1e6))
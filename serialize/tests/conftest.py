@@ -34,6 +34,8 @@ def mock_aggregator():
         'flush.return_value': MOCK_FLUSH_DATA,
         'flush_events.return_value': events,
         'flush_service_checks.return_value': service_checks,
+        'flush_timestamped.return_value': [],
+        'flush_sketches.return_value': [],
     }
     aggregator.configure_mock(**attrs)
     return aggregator
@@ -41,7 +43,9 @@ def mock_aggregator():
 
 @pytest.fixture(scope='session')
 def mock_forwarder():
-    return MagicMock()
+    forwarder = MagicMock()
+    forwarder.configure_mock(**{'stream_compressor.return_value': None})
+    return forwarder
 
 
 @pytest.fixture(scope='session')
@@ -0,0 +1,168 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import math
+import struct
+
+from aggregator.formatters import api_formatter
+from aggregator.sketch import DDSketch
+from serialize import protobuf
+
+
+def decode_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def decode_message(data):
+    """ Decodes a message as a list of (field, value) pairs """
+    fields = []
+    pos = 0
+    while pos < len(data):
+        field_key, pos = decode_varint(data, pos)
+        field, wire_type = field_key >> 3, field_key & 0x7
+        if wire_type == protobuf.VARINT:
+            value, pos = decode_varint(data, pos)
+        elif wire_type == protobuf.FIXED64:
+            value, = struct.unpack('<d', data[pos:pos + 8])
+            pos += 8
+        else:
+            length, pos = decode_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        fields.append((field, value))
+    return fields
+
+
+def decode_payload(data):
+    series = []
+    for field, value in decode_message(data):
+        assert field == 1
+        serie = {'resources': [], 'tags': [], 'points': []}
+        for series_field, series_value in decode_message(value):
+            if series_field == 1:
+                serie['resources'].append(dict(decode_message(series_value)))
+            elif series_field == 3:
+                serie['tags'].append(series_value.decode())
+            elif series_field == 4:
+                point = dict(decode_message(series_value))
+                serie['points'].append((point.get(2, 0), point.get(1, 0.0)))
+            else:
+                serie[{2: 'metric', 5: 'type', 7: 'source_type_name', 8: 'interval'}[series_field]] = series_value
+        series.append(serie)
+    return series
+
+
+def decode_packed(data):
+    values = []
+    pos = 0
+    while pos < len(data):
+        value, pos = decode_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def decode_sketch_payload(data):
+    sketches = []
+    for field, value in decode_message(data):
+        assert field == 1
+        sketch = {'tags': [], 'dogsketches': []}
+        for sketch_field, sketch_value in decode_message(value):
+            if sketch_field == 4:
+                sketch['tags'].append(sketch_value)
+            elif sketch_field == 7:
+                dogsketch = dict(decode_message(sketch_value))
+                keys = decode_packed(dogsketch.pop(7, b''))
+                sketch['dogsketches'].append(dict(
+                    zip(('ts', 'cnt', 'min', 'max', 'avg', 'sum'), (dogsketch.get(f, 0) for f in range(1, 7))),
+                    k=[k >> 1 ^ -(k & 1) for k in keys],
+                    n=decode_packed(dogsketch.pop(8, b'')),
+                ))
+            else:
+                sketch[{1: 'metric', 2: 'host'}[sketch_field]] = sketch_value
+        sketches.append(sketch)
+    return sketches
+
+
+def encode(serie):
+    return protobuf.encode_series(protobuf.encode_series_fields(serie), serie['points'])
+
+
+def test_encode_varint():
+    assert protobuf.encode_varint(0) == b'\x00'
+    assert protobuf.encode_varint(1) == b'\x01'
+    assert protobuf.encode_varint(300) == b'\xac\x02'
+    assert protobuf.encode_varint(1500000000) == b'\x80\xde\xa0\xcb\x05'
+    assert protobuf.encode_varint(-1) == b'\xff' * 9 + b'\x01'
+    for value in (127, 128, 2 ** 32, 2 ** 63 - 1):
+        assert decode_varint(protobuf.encode_varint(value), 0) == (value, len(protobuf.encode_varint(value)))
+
+
+def test_encode_series():
+    series = [
+        api_formatter(b'my.counter', 1.5, 1500000000, (b'env:prod', b'role:db'), b'myhost', 'rate', 10),
+        api_formatter('my.gauge', -2, 1500000010.5, ['caf\xe9'], 'otherhost', 'gauge', 1.0),
+        api_formatter('my.count', float('nan'), 0, None, None, 'count', None),
+        dict(api_formatter('my.counter', 0.0, 10, None, 'myhost', 'rate', 10), points=[(10, 0.0), (20, 0.0)]),
+        {'metric': 'my.check', 'points': [(10, 1)], 'type': 'counter', 'source_type_name': 'System'},
+    ]
+    decoded = decode_payload(b''.join(encode(serie) for serie in series))
+
+    assert decoded[0] == {
+        'resources': [{1: b'host', 2: b'myhost'}],
+        'metric': b'my.counter',
+        'tags': ['env:prod', 'role:db'],
+        'points': [(1500000000, 1.5)],
+        'type': 2,
+        'interval': 10,
+    }
+    assert decoded[1] == {
+        'resources': [{1: b'host', 2: b'otherhost'}],
+        'metric': b'my.gauge',
+        'tags': ['caf\xe9'],
+        'points': [(1500000010, -2.0)],
+        'type': 3,
+        'interval': 1,
+    }
+    # defaults are left out
+    assert decoded[2]['resources'] == [] and 'interval' not in decoded[2]
+    assert decoded[2]['points'][0][0] == 0 and math.isnan(decoded[2]['points'][0][1])
+    assert decoded[3]['points'] == [(10, 0.0), (20, 0.0)]
+    assert decoded[4] == {
+        'resources': [],
+        'metric': b'my.check',
+        'tags': [],
+        'points': [(10, 1.0)],
+        'source_type_name': b'System',
+    }
+
+    # invalid UTF-8 is replaced
+    decoded = decode_payload(encode(api_formatter(b'my.\xff', 1, 10, None, None, 'gauge', 10)))
+    assert decoded[0]['metric'] == 'my.�'.encode()
+
+
+def test_encode_sketch():
+    assert [protobuf.zigzag(value) for value in (0, -1, 1, -2, 1338, -1338)] == [0, 1, 2, 3, 2676, 2675]
+
+    sketch = DDSketch()
+    sketch.add_many([-2, 0, 1, 1, 10])
+    decoded = decode_sketch_payload(
+        protobuf.encode_sketch(b'my.dist', 'myhost', (b'env:prod',), [sketch.to_dict(10), DDSketch().to_dict(20)]))
+    assert decoded == [{
+        'metric': b'my.dist',
+        'host': b'myhost',
+        'tags': [b'env:prod'],
+        'dogsketches': [
+            {'ts': 10, 'cnt': 5, 'min': -2.0, 'max': 10.0, 'avg': 2.0, 'sum': 10.0,
+             'k': [-1383, 0, 1338, 1487], 'n': [1, 1, 2, 1]},
+            {'ts': 20, 'cnt': 0, 'min': float('inf'), 'max': float('-inf'), 'avg': 0.0, 'sum': 0.0, 'k': [], 'n': []},
+        ],
+    }]
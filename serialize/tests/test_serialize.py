@@ -4,8 +4,19 @@
 # Copyright 2018 Datadog, Inc.
 
 import json
+import zlib
 
+from mock import MagicMock, patch
+
+from aggregator import MetricsAggregator, MetricsBucketAggregator
+from aggregator.formatters import api_formatter
+from aggregator.interning import TagRegistry
+from aggregator.types import Distribution
 from serialize import Serializer
+from serialize import serialize as serialize_module
+from utils.http import StreamCompressor
+
+from .test_protobuf import decode_payload, decode_sketch_payload
 
 
 def test_split(legacy_payload, service_check_payload):
@@ -45,11 +56,11 @@ def test_split(legacy_payload, service_check_payload):
 def test_serialize(mock_aggregator, mock_forwarder):
     serializer = Serializer(mock_aggregator, mock_forwarder)
 
-    metrics_szd, metrics_count = serializer.serialize_metrics(False)
+    (metrics_szd, _), = serializer.serialize_metrics(False)[0]
     assert metrics_szd
-    service_checks_szd, service_checks_count = serializer.serialize_service_checks(False)
+    (service_checks_szd, _), = serializer.serialize_service_checks(False)[0]
     assert service_checks_szd
-    events_szd, events_count = serializer.serialize_events(False)
+    (events_szd, _), = serializer.serialize_events(False)[0]
     assert events_szd
 
     metrics = json.loads(metrics_szd)
@@ -72,3 +83,173 @@ def test_serialize_and_push(mock_aggregator, mock_forwarder):
     forwarder.submit_v1_series.assert_called()
     forwarder.submit_v1_service_checks.assert_called()
     forwarder.submit_v1_intake.assert_called()
+
+
+def test_serialize_compressed():
+    aggregator = MetricsBucketAggregator('myhost', interval=1)
+    aggregator.timestamped_series = [
+        api_formatter(b'my.gauge', i, 10, (b'env:prod',), b'myhost', 'gauge', 10) for i in range(5)
+    ]
+    forwarder = MagicMock()
+    forwarder.stream_compressor.side_effect = lambda: StreamCompressor(zlib.compressobj(), 'deflate')
+    serializer = Serializer(aggregator, forwarder)
+    # series are encoded a few at a time
+    serializer.BATCH_SIZE = 2
+
+    serializer.serialize_and_push(False)
+    payload, headers = forwarder.submit_v1_series.call_args[0]
+    assert headers == {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
+    series = json.loads(zlib.decompress(payload))['series']
+    assert [(s['metric'], s['tags'], s['points']) for s in series] == \
+        [('my.gauge', ['env:prod'], [[10, i]]) for i in range(5)]
+
+    # the JSON headers are left alone
+    assert Serializer.JSON_HEADERS == {'Content-Type': 'application/json'}
+    forwarder.record_payload_splits.assert_not_called()
+
+
+def test_serialize_v2_series(monkeypatch):
+    monkeypatch.setattr(Serializer, 'V2_SERIES_LIMITS', (Serializer.V2_SERIES_LIMITS[0], 200))
+    aggregator = MetricsBucketAggregator('myhost', interval=1)
+    aggregator.timestamped_series = [
+        api_formatter(b'my.gauge', i, 10, (b'env:prod',), b'myhost', 'gauge', 10) for i in range(10)
+    ]
+    forwarder = MagicMock()
+    forwarder.stream_compressor.side_effect = lambda: StreamCompressor(zlib.compressobj(), 'deflate')
+    serializer = Serializer(aggregator, forwarder, use_v2_series=True)
+    serializer.BATCH_SIZE = 2
+
+    serializer.serialize_and_push(False)
+    forwarder.submit_v1_series.assert_not_called()
+    series = []
+    for (payload, headers), _ in forwarder.submit_v2_series.call_args_list:
+        assert headers == {'Content-Type': 'application/x-protobuf', 'Content-Encoding': 'deflate'}
+        series += decode_payload(zlib.decompress(payload))
+    assert forwarder.submit_v2_series.call_count > 1
+    assert [(s['metric'], s['tags'], s['resources'], s['points']) for s in series] == \
+        [(b'my.gauge', ['env:prod'], [{1: b'host', 2: b'myhost'}], [(10, float(i))]) for i in range(10)]
+    forwarder.record_payload_splits.assert_called_once_with('series', forwarder.submit_v2_series.call_count - 1, 0)
+
+
+def test_split_v2_series_payloads(mock_forwarder):
+    series = [api_formatter('my.gauge', i, 1500000000, ['shard:%d' % i], 'myhost', 'gauge', 10) for i in range(12000)]
+    serializer = Serializer(None, mock_forwarder, use_v2_series=True)
+
+    # Over the v2 limit of 512000 bytes, but not over the v1 ones
+    payloads, count, dropped = serializer.serialize_metrics(False, series=series)
+    assert (count, dropped) == (12000, 0)
+    assert len(payloads) > 1
+    assert all(len(payload) <= 512000 for payload, _ in payloads)
+    assert sum(len(decode_payload(payload)) for payload, _ in payloads) == 12000
+    assert sum(len(payload) for payload, _ in payloads) > 512000
+
+    serializer.use_v2_series = False
+    payloads, _, _ = serializer.serialize_metrics(False, series=series)
+    assert len(payloads) == 1
+
+
+def test_split_payloads(monkeypatch):
+    monkeypatch.setattr(serialize_module, 'MAX_UNCOMPRESSED_SIZE', 1000)
+    series = [api_formatter('my.gauge', i, 10, ['shard:%d' % i], 'myhost', 'gauge', 10) for i in range(40)]
+    aggregator = MetricsBucketAggregator('myhost', interval=1)
+    forwarder = MagicMock()
+    forwarder.stream_compressor.return_value = None
+    serializer = Serializer(aggregator, forwarder)
+    serializer.BATCH_SIZE = 3
+
+    # Batches are added to a payload while they fit
+    payloads, dropped = serializer.encode_list(series, b'{"series":[', b']}')
+    assert dropped == 0
+    assert all(len(payload) <= 1000 and encoding is None for payload, encoding in payloads)
+    assert [len(json.loads(payload)['series']) for payload, _ in payloads] == [6, 6, 6, 6, 6, 6, 4]
+    assert sum((json.loads(payload)['series'] for payload, _ in payloads), []) == json.loads(json.dumps(series))
+
+    # A batch too large is bisected, up to MAX_SPLIT_DEPTH
+    serializer.BATCH_SIZE = 16
+    payloads, dropped = serializer.encode_list(series, b'{"series":[', b']}')
+    assert dropped == 0
+    assert [len(json.loads(payload)['series']) for payload, _ in payloads] == [8, 8, 8, 8, 8]
+    assert sum((json.loads(payload)['series'] for payload, _ in payloads), []) == json.loads(json.dumps(series))
+    serializer.BATCH_SIZE = 40
+    payloads, dropped = serializer.encode_list(series, b'{"series":[', b']}')
+    assert (len(payloads), dropped) == (0, 40)
+
+    aggregator.timestamped_series = series
+    aggregator.service_checks = [{'check': 'my.check.%d' % i, 'status': 0} for i in range(100)]
+    serializer.BATCH_SIZE = 3
+    serializer.serialize_and_push()
+    assert forwarder.submit_v1_series.call_count == 7
+    assert forwarder.submit_v1_service_checks.call_count == 5
+    assert forwarder.submit_v1_intake.call_count == 1
+    assert [c[0] for c in forwarder.record_payload_splits.call_args_list] == \
+        [('series', 6, 0), ('service_check', 4, 0)]
+
+
+def decoded(serie):
+    """ Copy of a series whose bytes name, tags and host are decoded """
+    return dict(serie, **{field: serialize_module.decode(serie[field]) for field in ('metric', 'tags', 'host')
+                          if serie.get(field) and serialize_module.is_bytes(serie[field])})
+
+
+def test_encode_series_batch(mock_forwarder):
+    serializer = Serializer(None, mock_forwarder)
+    series = [
+        api_formatter(b'my.counter', 1.5, 10, (b'env:prod', b'role:db'), b'myhost', 'rate', 10),
+        api_formatter('my.gauge', 2, 10.5, ['env:prod'], 'myhost', 'gauge', None),
+        api_formatter('my.gauge', float('nan'), 10, None, None, 'gauge', 10),
+        dict(api_formatter('my.counter', 0.0, 10, None, 'myhost', 'rate', 10), points=[(10, 0.0), (20, 0.0)]),
+        {'metric': 'my.check', 'points': [(10, 1)], 'device': 'sda'},
+    ]
+    expected = json.loads('[%s]' % serializer.encode_batch([decoded(s) for s in series]).decode())
+    assert json.loads(b'[%s]' % serializer.encode_series_batch(series)) == expected
+
+    # the fields of the contexts flushed again are reused
+    assert len(serializer._series_fields) == 4
+    fields = serializer._series_fields[(b'my.counter', (b'env:prod', b'role:db'), b'myhost', 'rate', 10)]
+    series = [api_formatter(b'my.counter', 3, 20, (b'env:prod', b'role:db'), b'myhost', 'rate', 10)]
+    assert serializer.encode_series_batch(series).endswith(fields)
+    assert json.loads(serializer.encode_series_batch(series))['points'] == [[20, 3]]
+
+
+def test_expire_series_fields(mock_forwarder):
+    aggregator = MetricsAggregator('myhost', expiry_seconds=300, histogram_aggregates=['max'],
+                                   histogram_percentiles=[], tag_registry=TagRegistry())
+    serializer = Serializer(aggregator, mock_forwarder)
+    with patch('aggregator.aggregator.time', return_value=100), patch('aggregator.types.time', return_value=100):
+        aggregator.gauge('my.gauge', 1, tags=['env:prod'])
+        aggregator.histogram('my.histogram', 1)
+        serializer.serialize_metrics(False)
+    assert sorted(key[0] for key in serializer._series_fields) == [
+        'datadog.agent.running', 'my.gauge', 'my.histogram.max']
+
+    # the fields of a series are forgotten with the context it was flushed for
+    with patch('aggregator.aggregator.time', return_value=350), patch('aggregator.types.time', return_value=350):
+        aggregator.gauge('my.gauge', 1, tags=['env:prod'])
+        serializer.serialize_metrics(False)
+    with patch('aggregator.aggregator.time', return_value=500), patch('aggregator.types.time', return_value=500):
+        serializer.serialize_metrics(False)
+    assert sorted(key[0] for key in serializer._series_fields) == ['datadog.agent.running', 'my.gauge']
+    assert sorted(serializer._series_keys) == [
+        ('datadog.agent', (), 'myhost'), ('datadog.agent.running', (), 'myhost'),
+        ('my', ('env:prod',), 'myhost'), ('my.gauge', ('env:prod',), 'myhost')]
+
+
+def test_serialize_sketches(mock_forwarder):
+    aggregator = MetricsBucketAggregator('myhost', interval=1)
+    serializer = Serializer(aggregator, mock_forwarder)
+    assert serializer.serialize_sketches(False) == (None, 0)
+
+    dist = Distribution(api_formatter, b'my.dist', (b'env:prod',), b'myhost')
+    dist.sample_many([1, 2], 1)
+    aggregator.sketches += dist.flush(10, 10)
+    dist.sample(3, 1)
+    aggregator.sketches += dist.flush(20, 10)
+
+    payload, count = serializer.serialize_sketches(False)
+    assert count == 1
+    sketch, = decode_sketch_payload(payload)
+    assert sketch['metric'] == b'my.dist'
+    assert sketch['tags'] == [b'env:prod']
+    assert sketch['host'] == b'myhost'
+    assert [(s['ts'], s['cnt'], s['sum'], s['k'], s['n']) for s in sketch['dogsketches']] == \
+        [(10, 2, 3, [1338, 1383], [1, 1]), (20, 1, 3, [1409], [1])]
@@ -0,0 +1,88 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+import json
+from threading import Event
+
+from mock import MagicMock
+
+from aggregator import MetricsBucketAggregator
+from aggregator.formatters import api_formatter
+from serialize import Serializer
+from serialize.worker import SerializerWorker
+from utils.stats import Stats
+
+
+def test_worker_process_flush():
+    stats = Stats()
+    pushed = []
+    w = SerializerWorker(pushed.append, stats, queue_size=2)
+
+    w.submit('flush1')
+    w.submit('flush2')
+    w.submit('flush3')
+    assert stats.get_stat('queue_depth') == 2
+    assert stats.get_stat('flushes_dropped') == 1
+
+    assert w._process_flush()
+    assert pushed == ['flush1']
+    assert stats.get_stat('queue_depth') == 1
+    assert stats.get_stat('flushes_serialized') == 1
+    assert stats.get_stat('encode_latency_ms') >= 0
+    assert stats.get_stat('encode_latency_max_ms') >= stats.get_stat('encode_latency_ms')
+
+    w.stop()
+    w.run()
+    assert pushed == ['flush1', 'flush2']
+    assert stats.get_stat('queue_depth') == 0
+    assert not w._process_flush(block=False)
+
+
+def test_worker_push_error():
+    stats = Stats()
+    w = SerializerWorker(MagicMock(side_effect=ValueError), stats)
+
+    w.submit('flush')
+    assert w._process_flush()
+    assert stats.get_stat('serialization_errors') == 1
+    assert stats.get_stat('flushes_serialized') == 0
+
+
+def test_serialize_off_thread():
+    aggregator = MetricsBucketAggregator('myhost', interval=1)
+    forwarder = MagicMock()
+    forwarder.stream_compressor.return_value = None
+    serializer = Serializer(aggregator, forwarder)
+
+    # the first push blocks, as a slow encode would
+    pushing = Event()
+    resume = Event()
+    push = serializer.push
+
+    def slow_push(flushed):
+        pushing.set()
+        resume.wait(5)
+        push(flushed)
+    serializer.push = slow_push
+
+    serializer.start()
+    try:
+        for i in range(2):
+            aggregator.timestamped_series = [api_formatter('my.gauge', i, 10, None, 'myhost', 'gauge', 10)]
+            assert serializer.serialize_and_push() == (1, 0, 0)
+        assert pushing.wait(5)
+        forwarder.submit_v1_series.assert_not_called()
+    finally:
+        resume.set()
+        serializer.stop()
+
+    # flushes are pushed in order, the queued ones before stopping
+    assert [json.loads(c[0][0])['series'][0]['points'] for c in forwarder.submit_v1_series.call_args_list] == \
+        [[[10, 0]], [[10, 1]]]
+    assert serializer.stats.get_stat('flushes_serialized') == 2
+
+    # stopped, flushes are serialized synchronously again
+    serializer.serialize_and_push()
+    assert forwarder.submit_v1_series.call_count == 3
@@ -0,0 +1,74 @@
+# Unless explicitly stated otherwise all files in this repository are licensed
+# under the Apache License Version 2.0.
+# This product includes software developed at Datadog (https://www.datadoghq.com/).
+# Copyright 2018 Datadog, Inc.
+
+from threading import Thread, Event
+from time import perf_counter
+import queue
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SerializerWorker(Thread):
+    """
+    Serializes the flushes handed over by a `Serializer` with `push`, so that
+    the collection loop and the dogstatsd reporter never wait on encoding and
+    compression. Flushes are pushed in order; when the queue is full, as when
+    serializing takes longer than the flush interval, the new ones are dropped.
+
+    Reports the queue depth and the time taken to push each flush in `stats`.
+    """
+    QUEUE_SIZE = 10
+    GET_TIMEOUT = 1  # seconds
+
+    def __init__(self, push, stats, queue_size=QUEUE_SIZE):
+        super(SerializerWorker, self).__init__(name='SerializerWorker')
+        self.input_queue = queue.Queue(queue_size)
+        self.exit = Event()
+        self._push = push
+        self._stats = stats
+        self._encode_latency_max = 0
+
+    def stop(self):
+        self.exit.set()
+
+    def submit(self, flushed):
+        try:
+            self.input_queue.put_nowait(flushed)
+        except queue.Full:
+            log.error("Could not serialize flush, queue is full (dropping it)")
+            self._stats.inc_stat('flushes_dropped', 1)
+        self._stats.set_stat('queue_depth', self.input_queue.qsize())
+
+    def _process_flush(self, block=True):
+        try:
+            # blocking for 1 seconds so we can check the exit condition
+            flushed = self.input_queue.get(block, self.GET_TIMEOUT)
+        except queue.Empty:
+            return False
+        self._stats.set_stat('queue_depth', self.input_queue.qsize())
+
+        start = perf_counter()
+        try:
+            self._push(flushed)
+        except Exception:
+            log.exception("Error serializing flush")
+            self._stats.inc_stat('serialization_errors', 1)
+            return True
+
+        latency = (perf_counter() - start) * 1000
+        self._encode_latency_max = max(self._encode_latency_max, latency)
+        self._stats.set_stat('encode_latency_ms', round(latency, 1))
+        self._stats.set_stat('encode_latency_max_ms', round(self._encode_latency_max, 1))
+        self._stats.inc_stat('flushes_serialized', 1)
+        return True
+
+    def run(self):
+        while not self.exit.is_set():
+            self._process_flush()
+
+        # Push the flushes still queued
+        while self._process_flush(block=False):
+            pass
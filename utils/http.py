@@ -25,7 +25,11 @@ log = logging.getLogger(__name__)
 # Compression constants (aligned with backend limits)
 # -------------------------------------------------------------------
 MAX_COMPRESSED_SIZE = 2 << 20  # 2 MB – conservative limit
-MAX_SPLIT_DEPTH = 2            # for future payload-splitting logic
+MAX_UNCOMPRESSED_SIZE = 4 << 20  # 4 MB – conservative limit
+MAX_SPLIT_DEPTH = 2            # times a payload still too large is bisected
+# Limits of the v2 series intake (/api/v2/series)
+V2_SERIES_MAX_COMPRESSED_SIZE = 512000
+V2_SERIES_MAX_UNCOMPRESSED_SIZE = 5242880
 
 
 def _no_proxy_uri_list(proxies):
@@ -51,6 +55,64 @@ def _compress_with_zlib(data: bytes, level: Optional[int] = None):
     return zlib.compress(data, zlib.Z_DEFAULT_COMPRESSION), "deflate"
 
 
+class StreamCompressor:
+    """
+    Compresses a payload written in chunks as they are produced, so that
+    only its compressed form is ever held whole. The payload is sent with
+    its Content-Encoding set, see RequestsWrapper.request.
+
+    `size` is the compressed output so far, `pending` the input written since
+    the compressor last output anything, buffered in it.
+    """
+    __slots__ = ('_compressobj', '_chunks', 'encoding', 'raw_size', 'size', 'pending')
+
+    def __init__(self, compressobj, encoding: str):
+        self._compressobj = compressobj
+        self._chunks = []
+        self.encoding = encoding
+        self.raw_size = 0
+        self.size = 0
+        self.pending = 0
+
+    def write(self, data: bytes):
+        self.raw_size += len(data)
+        chunk = self._compressobj.compress(data)
+        if chunk:
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+            self.pending = 0
+        else:
+            self.pending += len(data)
+
+    def getvalue(self) -> bytes:
+        """Flush the compressor and return the compressed payload, once."""
+        chunk = self._compressobj.flush()
+        if chunk:
+            self._chunks.append(chunk)
+            self.size += len(chunk)
+        self.pending = 0
+        log.debug(
+            "[HTTP] Stream compression: kind=%s, before=%d bytes, after=%d bytes (%.1f%% of original)",
+            self.encoding,
+            self.raw_size,
+            self.size,
+            (self.size / self.raw_size) * 100 if self.raw_size else 0.0,
+        )
+        payload = b"".join(self._chunks)
+        self._chunks = []
+        return payload
+
+
+def _stream_compressor_zstd(level: Optional[int] = None):
+    """Streaming counterpart of _compress_with_zstd."""
+    return StreamCompressor(zstd.ZstdCompressor(level=level or 1).compressobj(), "zstd")
+
+
+def _stream_compressor_zlib(level: Optional[int] = None):
+    """Streaming counterpart of _compress_with_zlib."""
+    return StreamCompressor(zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION), "deflate")
+
+
 def _compress_payload(
     data: bytes,
     compress_func,
@@ -134,6 +196,7 @@ class RequestsWrapper:
         'options',
         '_use_compression',
         '_compress_func',
+        '_stream_compressor_func',
         '_compression_level',
         '_default_content_type',
     )
@@ -167,6 +230,7 @@ class RequestsWrapper:
         # ----- Compression config -----
         self._use_compression = bool(use_compression)
         self._compress_func = None
+        self._stream_compressor_func = None
         self._compression_level = None
 
         if self._use_compression:
@@ -174,6 +238,7 @@ class RequestsWrapper:
 
             if HAS_ZSTD and kind != "zlib":
                 self._compress_func = _compress_with_zstd
+                self._stream_compressor_func = _stream_compressor_zstd
                 self._compression_level = compression_level
                 log.debug(
                     "[HTTP] Compression initialized with zstd (level=%s)",
@@ -181,6 +246,7 @@ class RequestsWrapper:
                 )
             else:
                 self._compress_func = _compress_with_zlib
+                self._stream_compressor_func = _stream_compressor_zlib
                 msg = (
                     "[HTTP] zstandard not available; using zlib fallback"
                     if compression_kind == "zstd" and not HAS_ZSTD
@@ -194,6 +260,15 @@ class RequestsWrapper:
             log.warning(
                 "[HTTP] SSL verification disabled; suppressing InsecureRequestWarning")
 
+    def stream_compressor(self):
+        """
+        Return a new StreamCompressor matching the configured compression, or
+        None when compression is disabled.
+        """
+        if self._stream_compressor_func is None:
+            return None
+        return self._stream_compressor_func(self._compression_level)
+
     # --------------------------------------------------------------------------
     # Centralized request handler with safe error logging
     # --------------------------------------------------------------------------
@@ -211,12 +286,13 @@ class RequestsWrapper:
             safe_headers["DD-API-KEY"] = mask_api_key_value(safe_headers["DD-API-KEY"])
 
         # ----------------------------------------------------------------------
-        # Optional payload compression (POST/PUT with data)
+        # Optional payload compression (POST/PUT with data). Payloads with a
+        # Content-Encoding were compressed already, see StreamCompressor.
         # ----------------------------------------------------------------------
         encoding = None
         endpoint = urlparse(url).path
 
-        if self._compress_func and method in ("POST", "PUT"):
+        if self._compress_func and method in ("POST", "PUT") and "Content-Encoding" not in headers:
             try:
                 # Convert to bytes
                 if isinstance(data, (dict, list, tuple)):
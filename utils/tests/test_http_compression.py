@@ -1,6 +1,7 @@
 import pytest
 import json
 import logging
+import zlib
 from utils import http
 
 class DummySession:
@@ -89,3 +90,42 @@ def test_request_applies_compression(monkeypatch):
     else:
         # Compression skipped (payload too small)
         assert kwargs["data"] == data
+
+
+def test_stream_compressor():
+    compressor = http._stream_compressor_zlib()
+    compressor.write(b'{"series":[')
+    compressor.write(b"x" * 10000)
+    compressor.write(b"]}")
+    payload = compressor.getvalue()
+    assert compressor.encoding == "deflate"
+    assert compressor.raw_size == 10013
+    assert compressor.size == len(payload)
+    assert zlib.decompress(payload) == b'{"series":[' + b"x" * 10000 + b"]}"
+
+
+@pytest.mark.skipif(not http.HAS_ZSTD, reason="zstandard not available")
+def test_stream_compressor_zstd():
+    compressor = http._stream_compressor_zstd()
+    for _ in range(100):
+        compressor.write(b"x" * 1000)
+    payload = compressor.getvalue()
+    assert compressor.encoding == "zstd"
+    assert http.zstd.ZstdDecompressor().decompressobj().decompress(payload) == b"x" * 100000
+
+
+def test_request_skips_compressed_payloads(monkeypatch):
+    session = DummySession()
+    monkeypatch.setattr(http.requests, "Session", lambda: session)
+    wrapper = http.RequestsWrapper(use_compression=True, compression_kind="zlib")
+
+    compressor = wrapper.stream_compressor()
+    compressor.write(json.dumps({"series": ["x" * 10000]}).encode("utf-8"))
+    data = compressor.getvalue()
+    wrapper.request("POST", "https://unix.agent.datadoghq.com/api/v1/series", data=data,
+                    headers={"Content-Encoding": compressor.encoding})
+
+    method, url, kwargs = session.last_post
+    assert kwargs["headers"]["Content-Encoding"] == "deflate"
+    assert kwargs["data"] is data
+    assert http.RequestsWrapper().stream_compressor() is None
@@ -5,6 +5,13 @@
 
 ENCODING = 'utf-8'
 
+
+def ensure_str(data):
+    if isinstance(data, bytes):
+        return data.decode(ENCODING)
+    return data
+
+
 def ensure_unicode(data):
     for i, datum in enumerate(data):
         for key, value in list(datum.items()):